@@ -0,0 +1,10 @@
+import os, os.path
+import sys
+
+# Benchmarks of the ingest stages, the traversals, the dbdict primitives and the
+# server endpoints on synthetic river networks, run with: python -m benchmark
+# The modules of the repository are imported from its root folder.
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_FOLDER not in sys.path:
+    sys.path.insert(0, REPO_FOLDER)
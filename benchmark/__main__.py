@@ -0,0 +1,89 @@
+import os, os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from benchmark import networks, suite
+
+# python -m benchmark [--shapes ...] [--scales ...] [--output results.json] [--compare baseline.json]
+# The results are written as json, with --compare the median of every result is checked
+# against the baseline and the exit code is 1 if one of them is slower than the tolerance.
+
+GROUPS = ["ingest", "traversal", "dbdict", "server"]
+
+
+def compare(results, baseline, tolerance):
+    # returns the results that are slower than the same result of the baseline
+    key = lambda entry: (entry["group"], entry["name"], entry["shape"], entry["scale"])
+    baseline = {key(entry): entry for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        old = baseline.get(key(entry))
+        if old is None:
+            continue
+        old_median, new_median = old["seconds"]["median"], entry["seconds"]["median"]
+        if new_median > old_median * (1 + tolerance):
+            regressions.append((key(entry), old_median, new_median))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark")
+    parser.add_argument("--shapes", nargs="+", choices=networks.SHAPES, default=networks.SHAPES)
+    parser.add_argument("--scales", nargs="+", choices=list(networks.SCALES), default=["small"])
+    parser.add_argument("--groups", nargs="+", choices=GROUPS, default=GROUPS)
+    parser.add_argument("--workers", type=int, default=1, help="workers of the ingest")
+    parser.add_argument("--samples", type=int, default=200, help="waterways per traversal and endpoint")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="json file of the results, printed if not given")
+    parser.add_argument("--compare", metavar="BASELINE", help="json file of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown of the median")
+    parser.add_argument("--keep", action="store_true", help="keep the generated files")
+    args = parser.parse_args()
+
+    results = []
+    cwd = os.getcwd()
+    for shape in args.shapes:
+        for scale in args.scales:
+            workdir = tempfile.mkdtemp(prefix=f"rivers-benchmark-{shape}-{scale}-")
+            print(f"{shape} {scale}: {workdir}", file=sys.stderr)
+            try:
+                results += suite.run(shape, scale, workdir, args.workers, args.samples, args.seed, args.groups)
+            finally:
+                os.chdir(cwd)
+                if not args.keep:
+                    shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "workers": args.workers,
+            "samples": args.samples,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=1)
+    else:
+        print(json.dumps(output, indent=1))
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for (group, name, shape, scale), old_median, new_median in regressions:
+            print(f"{group} {name} ({shape} {scale}): {old_median * 1000:.3f} ms -> {new_median * 1000:.3f} ms",
+                  file=sys.stderr)
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import os, os.path
+import random
+import osmium
+
+# Synthetic river networks written as small .osm.pbf files.
+# Ways point downstream like in osm, the last node of a tributary is a node of the
+# river it flows into. Some roads and closed lakes are added, the filter has to drop them.
+
+# multiplier of the number of rivers
+SCALES = {"small": 1, "medium": 8, "large": 40}
+SHAPES = ["dendritic", "braided", "stem"]
+
+
+class Network():
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        # key=node_id, value=(lon, lat)
+        self.nodes = dict()
+        # (way_id, [node ids], tags)
+        self.ways = []
+        # (relation_id, [way ids])
+        self.relations = []
+
+
+    def node(self, lon, lat):
+        node_id = len(self.nodes) + 1
+        self.nodes[node_id] = (lon, lat)
+        return node_id
+
+
+    def chain(self, count, lon=None, lat=None):
+        # new nodes walking south, from the source towards the mouth
+        if lon is None:
+            lon, lat = self.random.uniform(-170, 170), self.random.uniform(-60, 70)
+        nodes = []
+        for _ in range(count):
+            lon += self.random.uniform(-0.01, 0.01)
+            lat -= self.random.uniform(0.001, 0.01)
+            nodes.append(self.node(lon, lat))
+        return nodes
+
+
+    def chain_to(self, mouth, count):
+        # new nodes ending in an existing node
+        lon, lat = self.nodes[mouth]
+        return self.chain(count, lon, lat + 0.011 * (count + 1)) + [mouth]
+
+
+    def river(self, nodes, segments, waterway="river", relation=True):
+        # splits the node chain into ways sharing their end nodes, returns their ids
+        segments = max(1, min(segments, len(nodes) - 1))
+        bounds = [round(i * (len(nodes) - 1) / segments) for i in range(segments + 1)]
+        way_ids = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            way_id = len(self.ways) + 1
+            self.ways.append((way_id, nodes[start:end + 1], {"waterway": waterway}))
+            way_ids.append(way_id)
+        if relation:
+            self.relations.append((len(self.relations) + 1, way_ids))
+        return way_ids
+
+
+    def noise(self, count):
+        for _ in range(count):
+            # a road crossing a river node
+            crossing = self.random.randint(1, len(self.nodes))
+            lon, lat = self.nodes[crossing]
+            road = [self.node(lon - 0.01, lat), crossing, self.node(lon + 0.01, lat)]
+            self.ways.append((len(self.ways) + 1, road, {"highway": "residential"}))
+            # a lake
+            lake = self.chain(4)
+            self.ways.append((len(self.ways) + 1, lake + lake[:1], {"natural": "water"}))
+
+
+    def write(self, path):
+        if os.path.isfile(path):
+            os.remove(path)
+        writer = osmium.SimpleWriter(path)
+        for node_id, (lon, lat) in self.nodes.items():
+            writer.add_node(osmium.osm.mutable.Node(id=node_id, location=osmium.osm.Location(lon, lat)))
+        for way_id, nodes, tags in self.ways:
+            writer.add_way(osmium.osm.mutable.Way(id=way_id, nodes=nodes, tags=tags))
+        for relation_id, way_ids in self.relations:
+            writer.add_relation(osmium.osm.mutable.Relation(
+                id=relation_id, members=[("w", way_id, "main_stream") for way_id in way_ids],
+                tags={"type": "waterway", "waterway": "river"}))
+        writer.close()
+
+
+def dendritic(network, scale):
+    # trees of rivers, every river has a few tributaries down to a depth of 3
+
+    def tributaries(nodes, depth):
+        if depth == 0 or len(nodes) < 3:
+            return
+        for _ in range(network.random.randint(1, 3)):
+            mouth = network.random.choice(nodes[1:-1])
+            tributary = network.chain_to(mouth, network.random.randint(6, 20))
+            network.river(tributary, network.random.randint(1, 4), "river" if depth > 1 else "stream", depth > 1)
+            tributaries(tributary, depth - 1)
+
+    for _ in range(4 * scale):
+        main = network.chain(network.random.randint(30, 60))
+        network.river(main, network.random.randint(3, 8))
+        tributaries(main, 3)
+
+
+def braided(network, scale):
+    # a main stem ending in a delta of channels that split and join each other
+    for _ in range(scale):
+        main = network.chain(40)
+        network.river(main, 8)
+        channel_nodes = [main[-1]]
+        for _ in range(16):
+            start = network.random.choice(channel_nodes)
+            lon, lat = network.nodes[start]
+            channel = [start] + network.chain(network.random.randint(4, 10), lon, lat)
+            # joins another channel
+            if network.random.random() < 0.5 and len(channel_nodes) > 1:
+                end = network.random.choice(channel_nodes)
+                if end not in channel:
+                    channel.append(end)
+            network.river(channel, 2, network.random.choice(["river", "stream"]), network.random.random() < 0.3)
+            channel_nodes.extend(channel[1:])
+
+
+def stem(network, scale):
+    # a single very long river relation with short streams along it
+    main = network.chain(200 * scale)
+    network.river(main, 100 * scale)
+    for _ in range(30 * scale):
+        mouth = network.random.choice(main[1:-1])
+        network.river(network.chain_to(mouth, network.random.randint(3, 10)), 1, "stream", False)
+
+
+GENERATORS = {"dendritic": dendritic, "braided": braided, "stem": stem}
+
+
+def generate(shape, scale, path, seed=1):
+    # returns (number of ways, number of relations)
+    network = Network(seed)
+    GENERATORS[shape](network, SCALES[scale])
+    network.noise(SCALES[scale] * 10)
+    network.write(path)
+    return len(network.ways), len(network.relations)
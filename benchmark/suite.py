@@ -0,0 +1,251 @@
+import os, os.path
+import sys
+import io
+import gzip
+import json
+import time
+import random
+import sqlite3
+import importlib
+import contextlib
+from benchmark import networks
+
+# Every benchmark returns a list of results:
+#   {"group": ..., "name": ..., "seconds": {count, mean, min, median, p95, max}, ...}
+# a result can carry more fields (e.g. the mean size of a traversal)
+
+TOTP_SECRET = "JBSWY3DPEHPK3PXP"
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "min": samples[0],
+        "median": samples[len(samples) // 2],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max": samples[-1],
+    }
+
+
+def result(group, name, samples, **fields):
+    return {"group": group, "name": name, "seconds": summarize(samples), **fields}
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    return time.perf_counter() - start, value
+
+
+def time_calls(function, args_list):
+    # (samples, mean size of the returned values)
+    samples = []
+    sizes = []
+    for args in args_list:
+        seconds, value = timed(function, *args)
+        samples.append(seconds)
+        sizes.append(len(value) if hasattr(value, "__len__") else 1)
+    return samples, sum(sizes) / max(1, len(sizes))
+
+
+def ingest(workdir, workers=1):
+    # a full rivers.py run on workdir/src, with the records of its stages (see stages.py)
+    import rivers
+    os.chdir(workdir)
+    os.makedirs(rivers.DICT_DB_FOLDER, exist_ok=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, records = timed(rivers.write, False, workers, "src")
+    results = [result("ingest", record["name"], [record["seconds"]], peak_rss=record["peak_rss"],
+                      objects=record["objects"], tables=record["tables"]) for record in records]
+    results.append(result("ingest", "total", [seconds]))
+    return results
+
+
+def sample_waterways(workdir, count, seed):
+    from graph import Graph
+    graph = Graph.load(os.path.join(workdir, "data"))
+    waterway_ids = graph.waterway_ids.tolist()
+    return random.Random(seed).sample(waterway_ids, min(count, len(waterway_ids)))
+
+
+def traversals(workdir, waterway_ids):
+    from db_dict import dbdict
+    from graph import Graph
+    from relations import downstream, local_confluence, graph_downstream, indexed_downstream, graph_local_confluence
+    folder = os.path.join(workdir, "data")
+    node_to_waterways = dbdict(folder, "node_to_waterways")
+    waterway_to_nodes = dbdict(folder, "waterway_to_nodes")
+    waterway_to_river = dbdict(folder, "waterway_to_river")
+    river_to_waterways = dbdict(folder, "river_to_waterways")
+    # not written anymore, the tables based traversal calculates every local confluence
+    river_to_local_confluence = None
+    graph = Graph.load(folder)
+
+    cases = [
+        ("relations.downstream", downstream, [(w, node_to_waterways, waterway_to_nodes) for w in waterway_ids]),
+        ("relations.local_confluence", local_confluence,
+         [(w, node_to_waterways, waterway_to_nodes, waterway_to_river, river_to_waterways, river_to_local_confluence)
+          for w in waterway_ids]),
+        ("graph_downstream", graph_downstream, [(w, graph) for w in waterway_ids]),
+        ("indexed_downstream", indexed_downstream, [(w, graph) for w in waterway_ids]),
+        ("graph_local_confluence", graph_local_confluence, [(w, graph) for w in waterway_ids]),
+    ]
+    results = []
+    for name, function, args_list in cases:
+        samples, mean_size = time_calls(function, args_list)
+        results.append(result("traversal", name, samples, mean_size=mean_size))
+    return results
+
+
+def dbdict_primitives(workdir, count, seed):
+    from db_dict import dbdict
+    from value_codecs import CODECS
+    folder = os.path.join(workdir, "dbdict")
+    os.makedirs(folder, exist_ok=True)
+    generator = random.Random(seed)
+    items = [(key, [generator.randint(1, 1 << 40) for _ in range(generator.randint(1, 8))])
+             for key in generator.sample(range(1, 1 << 40), count)]
+    keys = [key for key, _ in items]
+    missing = [key + 1 for key in keys]
+
+    results = []
+    for codec in CODECS:
+        for name in (f"set_{codec}", f"bulk_{codec}"):
+            for suffix in (".sqlite", ".bloom"):
+                if os.path.isfile(os.path.join(folder, f"dict_db_{name}{suffix}")):
+                    os.remove(os.path.join(folder, f"dict_db_{name}{suffix}"))
+
+        table = dbdict(folder, f"set_{codec}", codec=codec, bulk=True)
+        seconds, _ = timed(lambda: ([table.__setitem__(key, value) for key, value in items], table.flush()))
+        results.append(result("dbdict", f"{codec} set+flush", [seconds / count]))
+        table.close()
+
+        table = dbdict(folder, f"bulk_{codec}", codec=codec, bulk=True)
+        seconds, _ = timed(table.bulk_insert, items)
+        results.append(result("dbdict", f"{codec} bulk_insert", [seconds / count]))
+        table.close()
+
+        table = dbdict(folder, f"bulk_{codec}")
+        seconds, _ = timed(lambda: [table.get(key) for key in keys])
+        results.append(result("dbdict", f"{codec} get uncached", [seconds / count]))
+        seconds, _ = timed(lambda: [table.get(key) for key in keys])
+        results.append(result("dbdict", f"{codec} get cached", [seconds / count]))
+        seconds, _ = timed(lambda: [key in table for key in missing])
+        results.append(result("dbdict", f"{codec} contains missing", [seconds / count]))
+        table.build_bloom()
+        seconds, _ = timed(lambda: [key in table for key in missing])
+        results.append(result("dbdict", f"{codec} contains missing (bloom)", [seconds / count]))
+        seconds, _ = timed(lambda: sum(1 for _ in table.items()))
+        results.append(result("dbdict", f"{codec} items", [seconds / count]))
+        table.close()
+    return results
+
+
+def write_mbtiles(path, seed):
+    # a few gzip compressed random tiles at zoom 4
+    if os.path.isfile(path):
+        os.remove(path)
+    generator = random.Random(seed)
+    con = sqlite3.connect(path)
+    con.execute("create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+    con.execute("create unique index tile_index on tiles (zoom_level, tile_column, tile_row)")
+    for x in range(16):
+        for y in range(16):
+            tile_data = gzip.compress(bytes(generator.getrandbits(8) for _ in range(2048)))
+            con.execute("insert into tiles values (4, ?, ?, ?)", (x, y, tile_data))
+    con.commit()
+    con.close()
+
+
+def load_server(workdir, seed):
+    # imports (or reloads) server.py with a config pointing to workdir
+    write_mbtiles(os.path.join(workdir, "tiles.mbtiles"), seed)
+    with open(os.path.join(workdir, "style.json"), "w") as file:
+        json.dump({"version": 8, "sources": {}, "layers": []}, file)
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as file:
+        json.dump({"secret": TOTP_SECRET, "mbtiles_path": os.path.join(workdir, "tiles.mbtiles"), "port": 8000,
+                   "style_path": os.path.join(workdir, "style.json"),
+                   "dict_db_folder": os.path.join(workdir, "data")}, file)
+    sys.argv = ["server.py", config_path]
+    if "server" in sys.modules:
+        return importlib.reload(sys.modules["server"])
+    return importlib.import_module("server")
+
+
+def endpoints(workdir, waterway_ids, seed):
+    import pyotp
+    from consts import COORDINATE_PRECISION
+    from fastapi.testclient import TestClient
+    server = load_server(workdir, seed)
+    client = TestClient(server.app)
+    totp = pyotp.TOTP(TOTP_SECRET, interval=4 * 60)
+
+    def headers():
+        # a token per request, a run can outlast the interval of a single one
+        return {"totp-token": totp.now()}
+
+    def checked(response, status=200):
+        # error bodies must not be timed as results
+        if response.status_code != status:
+            raise RuntimeError(f"{response.request.method} {response.request.url} returned {response.status_code}, "
+                               f"expected {status}: {response.text[:200]}")
+        return response.content
+
+    def get(url, extra_headers=None, status=200):
+        return checked(client.get(url, headers={**headers(), **(extra_headers or {})}), status)
+
+    tiles = [(x, y) for x in range(16) for y in range(16)]
+    etag = client.get("/data/4/0/15.pbf", headers=headers()).headers["etag"]
+    # the first node of the sampled waterways, moved a bit off the river
+    points = []
+    for w in waterway_ids:
+        xs, ys = server.waterway_geometry(w)
+        points.append((xs[0] / COORDINATE_PRECISION + 0.001, ys[0] / COORDINATE_PRECISION))
+    cases = [
+        ("GET /downstream", [(f"/downstream/{w}",) for w in waterway_ids]),
+        ("GET /downstream?format=varint", [(f"/downstream/{w}?format=varint",) for w in waterway_ids]),
+        ("GET /local_confluence", [(f"/local_confluence/{w}",) for w in waterway_ids]),
+        ("GET /local_confluence?format=stream", [(f"/local_confluence/{w}?format=stream",) for w in waterway_ids]),
+        ("GET /local_confluence?format=geojson", [(f"/local_confluence/{w}?format=geojson&zoom=8",)
+                                                  for w in waterway_ids]),
+        ("GET /confluence", [(f"/confluence/{w}",) for w in waterway_ids]),
+        ("GET /data", [(f"/data/4/{x}/{y}.pbf",) for x, y in tiles]),
+        ("GET /data 304", [("/data/4/0/15.pbf", {"If-None-Match": etag}, 304)] * len(tiles)),
+        ("GET /nearest", [(f"/nearest?lon={lon}&lat={lat}",) for lon, lat in points]),
+        ("GET /waterways", [(f"/waterways?bbox={lon - 0.1},{lat - 0.1},{lon + 0.1},{lat + 0.1}",) for lon, lat in points]),
+    ]
+    results = []
+    for name, args_list in cases:
+        # the first pass fills the caches of the server
+        for run in ("cold", "warm"):
+            samples, mean_size = time_calls(get, args_list)
+            results.append(result("server", f"{name} {run}", samples, mean_bytes=mean_size))
+
+    batch = {"waterway_ids": waterway_ids[:100]}
+    samples, mean_size = time_calls(
+        lambda: checked(client.post("/batch", json=batch, headers=headers())), [()] * 10)
+    results.append(result("server", f"POST /batch ({len(batch['waterway_ids'])} ids)", samples, mean_bytes=mean_size))
+    return results
+
+
+def run(shape, scale, workdir, workers=1, samples=200, seed=1, groups=("ingest", "traversal", "dbdict", "server")):
+    # generates the network into workdir/src and runs the benchmark groups on it
+    os.makedirs(os.path.join(workdir, "src"), exist_ok=True)
+    num_ways, num_relations = networks.generate(shape, scale, os.path.join(workdir, "src", f"{shape}.osm.pbf"), seed)
+    dataset = {"shape": shape, "scale": scale, "ways": num_ways, "relations": num_relations}
+    results = ingest(workdir, workers)
+    if "ingest" not in groups:
+        results = []
+    waterway_ids = sample_waterways(workdir, samples, seed)
+    if "traversal" in groups:
+        results += traversals(workdir, waterway_ids)
+    if "dbdict" in groups:
+        results += dbdict_primitives(workdir, samples * 10, seed)
+    if "server" in groups:
+        results += endpoints(workdir, waterway_ids, seed)
+    for entry in results:
+        entry.update(dataset)
+    return results
@@ -0,0 +1,90 @@
+import math
+import struct
+import numpy as np
+
+# Bloom filter over integer keys, used by dbdict to answer most negative
+# __contains__ lookups without querying SQLite.
+
+MAGIC = b"WRBLOOM1"
+HEADER = struct.Struct("<8sQQ3q")
+MASK = (1 << 64) - 1
+
+
+def _mix(x):
+    # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK
+    return x ^ (x >> 31)
+
+
+def _mix_array(x):
+    # same as _mix for a uint64 numpy array, multiplication wraps around
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+class BloomFilter():
+
+    def __init__(self, num_bits, num_hashes, fingerprint=(0, 0, 0), bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        # (write generation, last rowid, 0) of the table the filter was built for,
+        # used to detect stale files (see dbdict._fingerprint)
+        self.fingerprint = tuple(fingerprint)
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=0.01):
+        capacity = max(capacity, 1)
+        num_bits = int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2) + 1
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+
+    def _positions(self, key):
+        # double hashing: h1 + i * h2
+        h1 = _mix(key & MASK)
+        h2 = _mix(h1) | 1
+        return [((h1 + i * h2) & MASK) % self.num_bits for i in range(self.num_hashes)]
+
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+
+    def add_many(self, keys):
+        keys = np.asarray(keys, dtype=np.int64).view(np.uint64)
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        h1 = _mix_array(keys)
+        h2 = _mix_array(h1) | np.uint64(1)
+        for i in range(self.num_hashes):
+            positions = (h1 + np.uint64(i) * h2) % np.uint64(self.num_bits)
+            np.bitwise_or.at(bits, (positions >> np.uint64(3)).astype(np.int64),
+                             (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, self.num_bits, self.num_hashes, *self.fingerprint))
+            file.write(self.bits)
+
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            magic, num_bits, num_hashes, *fingerprint = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a bloom filter file")
+            bits = bytearray(file.read())
+        return cls(num_bits, num_hashes, fingerprint, bits)
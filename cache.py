@@ -0,0 +1,86 @@
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+# overhead of an OrderedDict entry with its key, roughly
+ENTRY_OVERHEAD = 100
+# size of a small int object referenced from a list
+INT_SIZE = 32
+
+
+def value_size(value):
+    # approximate memory used by a cached value
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + INT_SIZE * len(value)
+    return sys.getsizeof(value)
+
+
+class LRUCache():
+    # least recently used cache bounded by the (approximate) size of its values in bytes
+
+    def __init__(self, max_bytes, sizeof=value_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    def put(self, key, value):
+        size = self.sizeof(value) + ENTRY_OVERHEAD
+        # values bigger than the whole cache are not cached
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
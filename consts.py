@@ -2,11 +2,25 @@ FILE = "croatia-latest.osm"
 PREFIX = "."
 OSM_FILE = f"{PREFIX}/sources/{FILE}.pbf"
 CSV_FILE = f"{PREFIX}/confluences.csv"
+# waterway ids changed by the last incremental update (rivers.py --update)
+CHANGED_FILE = f"{PREFIX}/changed_waterways.txt"
 CSV_FOLDER = f"{PREFIX}/csv"
 DICT_DB_FOLDER = f"{PREFIX}/data"
+# finished stages of the last rivers.py run (see stages.py)
+MANIFEST_FILE = f"{PREFIX}/manifest.json"
+# the graph as left by the last finished stage of rivers.py
+CHECKPOINT_FOLDER = f"{DICT_DB_FOLDER}/checkpoint"
+# waterway-only extracts of the input files (see extract.py)
+EXTRACT_FOLDER = f"{PREFIX}/extracts"
 
 CLASSES = ["river", "stream"]
+# osmium stores coordinates as fixed point integers
+COORDINATE_PRECISION = 10000000
 
 
 MAX = 1000
+# smaller levels of local confluences are not worth forking processes for
+MIN_PARALLEL_RIVERS = 64
+# size of the read cache of every dbdict
+CACHE_BYTES = 64 * 1024 * 1024
 VERBOSE = False
\ No newline at end of file
@@ -1,64 +1,200 @@
 import os, os.path
+import sys
 from sqlite3 import dbapi2 as sqlite
-import json
 from consts import *
+from value_codecs import get_codec
+from cache import LRUCache
+from bloom import BloomFilter
+import copy
+import time
 
 # code modified from: http://sebsauvage.net/python/snyppets/index.html#dbdict
 
+# pragmas for writing large tables, durability is not needed since a failed
+# ingest stage is run again from empty tables (see rivers.write)
+BULK_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA mmap_size=1073741824",
+]
+BULK_PAGE_SIZE = 65536
+
+
 class dbdict():
+    # codec: name of the value codec (see value_codecs.py), the codec of an existing
+    # file is read from its meta table, files without one are json
+    # bulk: tunes the connection for bulk loading
+    # max_elements bounds the write-back buffer (dirty values), cache_bytes bounds the
+    # read cache (clean values), the two are kept separate so reads never cause writes
    
-    def __init__(self, folder, name, max_elements=10000, check_same_thread=True):
+    def __init__(self, folder, name, max_elements=10000, check_same_thread=True, codec=None, bulk=False,
+                 cache_bytes=CACHE_BYTES):
+        self.name = name
         self.db_filename = os.path.join(folder, f"dict_db_{name}.sqlite")
+        self.bloom_filename = os.path.join(folder, f"dict_db_{name}.bloom")
         self._write_dict = dict()
         self.max_elements = max_elements
+        self._read_cache = LRUCache(cache_bytes)
+        self.bulk = bulk
+        # stats
+        self.queries = 0
+        self.writes = 0
+        self.flushes = 0
+        # rows read by keys and items
+        self.scanned = 0
+        # time spent in the single key queries
+        self.query_seconds = 0.0
+        self.bloom_negatives = 0
         if not os.path.isfile(self.db_filename):
             self.con = sqlite.connect(self.db_filename, check_same_thread=check_same_thread)
+            if bulk:
+                self.con.execute(f"PRAGMA page_size={BULK_PAGE_SIZE}")
             self.con.execute("create table data (key PRIMARY KEY, value)")
+            self.con.execute("create table meta (key PRIMARY KEY, value)")
+            self.con.execute("insert into meta (key,value) values ('codec',?)", (codec or "json",))
+            self.con.commit()
+            stored_codec = codec or "json"
         else:
             self.con = sqlite.connect(self.db_filename, check_same_thread=check_same_thread)
+            stored_codec = self._stored_codec()
+            if codec is not None and codec != stored_codec:
+                raise ValueError(f"{self.db_filename} uses the {stored_codec} codec, not {codec}. "
+                                 f"Convert it with: python db_dict.py {folder} {name} {codec}")
+        self.codec = get_codec(stored_codec)
+        if bulk:
+            for pragma in BULK_PRAGMAS:
+                self.con.execute(pragma)
+        self.bloom = None
+        self._bloom_dirty = False
+        self._load_bloom()
+
+
+    def _fingerprint(self):
+        # (write generation, last rowid), both are read without scanning the table
+        generation = self.con.execute("select value from meta where key='generation'").fetchone() if self._has_meta() else None
+        last_rowid = self.con.execute("select max(rowid) from data").fetchone()[0]
+        return (generation[0] if generation else 0, last_rowid or 0, 0)
+
+
+    def _has_meta(self):
+        return self.con.execute("select name from sqlite_master where type='table' and name='meta'").fetchone() is not None
+
+
+    def _count_write(self):
+        # bumps the write generation in the transaction of a write, so a saved bloom filter
+        # that does not know the written keys does not match the table anymore
+        if not self._has_meta():
+            # tables of older versions
+            self.con.execute("create table meta (key PRIMARY KEY, value)")
+            self.con.execute("insert into meta (key,value) values ('codec','json')")
+        self.con.execute("insert into meta (key,value) values ('generation',1) "
+                         "on conflict (key) do update set value=value+1")
+
+
+    def _load_bloom(self):
+        # negative lookup accelerator, only used if it matches the table
+        if not os.path.isfile(self.bloom_filename):
+            return
+        bloom = BloomFilter.load(self.bloom_filename)
+        if bloom.fingerprint == self._fingerprint():
+            self.bloom = bloom
+
+
+    def build_bloom(self, false_positive_rate=0.01):
+        # builds and saves a bloom filter over the (integer) keys of the table,
+        # so most lookups of missing keys never reach sqlite
+        self.flush()
+        keys = self.keys()
+        bloom = BloomFilter.for_capacity(len(keys), false_positive_rate)
+        bloom.add_many(keys)
+        bloom.fingerprint = self._fingerprint()
+        bloom.save(self.bloom_filename)
+        self.bloom = bloom
+        self._bloom_dirty = False
+
+
+    def _stored_codec(self):
+        if not self._has_meta():
+            return "json"
+        row = self.con.execute("select value from meta where key='codec'").fetchone()
+        return row[0] if row else "json"
         
 
+    def _read(self, key):
+        # clean value from the read cache or the db, None if missing
+        result = self._read_cache.get(key)
+        if result is not None:
+            return result
+        if self.bloom is not None and key not in self.bloom:
+            self.bloom_negatives += 1
+            return None
+        self.queries += 1
+        start = time.perf_counter()
+        row = self.con.execute("select value from data where key=?", (key,)).fetchone()
+        self.query_seconds += time.perf_counter() - start
+        if not row:
+            return None
+        result = self.codec.decode(row[0])
+        self._read_cache.put(key, result)
+        return result
+
+
     def __getitem__(self, key):
-        # returns a reference from the _write_dict
+        # the result can be modified, but has to be set again to be stored
         if key in self._write_dict:
             return self._write_dict[key]
-        else:
-            row = self.con.execute("select value from data where key=?", (key,)).fetchone()
-            if not row: raise KeyError
-            result = json.loads(row[0])
-        # clear cache if overused
-        if len(self._write_dict) >= self.max_elements:
-            self.flush()
-        self._write_dict[key] = result
-        return result
+        result = self._read(key)
+        if result is None:
+            raise KeyError
+        # the cached value must not change
+        return copy.copy(result)
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
     
 
     def fast_get(self, key):
         # the result should not be modified
         if key in self._write_dict:
             return self._write_dict[key]
-        else:
-            row = self.con.execute("select value from data where key=?", (key,)).fetchone()
-            if not row:
-                raise KeyError
-            result = json.loads(row[0])
+        result = self._read(key)
+        if result is None:
+            raise KeyError
         return result
 
 
     def __contains__(self, key):
         # check in cache first
-        if key in self._write_dict:
+        if key in self._write_dict or key in self._read_cache:
             return True
-        row = self.con.execute("select value from data where key=?", (key,)).fetchone()
+        if self.bloom is not None and key not in self.bloom:
+            self.bloom_negatives += 1
+            return False
+        self.queries += 1
+        start = time.perf_counter()
+        row = self.con.execute("select 1 from data where key=?", (key,)).fetchone()
+        self.query_seconds += time.perf_counter() - start
         if not row: return False
         return True
     
 
     def flush(self):
-        # insert into db
-        for dict_key, dict_value in self._write_dict.items():
-            self.con.execute("insert or replace into data (key,value) values (?,?)", (dict_key, json.dumps(dict_value)))
+        # insert into db, a single transaction per batch
+        if not self._write_dict:
+            return
+        encode = self.codec.encode
+        self.con.executemany("insert or replace into data (key,value) values (?,?)",
+                             ((dict_key, encode(dict_value)) for dict_key, dict_value in self._write_dict.items()))
+        self._count_write()
         self.con.commit()
+        self.writes += len(self._write_dict)
+        self.flushes += 1
         self._write_dict.clear()
     
 
@@ -66,6 +202,10 @@ class dbdict():
         if key not in self._write_dict:
             if len(self._write_dict) >= self.max_elements:
                 self.flush()
+        self._read_cache.pop(key)
+        if self.bloom is not None:
+            self.bloom.add(key)
+            self._bloom_dirty = True
         self._write_dict[key] = item
 
 
@@ -74,27 +214,142 @@ class dbdict():
         if key in self._write_dict:
             exists = True
             del self._write_dict[key]
+        self._read_cache.pop(key)
         if self.con.execute("select key from data where key=?", (key,)).fetchone():
             exists = True
             self.con.execute("delete from data where key=?", (key,))
+            self._count_write()
             self.con.commit()
         if not exists:
              raise KeyError
     
 
+    def bulk_insert(self, items):
+        # writes (key, value) pairs directly in a single transaction, bypassing the cache
+        self.flush()
+        encode = self.codec.encode
+        self._read_cache.clear()
+        if self.bloom is not None:
+            items = list(items)
+            self.bloom.add_many([key for key, _ in items])
+            self._bloom_dirty = True
+        cursor = self.con.executemany("insert or replace into data (key,value) values (?,?)",
+                                      ((key, encode(value)) for key, value in items))
+        self._count_write()
+        self.con.commit()
+        self.writes += cursor.rowcount
+        self.flushes += 1
+
+
+    def merge(self, other, append=False):
+        # copies the rows of another table with the same codec inside sqlite, keys that are
+        # already present keep their value, with append their lists are concatenated instead
+        # (only for the int64 codec, where joining the encoded values joins the lists)
+        if other.codec.name != self.codec.name:
+            raise ValueError(f"{other.db_filename} uses the {other.codec.name} codec, not {self.codec.name}")
+        if append and self.codec.name != "int64":
+            raise ValueError(f"Values of the {self.codec.name} codec can not be appended")
+        self.flush()
+        other.flush()
+        self.con.execute("attach database ? as other", (other.db_filename,))
+        if append:
+            # || works on text, the cast keeps the result a blob
+            cursor = self.con.execute("update data set value = cast(value || (select o.value from other.data as o where o.key = data.key) "
+                                      "as blob) where key in (select key from other.data)")
+            self.writes += cursor.rowcount
+        cursor = self.con.execute("insert or ignore into data (key,value) select key, value from other.data order by rowid")
+        self._count_write()
+        self.con.commit()
+        self.writes += cursor.rowcount
+        self.flushes += 1
+        self.con.execute("detach database other")
+        self._read_cache.clear()
+        # the filter does not know the new keys
+        self.bloom = None
+        self._bloom_dirty = False
+
+
     def clear_redundant_nodes(self):
         # delete all nodes with only a single waterway connected with them
         self.flush()
-        self.con.execute("delete from data where json_array_length(value) = 1")
+        if self.codec.single_element_sql is not None:
+            self.con.execute(f"delete from data where {self.codec.single_element_sql}")
+        else:
+            single = [(key,) for key, value in self.items() if len(value) == 1]
+            self.con.executemany("delete from data where key=?", single)
+        self._count_write()
         self.con.commit()
+        self._read_cache.clear()
         self.con.execute("VACUUM")
 
             
     def keys(self):
         self.flush()
-        return [row[0] for row in self.con.execute("select key from data").fetchall()]
-    
+        keys = [row[0] for row in self.con.execute("select key from data").fetchall()]
+        self.scanned += len(keys)
+        return keys
 
-    def __del__(self):
+
+    def items(self):
+        # iterates over the whole table without loading it into memory
         self.flush()
+        decode = self.codec.decode
+        for key, value in self.con.execute("select key, value from data"):
+            self.scanned += 1
+            yield key, decode(value)
+
+
+    def stats(self):
+        return {"queries": self.queries, "writes": self.writes, "flushes": self.flushes, "scanned": self.scanned,
+                "query_seconds": self.query_seconds, "bloom_negatives": self.bloom_negatives, "cache": self._read_cache.stats()}
+
+
+    def close(self):
+        if getattr(self, "con", None) is None:
+            return
+        self.flush()
+        # keys were added, the saved filter has to match the table again
+        if self._bloom_dirty:
+            self.bloom.fingerprint = self._fingerprint()
+            self.bloom.save(self.bloom_filename)
+        # leave a single self-contained file behind (tilemaker reads the tables)
+        if self.bulk:
+            self.con.execute("PRAGMA journal_mode=DELETE")
         self.con.close()
+        self.con = None
+    
+
+    def __del__(self):
+        self.close()
+
+
+def convert(folder, name, codec):
+    # one-shot conversion of an existing table to another value codec
+    source = dbdict(folder, name)
+    tmp_name = f"{name}_converting"
+    if os.path.isfile(os.path.join(folder, f"dict_db_{tmp_name}.sqlite")):
+        os.remove(os.path.join(folder, f"dict_db_{tmp_name}.sqlite"))
+    target = dbdict(folder, tmp_name, codec=codec, bulk=True)
+    target.bulk_insert(source.items())
+    source.close()
+    target.close()
+    os.replace(target.db_filename, source.db_filename)
+
+
+def exists(folder, name):
+    return os.path.isfile(os.path.join(folder, f"dict_db_{name}.sqlite"))
+
+
+def remove(folder, name):
+    # deletes a table with its bloom filter and the journal of an interrupted bulk load
+    for suffix in (".sqlite", ".sqlite-wal", ".sqlite-shm", ".sqlite-journal", ".bloom"):
+        path = os.path.join(folder, f"dict_db_{name}{suffix}")
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Usage: python db_dict.py <dict_db_folder> <table_name> <codec>")
+        exit(0)
+    convert(sys.argv[1], sys.argv[2], sys.argv[3])
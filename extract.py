@@ -0,0 +1,179 @@
+import os, os.path
+import sys
+import json
+import hashlib
+import multiprocessing
+from array import array
+import numpy as np
+import osmium
+from consts import *
+
+# Waterway-only extracts of the input files: the ways and relations tagged with one
+# of CLASSES and the nodes of those ways. They are a tiny fraction of a country file,
+# so all the passes of rivers.py read them instead of decoding the full file again.
+#
+# An extract is keyed by the content hash of its input file (and CLASSES), the hash is
+# only calculated again if the mtime or the size of the input file changed.
+
+# bumped when the content of the extracts changes
+EXTRACT_VERSION = 1
+MEMO_FILE = "extracts.json"
+HASH_CHUNK = 1 << 20
+NODE_BATCH = 1 << 20
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_path(osm_file, content_hash):
+    key = hashlib.blake2b(f"{content_hash},{EXTRACT_VERSION},{','.join(CLASSES)}".encode(), digest_size=8).hexdigest()
+    name = os.path.basename(osm_file)
+    for suffix in (".osm.pbf", ".pbf"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return os.path.join(EXTRACT_FOLDER, f"{name}-{key}.osm.pbf")
+
+
+class WaterwayNodeIdsHandler(osmium.SimpleHandler):
+    # only ways, the node blocks of the file are not decoded
+
+    def __init__(self):
+        osmium.SimpleHandler.__init__(self)
+        self.node_ids = array("q")
+
+
+    def way(self, w):
+        if w.tags.get("waterway") not in CLASSES:
+            return
+        self.node_ids.extend(n.ref for n in w.nodes)
+
+
+class NodeWriter(osmium.SimpleHandler):
+    # writes the nodes that are in the sorted node_ids array, checked in batches
+
+    def __init__(self, writer, node_ids):
+        osmium.SimpleHandler.__init__(self)
+        self.writer = writer
+        self.node_ids = node_ids
+        self.ids = array("q")
+        # fixed point coordinates, valid or not
+        self.xs = array("q")
+        self.ys = array("q")
+
+
+    def node(self, n):
+        self.ids.append(n.id)
+        self.xs.append(n.location.x)
+        self.ys.append(n.location.y)
+        if len(self.ids) >= NODE_BATCH:
+            self.flush()
+
+
+    def flush(self):
+        if len(self.ids) and len(self.node_ids):
+            ids = np.frombuffer(self.ids, dtype=np.int64)
+            positions = np.minimum(np.searchsorted(self.node_ids, ids), len(self.node_ids) - 1)
+            for i in np.flatnonzero(self.node_ids[positions] == ids).tolist():
+                location = osmium.osm.Location(self.xs[i] / COORDINATE_PRECISION, self.ys[i] / COORDINATE_PRECISION)
+                self.writer.add_node(osmium.osm.mutable.Node(id=self.ids[i], location=location))
+        self.ids = array("q")
+        self.xs = array("q")
+        self.ys = array("q")
+
+
+class WaterwayWriter(osmium.SimpleHandler):
+
+    def __init__(self, writer):
+        osmium.SimpleHandler.__init__(self)
+        self.writer = writer
+
+
+    def way(self, w):
+        if w.tags.get("waterway") in CLASSES:
+            self.writer.add_way(w)
+
+
+    def relation(self, r):
+        if r.tags.get("waterway") in CLASSES:
+            self.writer.add_relation(r)
+
+
+def write_extract(osm_file, path):
+    # nodes, ways and relations in this order, like in the input files
+    node_ids_handler = WaterwayNodeIdsHandler()
+    node_ids_handler.apply_file(osm_file)
+    node_ids = np.unique(np.frombuffer(node_ids_handler.node_ids, dtype=np.int64))
+
+    tmp_path = path + ".tmp.osm.pbf"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    writer = osmium.SimpleWriter(tmp_path)
+    try:
+        node_writer = NodeWriter(writer, node_ids)
+        node_writer.apply_file(osm_file)
+        node_writer.flush()
+        WaterwayWriter(writer).apply_file(osm_file)
+    finally:
+        writer.close()
+    os.replace(tmp_path, path)
+
+
+def extract_file(job):
+    # process pool worker, returns (osm_file, memo entry)
+    osm_file, stat, content_hash = job
+    if content_hash is None:
+        content_hash = file_hash(osm_file)
+    path = extract_path(osm_file, content_hash)
+    if not os.path.isfile(path):
+        write_extract(osm_file, path)
+    return osm_file, {"mtime": stat[0], "size": stat[1], "hash": content_hash, "extract": path}
+
+
+def extract_files(files, workers=1):
+    # returns the extract of every file, only missing or outdated extracts are written
+    os.makedirs(EXTRACT_FOLDER, exist_ok=True)
+    memo_path = os.path.join(EXTRACT_FOLDER, MEMO_FILE)
+    memo = dict()
+    if os.path.isfile(memo_path):
+        with open(memo_path) as file:
+            memo = json.load(file)
+
+    jobs = []
+    for osm_file in files:
+        stat = os.stat(osm_file)
+        stat = (stat.st_mtime_ns, stat.st_size)
+        entry = memo.get(os.path.abspath(osm_file))
+        # the hash is only trusted while the file looks unchanged
+        content_hash = entry["hash"] if entry and (entry["mtime"], entry["size"]) == stat else None
+        jobs.append((osm_file, stat, content_hash))
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(extract_file, jobs)
+    else:
+        results = [extract_file(job) for job in jobs]
+
+    for osm_file, entry in results:
+        old_entry = memo.get(os.path.abspath(osm_file))
+        # the previous extract of a changed file is not needed anymore
+        if old_entry and old_entry["extract"] != entry["extract"] and os.path.isfile(old_entry["extract"]):
+            os.remove(old_entry["extract"])
+        memo[os.path.abspath(osm_file)] = entry
+    with open(memo_path, "w") as file:
+        json.dump(memo, file, indent=1)
+    return [entry["extract"] for _, entry in results]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python extract.py <path_to_osm_pbf_folder>")
+        exit(0)
+    files = [os.path.join(sys.argv[1], file) for file in os.listdir(sys.argv[1])]
+    for extract in extract_files(files):
+        print(extract)
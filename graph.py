@@ -0,0 +1,303 @@
+import os, os.path
+import mmap
+import struct
+import numpy as np
+
+# Compact, read-only representation of the waterway graph.
+# OSM ids are remapped to dense int32 indices (position in the sorted id arrays)
+# and all adjacency is stored in CSR form (ptr/idx array pairs), so traversals
+# are plain array walks without any SQLite queries or json decoding.
+
+GRAPH_FILE = "graph.snapshot"
+
+# Snapshot file layout, all little endian:
+#   header:  magic (8 bytes), version (u32), number of arrays (u32)
+#   entries: name (32 bytes), dtype (8 bytes), shape (2 x u64, second is 0 for 1d arrays),
+#            offset (u64), size in bytes (u64)
+#   data:    the raw array contents, each aligned to ALIGNMENT bytes
+# The file is memory mapped read-only, so all server workers share one copy
+# of the graph in the page cache and loading it does not read the arrays.
+SNAPSHOT_MAGIC = b"WRGRAPH1"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sII")
+SNAPSHOT_ENTRY = struct.Struct("<32s8sQQQQ")
+ALIGNMENT = 64
+
+
+def _csr(lists, size):
+    # lists: iterable of (row, [values]) pairs, rows in range(size)
+    counts = np.zeros(size + 1, dtype=np.int64)
+    rows = []
+    values = []
+    for row, row_values in lists:
+        counts[row + 1] += len(row_values)
+        rows.append(row)
+        values.append(row_values)
+    ptr = np.cumsum(counts)
+    idx = np.empty(ptr[-1], dtype=np.int32)
+    for row, row_values in zip(rows, values):
+        idx[ptr[row]:ptr[row + 1]] = row_values
+    return ptr, idx
+
+
+def _indices(ids, osm_ids):
+    # positions of osm_ids in the sorted ids array, missing ids are dropped
+    osm_ids = np.asarray(osm_ids, dtype=np.int64)
+    if len(ids) == 0:
+        return np.empty(0, dtype=np.int32)
+    indices = np.minimum(np.searchsorted(ids, osm_ids), len(ids) - 1)
+    return indices[ids[indices] == osm_ids].astype(np.int32)
+
+
+class Graph():
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        # sorted osm ids, the index in these arrays is the dense id
+        self.waterway_ids = arrays["waterway_ids"]
+        self.node_ids = arrays["node_ids"]
+        self.river_ids = arrays["river_ids"]
+        # waterway -> [start_node, intersection_node_1, ..., end_node]
+        self.ww_node_ptr = arrays["ww_node_ptr"]
+        self.ww_node_idx = arrays["ww_node_idx"]
+        # node -> waterways the node is present in
+        self.node_ww_ptr = arrays["node_ww_ptr"]
+        self.node_ww_idx = arrays["node_ww_idx"]
+        self.start_node = arrays["start_node"]
+        self.end_node = arrays["end_node"]
+        # waterway -> river (-1 if the waterway is not part of a river relation)
+        self.ww_river = arrays["ww_river"]
+        # river -> member waterways
+        self.river_ww_ptr = arrays["river_ww_ptr"]
+        self.river_ww_idx = arrays["river_ww_idx"]
+        # local confluences are stored as [start, end) ranges of labels, a label is the
+        # position of a waterway in the pre-order dfs of the upstream tree (see upstream_tree_labels),
+        # so the tributaries of a waterway get consecutive labels
+        # waterway -> label, label -> waterway (None until calculated)
+        self.lc_label = arrays.get("lc_label")
+        self.lc_order = arrays.get("lc_order")
+        # river -> label ranges (empty row if not calculated), river_lc_ranges has shape (n, 2)
+        self.river_lc_ptr = arrays["river_lc_ptr"]
+        self.river_lc_ranges = arrays["river_lc_ranges"]
+        # waterway -> global confluence id (None until calculated)
+        self.ww_confluence = arrays.get("ww_confluence")
+        # waterway -> only downstream successor, -1 if none, -2 if split (None until calculated)
+        self.down_next = arrays.get("down_next")
+        # waterway -> downstream successors of splits and braids
+        self.down_split_ptr = arrays.get("down_split_ptr")
+        self.down_split_idx = arrays.get("down_split_idx")
+
+
+    @staticmethod
+    def _index(ids, osm_id):
+        i = int(np.searchsorted(ids, osm_id))
+        if i < len(ids) and ids[i] == osm_id:
+            return i
+        return -1
+
+
+    def waterway_index(self, waterway_id):
+        return self._index(self.waterway_ids, waterway_id)
+
+
+    def node_index(self, node_id):
+        return self._index(self.node_ids, node_id)
+
+
+    def river_index(self, river_id):
+        return self._index(self.river_ids, river_id)
+
+
+    def waterway_nodes(self, waterway):
+        return self.ww_node_idx[self.ww_node_ptr[waterway]:self.ww_node_ptr[waterway + 1]].tolist()
+
+
+    def node_waterways(self, node):
+        return self.node_ww_idx[self.node_ww_ptr[node]:self.node_ww_ptr[node + 1]].tolist()
+
+
+    def river_waterways(self, river):
+        return self.river_ww_idx[self.river_ww_ptr[river]:self.river_ww_ptr[river + 1]].tolist()
+
+
+    def river_local_confluence_ranges(self, river):
+        # None if the local confluence of the river was not calculated
+        start, end = self.river_lc_ptr[river], self.river_lc_ptr[river + 1]
+        if start == end:
+            return None
+        return self.river_lc_ranges[start:end]
+
+
+    def river_local_confluence(self, river):
+        ranges = self.river_local_confluence_ranges(river)
+        if ranges is None:
+            return None
+        return self.ranges_to_waterways(ranges).tolist()
+
+
+    def ranges_to_waterways(self, ranges):
+        if len(ranges) == 1:
+            return self.lc_order[ranges[0][0]:ranges[0][1]]
+        return np.concatenate([self.lc_order[start:end] for start, end in ranges])
+
+
+    def waterways_to_ranges(self, waterways):
+        # compresses a set of waterway indices into sorted [start, end) label ranges
+        labels = np.sort(self.lc_label[np.fromiter(waterways, dtype=np.int64)])
+        breaks = np.flatnonzero(np.diff(labels) != 1)
+        starts = labels[np.concatenate(([0], breaks + 1))]
+        ends = labels[np.concatenate((breaks, [len(labels) - 1]))] + 1
+        return np.stack([starts, ends], axis=1).astype(np.int32)
+
+
+    def down_splits(self, waterway):
+        return self.down_split_idx[self.down_split_ptr[waterway]:self.down_split_ptr[waterway + 1]].tolist()
+
+
+    def to_osm_ids(self, waterways):
+        return self.waterway_ids[np.fromiter(waterways, dtype=np.int64)].tolist()
+
+
+    def waterway_indices(self, osm_ids):
+        # waterways that are not in the graph are dropped
+        return _indices(self.waterway_ids, osm_ids)
+
+
+    def set_confluences(self, labels):
+        self.ww_confluence = self.arrays["ww_confluence"] = labels
+
+
+    def set_downstream_index(self, down_next, split_ptr, split_idx):
+        self.down_next = self.arrays["down_next"] = down_next
+        self.down_split_ptr = self.arrays["down_split_ptr"] = split_ptr
+        self.down_split_idx = self.arrays["down_split_idx"] = split_idx
+
+
+    def set_local_confluences(self, lc_label, lc_order, river_ranges):
+        # river_ranges: dict(river index -> label ranges)
+        self.lc_label = self.arrays["lc_label"] = lc_label
+        self.lc_order = self.arrays["lc_order"] = lc_order
+        counts = np.zeros(len(self.river_ids) + 1, dtype=np.int64)
+        for river, ranges in river_ranges.items():
+            counts[river + 1] = len(ranges)
+        river_lc_ptr = np.cumsum(counts)
+        river_lc_ranges = np.empty((river_lc_ptr[-1], 2), dtype=np.int32)
+        for river, ranges in river_ranges.items():
+            river_lc_ranges[river_lc_ptr[river]:river_lc_ptr[river + 1]] = ranges
+        self.river_lc_ptr = self.arrays["river_lc_ptr"] = river_lc_ptr
+        self.river_lc_ranges = self.arrays["river_lc_ranges"] = river_lc_ranges
+
+
+    @classmethod
+    def build(cls, waterway_to_nodes, waterway_to_river, river_to_waterways):
+        waterway_ids = np.array(sorted(waterway_to_nodes.keys()), dtype=np.int64)
+        node_ids = set()
+        for _, nodes in waterway_to_nodes.items():
+            node_ids.update(nodes)
+        node_ids = np.array(sorted(node_ids), dtype=np.int64)
+
+        # waterway -> nodes
+        ww_node_ptr, ww_node_idx = _csr(
+            ((int(np.searchsorted(waterway_ids, ww)), np.searchsorted(node_ids, nodes))
+             for ww, nodes in waterway_to_nodes.items()),
+            len(waterway_ids))
+        start_node = ww_node_idx[ww_node_ptr[:-1]]
+        end_node = ww_node_idx[ww_node_ptr[1:] - 1]
+
+        # node -> waterways, inverted from waterway -> nodes
+        waterway_of_entry = np.repeat(np.arange(len(waterway_ids), dtype=np.int32), np.diff(ww_node_ptr))
+        pairs = np.unique(np.stack([ww_node_idx.astype(np.int64), waterway_of_entry]), axis=1)
+        node_ww_ptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.add.at(node_ww_ptr, pairs[0] + 1, 1)
+        node_ww_ptr = np.cumsum(node_ww_ptr)
+        node_ww_idx = pairs[1].astype(np.int32)
+
+        # rivers
+        river_ids = np.array(sorted(river_to_waterways.keys()), dtype=np.int64)
+        river_ww_ptr, river_ww_idx = _csr(
+            ((int(np.searchsorted(river_ids, river)), _indices(waterway_ids, members))
+             for river, members in river_to_waterways.items() if members),
+            len(river_ids))
+        ww_river = np.full(len(waterway_ids), -1, dtype=np.int32)
+        for ww, river in waterway_to_river.items():
+            ww_index = cls._index(waterway_ids, ww)
+            river_index = cls._index(river_ids, river)
+            if ww_index >= 0 and river_index >= 0:
+                ww_river[ww_index] = river_index
+
+        # filled in by set_local_confluences
+        river_lc_ptr = np.zeros(len(river_ids) + 1, dtype=np.int64)
+        river_lc_ranges = np.empty((0, 2), dtype=np.int32)
+
+        return cls({
+            "waterway_ids": waterway_ids,
+            "node_ids": node_ids,
+            "river_ids": river_ids,
+            "ww_node_ptr": ww_node_ptr,
+            "ww_node_idx": ww_node_idx,
+            "node_ww_ptr": node_ww_ptr,
+            "node_ww_idx": node_ww_idx,
+            "start_node": start_node,
+            "end_node": end_node,
+            "ww_river": ww_river,
+            "river_ww_ptr": river_ww_ptr,
+            "river_ww_idx": river_ww_idx,
+            "river_lc_ptr": river_lc_ptr,
+            "river_lc_ranges": river_lc_ranges,
+        })
+
+
+    @staticmethod
+    def exists(folder):
+        return os.path.isfile(os.path.join(folder, GRAPH_FILE))
+
+
+    def save(self, folder):
+        save_arrays(os.path.join(folder, GRAPH_FILE), self.arrays)
+
+
+    @classmethod
+    def load(cls, folder):
+        return cls(load_arrays(os.path.join(folder, GRAPH_FILE)))
+
+
+def save_arrays(path, arrays, magic=SNAPSHOT_MAGIC):
+    # arrays: dict(name -> numpy array with at most 2 dimensions), written in the snapshot layout
+    names = sorted(arrays)
+    arrays = [np.ascontiguousarray(arrays[name]).astype(arrays[name].dtype.newbyteorder("<"), copy=False)
+              for name in names]
+    offset = SNAPSHOT_HEADER.size + SNAPSHOT_ENTRY.size * len(names)
+    entries = []
+    for name, array in zip(names, arrays):
+        offset += -offset % ALIGNMENT
+        shape = tuple(array.shape) + (0,) * (2 - array.ndim)
+        entries.append(SNAPSHOT_ENTRY.pack(name.encode(), array.dtype.str.encode(), *shape, offset, array.nbytes))
+        offset += array.nbytes
+    # written next to the old file and swapped, running servers keep their mapping
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(SNAPSHOT_HEADER.pack(magic, SNAPSHOT_VERSION, len(names)))
+        for entry in entries:
+            file.write(entry)
+        for array in arrays:
+            file.write(b"\0" * (-file.tell() % ALIGNMENT))
+            file.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_arrays(path, magic=SNAPSHOT_MAGIC):
+    # the arrays are read-only views of the memory mapped file
+    with open(path, "rb") as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    file_magic, version, num_arrays = SNAPSHOT_HEADER.unpack_from(buffer, 0)
+    if file_magic != magic or version != SNAPSHOT_VERSION:
+        raise ValueError(f"{os.path.basename(path)} is not a {magic.decode()} file of version {SNAPSHOT_VERSION}")
+    arrays = {}
+    for i in range(num_arrays):
+        name, dtype, rows, columns, offset, nbytes = SNAPSHOT_ENTRY.unpack_from(
+            buffer, SNAPSHOT_HEADER.size + i * SNAPSHOT_ENTRY.size)
+        dtype = np.dtype(dtype.rstrip(b"\0").decode())
+        shape = (rows, columns) if columns else (rows,)
+        arrays[name.rstrip(b"\0").decode()] = np.frombuffer(
+            buffer, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset).reshape(shape)
+    return arrays
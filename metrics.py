@@ -0,0 +1,315 @@
+import time
+import bisect
+import threading
+from threading import Lock
+
+# Server metrics in the Prometheus text format (version 0.0.4), without the client library.
+# Nothing in here is created unless the config enables "metrics" (see server.py), so a
+# server without metrics does not pay for any of it.
+#
+# Counters and histograms are updated by the requests, everything that is counted anyway
+# (lru_cache info, the tile cache, dbdict stats) is only read when /metrics is scraped.
+# Every server worker keeps its own metrics.
+
+# starlette adds the charset to text responses
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# waterways, nodes or table lookups of a traversal
+SIZE_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Histogram():
+    # cumulative buckets are only summed up when scraped
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = "histogram"
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # key=tuple(label values), value=[count per bucket (last one is +Inf), sum]
+        self.values = dict()
+        self._lock = Lock()
+
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][index] += 1
+            counts[1] += value
+
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts), total) for label_values, (counts, total) in self.values.items()]
+        for label_values, counts, total in values:
+            labels = tuple(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (("le", format_value(float(bound))),), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Collected():
+    # a metric whose samples are read from somewhere else when scraped
+    # collect returns [(labels, value), ...], labels is a tuple of (label name, label value) pairs
+
+    def __init__(self, name, help, type, collect):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.collect = collect
+
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, labels, value
+
+
+class Registry():
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, label_names, buckets))
+
+
+    def collected(self, name, help, type, collect):
+        return self.add(Collected(name, help, type, collect))
+
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class LookupCounter(threading.local):
+    # table lookups of the traversal running in the current thread
+    count = 0
+
+
+class CountingTable():
+    # dbdict proxy for the traversals on the tables, counts their lookups per thread
+
+    def __init__(self, table, counter):
+        self.table = table
+        self.counter = counter
+
+
+    def __contains__(self, key):
+        self.counter.count += 1
+        return key in self.table
+
+
+    def __getitem__(self, key):
+        self.counter.count += 1
+        return self.table[key]
+
+
+    def get(self, key, default=None):
+        self.counter.count += 1
+        return self.table.get(key, default)
+
+
+    def fast_get(self, key):
+        self.counter.count += 1
+        return self.table.fast_get(key)
+
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+
+class RouteLatencyMiddleware():
+    # ASGI middleware timing every http request until its last body chunk is sent,
+    # so streamed responses are measured as a whole. Requests are labeled with the
+    # path template of their route (e.g. /downstream/{waterway_id})
+
+    def __init__(self, app, histogram, routes):
+        self.app = app
+        self.histogram = histogram
+        # key=endpoint function, value=path template
+        self.routes = routes
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_measured(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                self.observe(scope, status[0], start)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        except Exception:
+            self.observe(scope, 500, start)
+            raise
+
+
+    def observe(self, scope, status, start):
+        # the router adds the endpoint of the matched route to the scope
+        route = self.routes.get(scope.get("endpoint"), "unmatched")
+        self.histogram.observe(time.perf_counter() - start, route, scope["method"], str(status))
+
+
+class ServerMetrics():
+    # all the metrics of the server, see server.py for what is registered
+
+    def __init__(self):
+        self.registry = Registry()
+        self.request_seconds = self.registry.histogram(
+            "rivers_request_duration_seconds", "Time until the whole response was sent.", ("route", "method", "status"))
+        self.traversal_seconds = self.registry.histogram(
+            "rivers_traversal_duration_seconds", "Time of a downstream or local confluence traversal.", ("kind",))
+        self.traversal_waterways = self.registry.histogram(
+            "rivers_traversal_waterways", "Waterways visited by a traversal.", ("kind",), SIZE_BUCKETS)
+        self.traversal_nodes = self.registry.histogram(
+            "rivers_traversal_nodes", "Nodes of the waterways visited by a traversal on the graph.", ("kind",),
+            SIZE_BUCKETS)
+        self.traversal_lookups = self.registry.histogram(
+            "rivers_traversal_table_lookups", "Table lookups of a traversal on the .sqlite files.", ("kind",),
+            SIZE_BUCKETS)
+        self.lookups = LookupCounter()
+
+
+    def render(self):
+        return self.registry.render()
+
+
+    def instrument_app(self, app):
+        routes = {route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")}
+        app.add_middleware(RouteLatencyMiddleware, histogram=self.request_seconds, routes=routes)
+
+
+    def counting_table(self, table):
+        return CountingTable(table, self.lookups)
+
+
+    def traversal(self, kind, function, graph=None):
+        # wraps function(waterway_id) -> list(waterway ids)
+        def instrumented(waterway_id):
+            lookups = self.lookups.count
+            start = time.perf_counter()
+            waterway_ids = function(waterway_id)
+            self.traversal_seconds.observe(time.perf_counter() - start, kind)
+            self.observe_traversal(kind, waterway_ids, graph)
+            if self.lookups.count != lookups:
+                self.traversal_lookups.observe(self.lookups.count - lookups, kind)
+            return waterway_ids
+        return instrumented
+
+
+    def observe_traversal(self, kind, waterway_ids, graph=None):
+        self.traversal_waterways.observe(len(waterway_ids), kind)
+        if graph is not None and len(waterway_ids):
+            waterways = graph.waterway_indices(waterway_ids)
+            self.traversal_nodes.observe(int((graph.ww_node_ptr[waterways + 1] - graph.ww_node_ptr[waterways]).sum()),
+                                         kind)
+
+
+    def collect_lru_caches(self, functions):
+        # functions: key=name, value=function decorated with functools.lru_cache
+        # every miss adds an entry, so a full cache evicted all the misses it can not hold
+        def info(field):
+            def collect():
+                for name, function in functions.items():
+                    cache_info = function.cache_info()
+                    values = {"hits": cache_info.hits, "misses": cache_info.misses,
+                              "evictions": max(0, cache_info.misses - cache_info.currsize),
+                              "entries": cache_info.currsize}
+                    yield (("cache", name),), values[field]
+            return collect
+        for field in ("hits", "misses", "evictions"):
+            self.registry.collected(f"rivers_function_cache_{field}_total", f"Cache {field} of the cached functions.",
+                                    "counter", info(field))
+        self.registry.collected("rivers_function_cache_entries", "Entries of the cached functions.", "gauge",
+                                info("entries"))
+
+
+    def collect_lru_cache(self, name, stats):
+        # stats: returns the stats of a cache.LRUCache
+        def info(field):
+            return lambda: [((), stats()[field])]
+        for field in ("hits", "misses", "evictions"):
+            self.registry.collected(f"rivers_{name}_cache_{field}_total", f"{field.capitalize()} of the {name} cache.",
+                                    "counter", info(field))
+        self.registry.collected(f"rivers_{name}_cache_bytes", f"Size of the {name} cache.", "gauge", info("bytes"))
+
+
+    def collect_traversal_pool(self, stats):
+        # stats: returns the stats of a pool.TraversalPool
+        def info(field):
+            return lambda: [((), stats()[field])]
+        self.registry.collected("rivers_traversals_submitted_total", "Runs submitted to the traversal pool.", "counter",
+                                info("submitted"))
+        self.registry.collected("rivers_traversals_coalesced_total", "Queries that waited for an identical run.",
+                                "counter", info("coalesced"))
+        self.registry.collected("rivers_traversal_timeouts_total", "Queries that timed out waiting for their run.",
+                                "counter", info("timeouts"))
+        self.registry.collected("rivers_traversals_rejected_total", "Queries rejected because the pool was full.",
+                                "counter", info("rejected"))
+        self.registry.collected("rivers_traversals_pending", "Runs queued or running on the traversal pool.", "gauge",
+                                info("pending"))
+        self.registry.collected("rivers_traversals_in_flight", "Distinct queries running or queued on the pool.",
+                                "gauge", info("in_flight"))
+
+
+    def collect_tables(self, tables):
+        # tables: key=name, value=dbdict
+        def stat(read):
+            return lambda: [((("table", name),), read(table.stats())) for name, table in tables.items()]
+        self.registry.collected("rivers_table_queries_total", "SQLite queries of the tables.", "counter",
+                                stat(lambda stats: stats["queries"]))
+        self.registry.collected("rivers_table_query_seconds_total", "Time spent in the SQLite queries of the tables.",
+                                "counter", stat(lambda stats: stats["query_seconds"]))
+        self.registry.collected("rivers_table_bloom_negatives_total", "Lookups answered by the bloom filter.",
+                                "counter", stat(lambda stats: stats["bloom_negatives"]))
+        self.registry.collected("rivers_table_cache_hits_total", "Read cache hits of the tables.", "counter",
+                                stat(lambda stats: stats["cache"]["hits"]))
+        self.registry.collected("rivers_table_cache_misses_total", "Read cache misses of the tables.", "counter",
+                                stat(lambda stats: stats["cache"]["misses"]))
+        self.registry.collected("rivers_table_cache_evictions_total", "Read cache evictions of the tables.", "counter",
+                                stat(lambda stats: stats["cache"]["evictions"]))
@@ -0,0 +1,329 @@
+import os, os.path
+import sys
+import gzip
+import json
+import mmap
+import struct
+import sqlite3
+import hashlib
+import tempfile
+from array import array
+import numpy as np
+from value_codecs import encode_varints, decode_varints
+from cache import LRUCache
+from tiles import make_etag
+
+# PMTiles version 3 archives (https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md):
+# a single file holding a header, the directories and the tile data, so the same file can be
+# served by the server or put behind any static server that answers range requests.
+#
+# Tiles are addressed by a tile id: the position of (z, x, y) on the Hilbert curve of its zoom
+# level plus the number of tiles of all the lower zoom levels. A directory is a sorted list of
+# entries (tile_id, offset, length, run_length), an entry with a run length of 0 points to a
+# leaf directory. Runs of equal tiles (e.g. the ocean) are stored as a single entry.
+#
+# The reader memory maps the archive, a tile is a slice of the map without a copy and no
+# SQLite is involved. Decoded leaf directories are cached.
+
+MAGIC = b"PMTiles"
+VERSION = 3
+# magic, version, root directory offset/length, metadata offset/length, leaf directories offset/length,
+# tile data offset/length, addressed tiles, tile entries, tile contents, clustered, internal compression,
+# tile compression, tile type, min zoom, max zoom, min lon/lat, max lon/lat (e7), center zoom, center lon/lat (e7)
+HEADER = struct.Struct("<7sBQQQQQQQQQQQBBBBBBiiiiBii")
+# the header and the root directory have to fit into the first 16 KiB
+ROOT_SIZE = 16384 - HEADER.size
+LEAF_SIZE = 4096
+# directories are followed at most this deep
+MAX_DEPTH = 3
+
+COMPRESSION_UNKNOWN, COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_BROTLI, COMPRESSION_ZSTD = range(5)
+# Content-Encoding of the tiles
+ENCODINGS = {COMPRESSION_NONE: "identity", COMPRESSION_GZIP: "gzip", COMPRESSION_BROTLI: "br",
+             COMPRESSION_ZSTD: "zstd"}
+TILE_TYPE_MVT = 1
+# the directories are not compressed, so the reader decodes them straight from the map
+INTERNAL_COMPRESSION = COMPRESSION_NONE
+COORDINATE_PRECISION = 10000000
+
+
+def zxy_to_tile_id(z, x, y):
+    # y in the XYZ scheme (0 at the top), not TMS
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    n = 1 << z
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+
+def serialize_directory(tile_ids, offsets, lengths, run_lengths):
+    # numbers of entries, tile id deltas, run lengths, lengths, offsets (0 if right after the previous entry)
+    values = [len(tile_ids)]
+    previous = 0
+    for tile_id in tile_ids:
+        values.append(tile_id - previous)
+        previous = tile_id
+    values.extend(run_lengths)
+    values.extend(lengths)
+    for i, offset in enumerate(offsets):
+        if i > 0 and offset == offsets[i - 1] + lengths[i - 1]:
+            values.append(0)
+        else:
+            values.append(offset + 1)
+    return encode_varints(values)
+
+
+def deserialize_directory(data):
+    # returns the entries as numpy arrays (tile_ids, offsets, lengths, run_lengths)
+    values = decode_varints(data)
+    count = values[0]
+    tile_ids = np.cumsum(np.array(values[1:1 + count], dtype=np.int64))
+    run_lengths = np.array(values[1 + count:1 + 2 * count], dtype=np.int64)
+    lengths = np.array(values[1 + 2 * count:1 + 3 * count], dtype=np.int64)
+    offsets = values[1 + 3 * count:1 + 4 * count]
+    for i in range(count):
+        offsets[i] = offsets[i - 1] + values[2 * count + i] if offsets[i] == 0 and i > 0 else offsets[i] - 1
+    return tile_ids, np.array(offsets, dtype=np.int64), lengths, run_lengths
+
+
+def find_entry(directory, tile_id):
+    # index of the entry of tile_id, or of the leaf directory that can contain it, -1 if missing
+    tile_ids, _, _, run_lengths = directory
+    index = int(np.searchsorted(tile_ids, tile_id, side="right")) - 1
+    if index < 0:
+        return -1
+    if tile_ids[index] == tile_id or run_lengths[index] == 0:
+        return index
+    if tile_id - tile_ids[index] < run_lengths[index]:
+        return index
+    return -1
+
+
+def compress(data, compression):
+    if compression == COMPRESSION_GZIP:
+        return gzip.compress(data)
+    return data
+
+
+def decompress(data, compression):
+    if compression == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    if compression == COMPRESSION_NONE:
+        return data
+    raise ValueError(f"Directories with compression {compression} are not supported")
+
+
+class PMTilesReader():
+    # same interface as tiles.TileReader, every tile has the single encoding of the archive
+
+    def __init__(self, pmtiles_path, cache_bytes):
+        with open(pmtiles_path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buffer)
+        header = HEADER.unpack_from(self.buffer, 0)
+        if header[0] != MAGIC or header[1] != VERSION:
+            raise ValueError(f"{pmtiles_path} is not a PMTiles archive of version {VERSION}")
+        (_, _, self.root_offset, self.root_length, self.metadata_offset, self.metadata_length,
+         self.leaves_offset, self.leaves_length, self.data_offset, self.data_length, *_) = header
+        self.internal_compression = header[14]
+        self.tile_compression = header[15]
+        self.min_zoom, self.max_zoom = header[17], header[18]
+        self.encodings = [ENCODINGS.get(self.tile_compression, "gzip")]
+        self.root = deserialize_directory(self._directory_bytes(self.root_offset, self.root_length))
+        # values are decoded leaf directories and etags
+        self.cache = LRUCache(cache_bytes, sizeof=self._sizeof)
+
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, tuple):
+            return sum(entries.nbytes for entries in value)
+        return len(value) + 64
+
+
+    def _directory_bytes(self, offset, length):
+        return decompress(self.buffer[offset:offset + length], self.internal_compression)
+
+
+    def _leaf(self, offset, length):
+        key = ("leaf", offset)
+        directory = self.cache.get(key)
+        if directory is None:
+            directory = deserialize_directory(self._directory_bytes(self.leaves_offset + offset, length))
+            self.cache.put(key, directory)
+        return directory
+
+
+    def metadata(self):
+        return json.loads(self._directory_bytes(self.metadata_offset, self.metadata_length))
+
+
+    def find(self, z, x, y):
+        # (offset, length) of the tile data in the archive, y in the XYZ scheme, None for missing tiles
+        if z < self.min_zoom or z > self.max_zoom:
+            return None
+        tile_id = zxy_to_tile_id(z, x, y)
+        directory = self.root
+        for _ in range(MAX_DEPTH + 1):
+            index = find_entry(directory, tile_id)
+            if index < 0:
+                return None
+            _, offsets, lengths, run_lengths = directory
+            if run_lengths[index] > 0:
+                return self.data_offset + int(offsets[index]), int(lengths[index])
+            directory = self._leaf(int(offsets[index]), int(lengths[index]))
+        return None
+
+
+    def read_tile(self, z, x, y, accepted=("gzip",)):
+        # y is in the TMS scheme like for the mbtiles (see TileReader.read_tile)
+        # returns (tile_data, etag, encoding), tile_data is a memoryview of the archive
+        if y < 0 or y >= 1 << z:
+            return None
+        location = self.find(z, x, (1 << z) - 1 - y)
+        if location is None:
+            return None
+        offset, length = location
+        tile_data = self.view[offset:offset + length]
+        # deduplicated tiles share their data, so the etag only depends on the location
+        key = ("etag", offset, length)
+        etag = self.cache.get(key)
+        if etag is None:
+            etag = make_etag(hashlib.blake2b(tile_data, digest_size=16).hexdigest(), self.encodings[0])
+            self.cache.put(key, etag)
+        return tile_data, etag, self.encodings[0]
+
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def build_directories(tile_ids, offsets, lengths, run_lengths):
+    # (root directory, leaf directories), leaves are added until the root fits into ROOT_SIZE
+    root = compress(serialize_directory(tile_ids, offsets, lengths, run_lengths), INTERNAL_COMPRESSION)
+    if len(root) <= ROOT_SIZE:
+        return root, b""
+    leaf_size = LEAF_SIZE
+    while True:
+        leaves = bytearray()
+        root_entries = ([], [], [], [])
+        for start in range(0, len(tile_ids), leaf_size):
+            end = start + leaf_size
+            leaf = compress(serialize_directory(tile_ids[start:end], offsets[start:end], lengths[start:end],
+                                                run_lengths[start:end]), INTERNAL_COMPRESSION)
+            for values, value in zip(root_entries, (tile_ids[start], len(leaves), len(leaf), 0)):
+                values.append(value)
+            leaves += leaf
+        root = compress(serialize_directory(*root_entries), INTERNAL_COMPRESSION)
+        if len(root) <= ROOT_SIZE:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def mbtiles_metadata(con):
+    # the metadata table of the mbtiles, the json field (vector_layers) is merged into it
+    metadata = dict()
+    for name, value in con.execute("select name, value from metadata"):
+        if name == "json":
+            metadata.update(json.loads(value))
+        else:
+            metadata[name] = value
+    return metadata
+
+
+def convert(mbtiles_path, pmtiles_path):
+    # tiles in the order of their tile ids (clustered), equal tiles are stored once and
+    # consecutive equal tiles become a single entry
+    source = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    metadata = mbtiles_metadata(source)
+
+    # rowids sorted by tile id, the tile data is read in this order
+    rowids = array("q")
+    keys = array("q")
+    min_zoom, max_zoom = None, 0
+    for rowid, z, x, y in source.execute("select rowid, zoom_level, tile_column, tile_row from tiles"):
+        rowids.append(rowid)
+        keys.append(zxy_to_tile_id(z, x, (1 << z) - 1 - y))
+        min_zoom = z if min_zoom is None else min(min_zoom, z)
+        max_zoom = max(max_zoom, z)
+    min_zoom = min_zoom or 0
+    order = np.argsort(np.frombuffer(keys, dtype=np.int64), kind="stable")
+    rowids = np.frombuffer(rowids, dtype=np.int64)[order].tolist()
+    keys = np.frombuffer(keys, dtype=np.int64)[order].tolist()
+    del order
+
+    tile_ids, offsets, lengths, run_lengths = [], [], [], []
+    # key=content hash, value=offset of the data
+    contents = dict()
+    data_length = 0
+    addressed = 0
+    data_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(pmtiles_path)))
+    compression = None
+    for i, (rowid, tile_id) in enumerate(zip(rowids, keys)):
+        tile_data = source.execute("select tile_data from tiles where rowid=?", (rowid,)).fetchone()[0]
+        if compression is None:
+            compression = COMPRESSION_GZIP if tile_data[:2] == b"\x1f\x8b" else COMPRESSION_NONE
+        content_hash = hashlib.blake2b(tile_data, digest_size=16).digest()
+        offset = contents.get(content_hash)
+        if offset is None:
+            offset = contents[content_hash] = data_length
+            data_file.write(tile_data)
+            data_length += len(tile_data)
+        addressed += 1
+        # the same tile as the previous tile id: the run gets longer
+        if tile_ids and offsets[-1] == offset and tile_ids[-1] + run_lengths[-1] == tile_id:
+            run_lengths[-1] += 1
+        else:
+            tile_ids.append(tile_id)
+            offsets.append(offset)
+            lengths.append(len(tile_data))
+            run_lengths.append(1)
+        if (i + 1) % 100000 == 0:
+            print(f" Processed: {i + 1}", end="\r")
+    source.close()
+
+    root, leaves = build_directories(tile_ids, offsets, lengths, run_lengths)
+    metadata_bytes = compress(json.dumps(metadata).encode(), INTERNAL_COMPRESSION)
+    bounds = [float(value) for value in metadata.get("bounds", "-180,-85.05112878,180,85.05112878").split(",")]
+    center = [float(value) for value in metadata.get("center", f"0,0,{min_zoom}").split(",")]
+    root_offset = HEADER.size
+    metadata_offset = root_offset + len(root)
+    leaves_offset = metadata_offset + len(metadata_bytes)
+    data_offset = leaves_offset + len(leaves)
+    header = HEADER.pack(
+        MAGIC, VERSION, root_offset, len(root), metadata_offset, len(metadata_bytes), leaves_offset, len(leaves),
+        data_offset, data_length, addressed, len(tile_ids), len(contents),
+        1, INTERNAL_COMPRESSION, compression or COMPRESSION_GZIP, TILE_TYPE_MVT, min_zoom, max_zoom,
+        *(round(value * COORDINATE_PRECISION) for value in bounds),
+        int(center[2]), round(center[0] * COORDINATE_PRECISION), round(center[1] * COORDINATE_PRECISION))
+
+    tmp_path = pmtiles_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        for part in (header, root, metadata_bytes, leaves):
+            file.write(part)
+        data_file.seek(0)
+        while True:
+            chunk = data_file.read(1 << 24)
+            if not chunk:
+                break
+            file.write(chunk)
+    data_file.close()
+    os.replace(tmp_path, pmtiles_path)
+    print(f"{addressed} tiles, {len(tile_ids)} entries, {len(contents)} distinct tiles written to {pmtiles_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python pmtiles.py <mbtiles_path> <pmtiles_path>")
+        exit(0)
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,127 @@
+import asyncio
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded thread pool for the expensive queries of the server (traversals, geojson, batches).
+#
+# The route handlers that use it are async, they wait for the pool on the event loop instead
+# of holding one of the threads that run the sync handlers, so the tiles are still served
+# while a big river is traversed. Concurrent calls with the same key share a single run
+# (single flight): the first one submits it, the others wait for the same future.
+#
+# A request that waits longer than the timeout gets an error, the run itself can not be
+# interrupted and finishes in the background, its result still fills the caches. The runs
+# that are queued or running are bounded too, new ones are rejected while the pool is full,
+# so an overloaded worker answers quickly instead of queueing work nobody waits for anymore.
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PoolFull(Exception):
+    pass
+
+
+class TraversalPool():
+
+    def __init__(self, threads, timeout, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="traversal")
+        self.threads = threads
+        # runs that are queued or running at most, including the ones of the threads
+        self.max_pending = max_pending
+        self.pending = 0
+        # seconds a request waits for its result, None waits forever
+        self.timeout = timeout
+        # key=query key, value=concurrent.futures.Future of the run
+        self._running = dict()
+        self._lock = Lock()
+        self.submitted = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+
+    def submit(self, key, function, *args):
+        # future of function(*args), shared with the calls of the same key that are not finished yet,
+        # a key of None is never shared, raises PoolFull if max_pending runs are not finished yet
+        with self._lock:
+            future = self._running.get(key) if key is not None else None
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PoolFull()
+            future = self.executor.submit(function, *args)
+            self.submitted += 1
+            self.pending += 1
+            if key is not None:
+                self._running[key] = future
+        future.add_done_callback(lambda done: self._finished(key, done))
+        return future
+
+
+    def _finished(self, key, future):
+        with self._lock:
+            self.pending -= 1
+            if key is not None and self._running.get(key) is future:
+                del self._running[key]
+
+
+    async def run(self, key, function, *args):
+        # result of function(*args), raises PoolTimeout after self.timeout seconds and PoolFull
+        # if the pool is full
+        # shielded: a request that gives up does not cancel the run the others are waiting for
+        future = asyncio.shield(asyncio.wrap_future(self.submit(key, function, *args)))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout()
+
+
+    async def iterate(self, items):
+        # async iterator over the items of a (slow) iterator, every next() runs on the pool,
+        # raises PoolFull if the pool is full and PoolTimeout once the whole iteration took
+        # longer than self.timeout
+        # the iteration holds a single pending slot until it is finished or closed
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PoolFull()
+            self.submitted += 1
+            self.pending += 1
+        loop = asyncio.get_running_loop()
+        deadline = None if self.timeout is None else loop.time() + self.timeout
+        finished = object()
+        try:
+            while True:
+                future = asyncio.wrap_future(self.executor.submit(next, items, finished))
+                try:
+                    item = await asyncio.wait_for(future, None if deadline is None else max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise PoolTimeout()
+                if item is finished:
+                    return
+                yield item
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                "threads": self.threads,
+                "in_flight": len(self._running),
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+            }
@@ -1,3 +1,7 @@
+from array import array
+import numpy as np
+
+
 def downstream(river_id, node_to_waterways, waterway_to_nodes):
     if river_id not in waterway_to_nodes:
         return []
@@ -74,7 +78,8 @@ def local_confluence_old(river_id, node_to_waterways, waterway_to_nodes, waterwa
 
 
 def local_confluence(waterway_id, node_to_waterways, waterway_to_nodes, 
-                     waterway_to_river, river_to_waterways, river_to_local_confluence):
+                     waterway_to_river, river_to_waterways, river_to_local_confluence=None):
+    # river_to_local_confluence: precomputed local confluences of rivers (older datasets), optional
     if waterway_id not in waterway_to_nodes:
         return []
     open_waterways = {waterway_id}
@@ -92,7 +97,7 @@ def local_confluence(waterway_id, node_to_waterways, waterway_to_nodes,
         if waterway in waterway_to_river:
             river_id = waterway_to_river.fast_get(waterway)
             # add the whole local confluence if calcualted
-            if river_id in river_to_local_confluence:
+            if river_to_local_confluence is not None and river_id in river_to_local_confluence:
                 for tributary in river_to_local_confluence.fast_get(river_id):
                     if tributary in open_waterways:
                         continue
@@ -144,4 +149,412 @@ def local_confluence(waterway_id, node_to_waterways, waterway_to_nodes,
                 open_waterways.add(adjacent_river)
 
         closed_waterways.add(waterway)
-    return list(closed_waterways)
\ No newline at end of file
+    return list(closed_waterways)
+
+def graph_downstream(waterway_id, graph):
+    # same as downstream, but walks the compact graph (see graph.py)
+    start = graph.waterway_index(waterway_id)
+    if start < 0:
+        return []
+    end_node = graph.end_node
+    open_waterways = {start}
+    closed_waterways = set()
+    while len(open_waterways):
+        river = open_waterways.pop()
+        for node in graph.waterway_nodes(river):
+            for adjacent_river in graph.node_waterways(node):
+                if adjacent_river == river:
+                    continue
+                if adjacent_river in closed_waterways or adjacent_river in open_waterways:
+                    continue
+                # the node in question cannot be the end node of a river
+                if end_node[adjacent_river] == node:
+                    continue
+                open_waterways.add(adjacent_river)
+        closed_waterways.add(river)
+    return graph.to_osm_ids(closed_waterways)
+
+
+def graph_local_confluence(waterway_id, graph):
+    # same as local_confluence, but walks the compact graph (see graph.py)
+    start = graph.waterway_index(waterway_id)
+    if start < 0:
+        return []
+    river = graph.ww_river[start]
+    if river >= 0:
+        ranges = graph.river_local_confluence_ranges(river)
+        # the traversal would only copy the stored local confluence
+        if ranges is not None:
+            return graph.waterway_ids[graph.ranges_to_waterways(ranges)].tolist()
+    return graph.to_osm_ids(local_confluence_indices(start, graph, graph.river_local_confluence))
+
+
+def local_confluence_indices(start, graph, river_local_confluence):
+    # river_local_confluence(river) returns the already calculated local confluence of a river or None
+    start_node = graph.start_node
+    end_node = graph.end_node
+    ww_river = graph.ww_river
+    open_waterways = {start}
+    closed_waterways = set()
+    while len(open_waterways):
+        waterway = open_waterways.pop()
+
+        # if the waterway belongs to a river
+        river = ww_river[waterway]
+        if river >= 0:
+            tributaries = river_local_confluence(river)
+            # add the whole local confluence if calcualted
+            if tributaries is not None:
+                for tributary in tributaries:
+                    if tributary in open_waterways:
+                        continue
+                    closed_waterways.add(tributary)
+                continue
+            # add the whole river
+            for ww in graph.river_waterways(river):
+                if ww == waterway:
+                    continue
+                if ww in open_waterways or ww in closed_waterways:
+                    continue
+                open_waterways.add(ww)
+
+        waterway_end_node = end_node[waterway]
+        for node in graph.waterway_nodes(waterway):
+            for adjacent_river in graph.node_waterways(node):
+                if adjacent_river == waterway:
+                    continue
+                if adjacent_river in closed_waterways or adjacent_river in open_waterways:
+                    continue
+
+                # not end node case
+                if node != waterway_end_node:
+                    # add if the shared node is adjacent_rivers end node
+                    if end_node[adjacent_river] == node:
+                        open_waterways.add(adjacent_river)
+                    continue
+
+                # end node case
+                # skip if it is not the start node of the adjacent waterway
+                if start_node[adjacent_river] != node:
+                    continue
+                # if it is end node of multiple waterways, then skip
+                multiple_end_node = False
+                for ww in graph.node_waterways(node):
+                    if ww == waterway:
+                        continue
+                    if ww in closed_waterways or ww in open_waterways:
+                        continue
+                    if end_node[ww] == node:
+                        multiple_end_node = True
+                        break
+                if multiple_end_node:
+                    continue
+                open_waterways.add(adjacent_river)
+
+        closed_waterways.add(waterway)
+    return closed_waterways
+
+
+def global_confluences(graph):
+    # union-find over the node -> waterways edges and the river relations
+    # returns the confluence id (from 1 upwards) of every waterway index
+    parent = array("i", range(len(graph.waterway_ids)))
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union_rows(ptr, idx):
+        # joins all the waterways within every row of a csr table
+        rows = np.repeat(np.arange(len(ptr) - 1), np.diff(ptr))
+        same_row = rows[1:] == rows[:-1]
+        for a, b in zip(idx[:-1][same_row].tolist(), idx[1:][same_row].tolist()):
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    union_rows(graph.node_ww_ptr, graph.node_ww_idx)
+    # all the waterways of a river belong to the same confluence
+    union_rows(graph.river_ww_ptr, graph.river_ww_idx)
+
+    roots = np.fromiter((find(x) for x in range(len(parent))), dtype=np.int32, count=len(parent))
+    # roots are the smallest index in their set, so numbering them in order gives ids from 1 upwards
+    is_root = roots == np.arange(len(roots))
+    confluence_of_root = np.cumsum(is_root).astype(np.int32)
+    return confluence_of_root[roots]
+
+
+def _successor_pairs(graph, entry_waterway, entry_node):
+    # expands every (waterway, node) entry with the waterways of the node
+    # and keeps the (waterway, adjacent) pairs where adjacent does not end in the node
+    degree = np.diff(graph.node_ww_ptr)[entry_node]
+    pair_waterway = np.repeat(entry_waterway, degree)
+    pair_node = np.repeat(entry_node, degree)
+    offsets = np.arange(len(pair_node)) - np.repeat(np.cumsum(degree) - degree, degree)
+    pair_adjacent = graph.node_ww_idx[graph.node_ww_ptr[pair_node] + offsets].astype(np.int64)
+    keep = (pair_adjacent != pair_waterway) & (graph.end_node[pair_adjacent] != pair_node)
+    return np.stack([pair_waterway[keep], pair_adjacent[keep]])
+
+
+def upstream_tree_parents(graph):
+    # the parent of a waterway is the only waterway it flows into at its end node,
+    # -1 for waterways without a single such parent (roots)
+    num_waterways = len(graph.waterway_ids)
+    pairs = _successor_pairs(graph, np.arange(num_waterways, dtype=np.int64), graph.end_node.astype(np.int64))
+    num_parents = np.bincount(pairs[0], minlength=num_waterways)
+    single = num_parents[pairs[0]] == 1
+    parent = np.full(num_waterways, -1, dtype=np.int64)
+    parent[pairs[0][single]] = pairs[1][single]
+    return parent
+
+
+def upstream_tree_labels(graph, parent=None):
+    # a pre-order dfs of the upstream tree (see upstream_tree_parents) labels every waterway,
+    # so each subtree (a waterway and all its tributaries) is a contiguous label range
+    # returns (lc_label, lc_order), waterway -> label and label -> waterway
+    if parent is None:
+        parent = upstream_tree_parents(graph)
+    num_waterways = len(graph.waterway_ids)
+
+    by_parent = np.argsort(parent, kind="stable")
+    num_roots = int((parent < 0).sum())
+    children_ptr = np.zeros(num_waterways + 1, dtype=np.int64)
+    np.add.at(children_ptr, parent[parent >= 0] + 1, 1)
+    children_ptr = np.cumsum(children_ptr).tolist()
+    children = by_parent[num_roots:].tolist()
+
+    label = [-1] * num_waterways
+    order = []
+
+    def visit(root):
+        stack = [root]
+        while len(stack):
+            waterway = stack.pop()
+            # waterways in cycles are reached more than once
+            if label[waterway] >= 0:
+                continue
+            label[waterway] = len(order)
+            order.append(waterway)
+            stack.extend(reversed(children[children_ptr[waterway]:children_ptr[waterway + 1]]))
+
+    for root in by_parent[:num_roots].tolist():
+        visit(root)
+    # cycles without a root
+    for waterway in range(num_waterways):
+        if label[waterway] < 0:
+            visit(waterway)
+    return np.array(label, dtype=np.int32), np.array(order, dtype=np.int32)
+
+
+def river_levels(graph, parent, lc_order):
+    # groups the river indices by their height in the tree of rivers, a river is a child of the
+    # first river downstream of it in the upstream tree (maybe through waterways without a river)
+    # headwaters are in the first level and every river comes after all the rivers flowing into it,
+    # rivers in cycles are in the last level
+    num_rivers = len(graph.river_ids)
+    ww_river = graph.ww_river.tolist()
+    parent_list = parent.tolist()
+    # first river downstream of every waterway, the waterway itself not counted
+    downstream_river = [-1] * len(parent_list)
+    # pre-order, parents come first
+    for waterway in lc_order.tolist():
+        waterway_parent = parent_list[waterway]
+        if waterway_parent >= 0:
+            river = ww_river[waterway_parent]
+            downstream_river[waterway] = river if river >= 0 else downstream_river[waterway_parent]
+    downstream_river = np.array(downstream_river, dtype=np.int64)
+    rivers = graph.ww_river.astype(np.int64)
+    mask = (rivers >= 0) & (downstream_river >= 0) & (downstream_river != rivers)
+    edges = np.unique(np.stack([rivers[mask], downstream_river[mask]]), axis=1)
+
+    # kahn's algorithm from the headwaters
+    pending = np.bincount(edges[1], minlength=num_rivers)
+    order = np.argsort(edges[0], kind="stable")
+    targets = edges[1][order].tolist()
+    targets_ptr = np.concatenate(([0], np.cumsum(np.bincount(edges[0], minlength=num_rivers)))).tolist()
+    pending = pending.tolist()
+    levels = []
+    level = [river for river in range(num_rivers) if pending[river] == 0]
+    done = 0
+    while len(level):
+        levels.append(level)
+        done += len(level)
+        next_level = []
+        for river in level:
+            for target in targets[targets_ptr[river]:targets_ptr[river + 1]]:
+                pending[target] -= 1
+                if pending[target] == 0:
+                    next_level.append(target)
+        level = sorted(next_level)
+    if done < num_rivers:
+        levels.append([river for river in range(num_rivers) if pending[river] > 0])
+    return levels
+
+
+def downstream_index(graph):
+    # successors of every waterway index: the waterways that share a node with it
+    # and do not end in that node (the same relation downstream walks)
+    # returns (down_next, split_ptr, split_idx), down_next is the only successor,
+    # -1 if there is none and -2 if there are more, which are then stored in the split csr
+    num_waterways = len(graph.waterway_ids)
+    entry_waterway = np.repeat(np.arange(num_waterways, dtype=np.int64), np.diff(graph.ww_node_ptr))
+    pairs = np.unique(_successor_pairs(graph, entry_waterway, graph.ww_node_idx.astype(np.int64)), axis=1)
+
+    num_successors = np.bincount(pairs[0], minlength=num_waterways)
+    down_next = np.full(num_waterways, -1, dtype=np.int32)
+    single = num_successors[pairs[0]] == 1
+    down_next[pairs[0][single]] = pairs[1][single]
+    down_next[num_successors > 1] = -2
+
+    # splits and braids
+    split = ~single
+    split_counts = np.zeros(num_waterways + 1, dtype=np.int64)
+    np.add.at(split_counts, pairs[0][split] + 1, 1)
+    split_ptr = np.cumsum(split_counts)
+    split_idx = pairs[1][split].astype(np.int32)
+    return down_next, split_ptr, split_idx
+
+
+def indexed_downstream(waterway_id, graph):
+    # downstream by following the precomputed successor pointers (see downstream_index)
+    start = graph.waterway_index(waterway_id)
+    if start < 0:
+        return []
+    down_next = graph.down_next
+    open_waterways = [start]
+    closed_waterways = {start}
+    while len(open_waterways):
+        waterway = open_waterways.pop()
+        successor = down_next[waterway]
+        if successor == -1:
+            continue
+        if successor >= 0:
+            successors = (int(successor),)
+        else:
+            successors = graph.down_splits(waterway)
+        for adjacent_river in successors:
+            if adjacent_river in closed_waterways:
+                continue
+            closed_waterways.add(adjacent_river)
+            open_waterways.append(adjacent_river)
+    return graph.to_osm_ids(closed_waterways)
+
+
+def _downstream_successors(graph, waterway):
+    # successors from the downstream index if calculated, otherwise from the adjacency
+    if graph.down_next is not None:
+        successor = graph.down_next[waterway]
+        if successor == -1:
+            return ()
+        if successor >= 0:
+            return (int(successor),)
+        return graph.down_splits(waterway)
+    end_node = graph.end_node
+    successors = []
+    for node in graph.waterway_nodes(waterway):
+        for adjacent_river in graph.node_waterways(node):
+            if adjacent_river != waterway and end_node[adjacent_river] != node:
+                successors.append(adjacent_river)
+    return successors
+
+
+def batch_downstream(waterway_ids, graph):
+    # downstream of several waterways at once, a traversal stops at waterways
+    # whose downstream is already known and reuses their result
+    # returns dict(waterway_id -> list of waterway ids)
+    downstreams = dict()
+    results = dict()
+    for waterway_id in waterway_ids:
+        start = graph.waterway_index(waterway_id)
+        if start < 0:
+            results[waterway_id] = []
+            continue
+        if start not in downstreams:
+            open_waterways = [start]
+            closed_waterways = {start}
+            reused = []
+            while len(open_waterways):
+                waterway = open_waterways.pop()
+                for adjacent_river in _downstream_successors(graph, waterway):
+                    if adjacent_river in closed_waterways:
+                        continue
+                    closed_waterways.add(adjacent_river)
+                    # everything downstream of it is already known
+                    if adjacent_river in downstreams:
+                        reused.append(adjacent_river)
+                        continue
+                    open_waterways.append(adjacent_river)
+            for waterway in reused:
+                closed_waterways |= downstreams[waterway]
+            downstreams[start] = closed_waterways
+        results[waterway_id] = graph.to_osm_ids(downstreams[start])
+    return results
+
+
+def batch_local_confluence(waterway_ids, graph):
+    # local confluence of several waterways at once, waterways of a river with
+    # a calculated local confluence share the result
+    # returns dict(waterway_id -> list of waterway ids)
+    shared = dict()
+    results = dict()
+    for waterway_id in waterway_ids:
+        start = graph.waterway_index(waterway_id)
+        if start < 0:
+            results[waterway_id] = []
+            continue
+        river = int(graph.ww_river[start])
+        if river >= 0 and graph.river_local_confluence_ranges(river) is not None:
+            key = ("river", river)
+        else:
+            key = ("waterway", start)
+        if key not in shared:
+            shared[key] = graph_local_confluence(waterway_id, graph)
+        results[waterway_id] = shared[key]
+    return results
+
+
+def iter_downstream(waterway_id, graph, chunk_size=4096):
+    # yields the downstream in lists of at most chunk_size waterway ids while it is traversed
+    start = graph.waterway_index(waterway_id)
+    if start < 0:
+        return
+    open_waterways = [start]
+    closed_waterways = {start}
+    chunk = [start]
+    while len(open_waterways):
+        waterway = open_waterways.pop()
+        for adjacent_river in _downstream_successors(graph, waterway):
+            if adjacent_river in closed_waterways:
+                continue
+            closed_waterways.add(adjacent_river)
+            open_waterways.append(adjacent_river)
+            chunk.append(adjacent_river)
+            if len(chunk) >= chunk_size:
+                yield graph.to_osm_ids(chunk)
+                chunk = []
+    if len(chunk):
+        yield graph.to_osm_ids(chunk)
+
+
+def iter_local_confluence(waterway_id, graph, chunk_size=4096):
+    # yields the local confluence in lists of at most chunk_size waterway ids
+    start = graph.waterway_index(waterway_id)
+    if start < 0:
+        return
+    river = graph.ww_river[start]
+    ranges = graph.river_local_confluence_ranges(river) if river >= 0 else None
+    if ranges is not None:
+        # stored, read straight from the label ranges
+        for range_start, range_end in ranges.tolist():
+            for chunk_start in range(range_start, range_end, chunk_size):
+                labels = graph.lc_order[chunk_start:min(chunk_start + chunk_size, range_end)]
+                yield graph.waterway_ids[labels].tolist()
+        return
+    waterways = list(local_confluence_indices(start, graph, graph.river_local_confluence))
+    for chunk_start in range(0, len(waterways), chunk_size):
+        yield graph.to_osm_ids(waterways[chunk_start:chunk_start + chunk_size])
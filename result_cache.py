@@ -0,0 +1,220 @@
+import os, os.path
+import time
+import hashlib
+import sqlite3
+from threading import Lock
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Query results of the server on disk, shared by all the workers and kept over restarts.
+#
+# The results are stored in a sqlite file (WAL, so the workers read while one of them
+# writes) under the version of the dataset they were calculated from: a hash of the
+# names, sizes and modification times of the files written by rivers.py. The results of
+# an older dataset are never returned and are deleted when a new one is first served.
+# The least recently used results are deleted when the file grows above its size, the
+# number and the size of all the results are kept in the usage table, updated in the
+# transaction of every insert and delete, so nothing has to scan the results.
+#
+# Every worker also counts the queries it answers and adds the counts to the file from
+# time to time. When a new dataset version is served, the first worker that starts warms
+# the cache up with the most requested queries, the counts are halved every time, so the
+# queries that stopped being popular drop out after a few deploys. The counts are written
+# by a thread of their own, counting a query never waits for the file.
+
+RESULT_CACHE_FILE = "results.sqlite"
+# files of the data folder the dataset version depends on
+VERSION_SUFFIXES = (".sqlite", ".snapshot", ".rtree")
+# seconds between the updates of the last use of a result, the results are not rewritten on every hit
+TOUCH_INTERVAL = 60
+# queries counted before they are written to the file
+HOT_FLUSH_COUNT = 100
+# deleted down to this share of max_bytes once the file is too big
+EVICT_TO = 0.9
+
+
+def dataset_version(folder):
+    digest = hashlib.blake2b(digest_size=8)
+    for name in sorted(os.listdir(folder)):
+        if name == RESULT_CACHE_FILE or not name.endswith(VERSION_SUFFIXES):
+            continue
+        stat = os.stat(os.path.join(folder, name))
+        digest.update(f"{name} {stat.st_size} {stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class ResultCache():
+
+    def __init__(self, path, version, max_bytes):
+        self.path = path
+        self.version = version
+        self.max_bytes = max_bytes
+        # a single connection per worker, used by the threads of the traversal pool
+        self.con = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.execute("create table if not exists results "
+                         "(key text primary key, version text, value blob, size integer, used integer)")
+        self.con.execute("create index if not exists results_used on results (used)")
+        self.con.execute("create table if not exists hot (key text primary key, count integer)")
+        self.con.execute("create table if not exists warmed (version text primary key, time integer)")
+        self.con.execute("create table if not exists usage (name text primary key, value integer)")
+        # summed once when the file is created (or was written by a version without the table)
+        self.con.execute("begin immediate")
+        if self.con.execute("select count(*) from usage").fetchone()[0] == 0:
+            entries, size = self.con.execute("select count(*), total(size) from results").fetchone()
+            self.con.executemany("insert into usage values (?, ?)", [("entries", entries), ("bytes", int(size))])
+        self.con.execute("commit")
+        self._lock = Lock()
+        # queries answered since the counts were last written, with a lock of its own,
+        # the requests count their query on the event loop
+        self._hot = Counter()
+        self._hot_lock = Lock()
+        self._hot_total = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+        # bytes stored for key in the current version, None if there are none
+        with self._lock:
+            row = self.con.execute("select value, used from results where key = ? and version = ?",
+                                   (key, self.version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = int(time.time())
+            if now - row[1] > TOUCH_INTERVAL:
+                self.con.execute("update results set used = ? where key = ?", (now, key))
+            return row[0]
+
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self.con.execute("begin immediate")
+            try:
+                replaced = self.con.execute("select size from results where key = ?", (key,)).fetchone()
+                self.con.execute("insert or replace into results values (?, ?, ?, ?, ?)",
+                                 (key, self.version, value, size, int(time.time())))
+                if replaced is None:
+                    self._add_usage(1, size)
+                else:
+                    self._add_usage(0, size - replaced[0])
+                if self._usage()[1] > self.max_bytes:
+                    self.evict()
+            except BaseException:
+                self.con.execute("rollback")
+                raise
+            self.con.execute("commit")
+
+
+    def _add_usage(self, entries, size):
+        self.con.execute("update usage set value = value + ? where name = 'entries'", (entries,))
+        self.con.execute("update usage set value = value + ? where name = 'bytes'", (size,))
+
+
+    def _usage(self):
+        # (entries, bytes) of all the results in the file
+        usage = dict(self.con.execute("select name, value from usage"))
+        return usage["entries"], usage["bytes"]
+
+
+    def evict(self):
+        # least recently used first, read along the index until enough is deleted
+        # (the results of older versions are deleted when a new one is served, see claim_warm_up)
+        excess = self._usage()[1] - self.max_bytes * EVICT_TO
+        evicted = []
+        freed = 0
+        for key, size in self.con.execute("select key, size from results order by used"):
+            if freed >= excess:
+                break
+            evicted.append((key,))
+            freed += size
+        self.con.executemany("delete from results where key = ?", evicted)
+        self._add_usage(-len(evicted), -freed)
+        self.evictions += len(evicted)
+
+
+    def cached(self, key, function):
+        # function() -> str, calculated if there is no result for key yet
+        value = self.get(key)
+        if value is not None:
+            return value.decode()
+        result = function()
+        self.put(key, result.encode())
+        return result
+
+
+    def count(self, key):
+        # counts a query for the warm up of the next dataset versions, the counts are written
+        # by the writer thread
+        with self._hot_lock:
+            self._hot[key] += 1
+            self._hot_total += 1
+            if self._hot_total < HOT_FLUSH_COUNT:
+                return
+            hot, self._hot, self._hot_total = self._hot, Counter(), 0
+        self._writer.submit(self.flush, hot)
+
+
+    def flush(self, hot=None):
+        if hot is None:
+            with self._hot_lock:
+                hot, self._hot, self._hot_total = self._hot, Counter(), 0
+        if not hot:
+            return
+        with self._lock:
+            self.con.executemany("insert into hot values (?, ?) on conflict (key) do update set count = count + ?",
+                                 [(key, count, count) for key, count in hot.items()])
+
+
+    def claim_warm_up(self, count):
+        # keys of the count most requested queries if this worker is the first one to serve the version,
+        # otherwise an empty list
+        with self._lock:
+            self.con.execute("begin immediate")
+            try:
+                claimed = self.con.execute("insert or ignore into warmed values (?, ?)",
+                                           (self.version, int(time.time()))).rowcount == 1
+                if not claimed:
+                    # nothing was written
+                    self.con.execute("commit")
+                    return []
+                stale = self.con.execute("select count(*), total(size) from results where version != ?",
+                                         (self.version,)).fetchone()
+                self.con.execute("delete from results where version != ?", (self.version,))
+                self._add_usage(-stale[0], -int(stale[1]))
+                keys = [key for key, in self.con.execute("select key from hot order by count desc limit ?", (count,))]
+                self.con.execute("update hot set count = count / 2")
+                self.con.execute("delete from hot where count = 0")
+            except BaseException:
+                self.con.execute("rollback")
+                raise
+            self.con.execute("commit")
+            return keys
+
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._usage()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "version": self.version,
+        }
+
+
+    def close(self):
+        self._writer.shutdown()
+        self.flush()
+        self.con.close()
@@ -1,11 +1,20 @@
 import osmium
 import sys
 import time
-from db_dict import dbdict
-from relations import local_confluence, downstream, local_confluence_old
+from db_dict import dbdict, remove, exists
+from relations import downstream, local_confluence_old, global_confluences, downstream_index
+from relations import upstream_tree_parents, upstream_tree_labels, river_levels, local_confluence_indices
+from relations import graph_downstream, graph_local_confluence
+from graph import Graph
+from extract import extract_files
+from stages import StageRunner
+from spatial import encode_geometry, decode_geometry, bounding_box, build_index
+import numpy as np
 import os
 from consts import *
-import json
+import argparse
+import multiprocessing
+import shutil
 
 
 def filter(w):
@@ -16,12 +25,82 @@ def filter(w):
     return True
 
 
+def way_geometry(w):
+    # fixed point coordinates of the nodes of a way read with locations, (xs, ys)
+    # nodes without a location are skipped, None if there are none
+    xs = []
+    ys = []
+    for n in w.nodes:
+        if n.location.valid():
+            xs.append(n.location.x)
+            ys.append(n.location.y)
+    if not xs:
+        return None
+    return xs, ys
+
+
+class GeometryTables():
+    # key=waterway_id, value=coordinates of all the nodes (see spatial.encode_geometry)
+    # key=waterway_id, value=[min_x, min_y, max_x, max_y], read by the spatial index
+
+    def __init__(self, folder=DICT_DB_FOLDER, bulk=True):
+        self.waterway_to_geometry = dbdict(folder, "waterway_to_geometry", MAX, codec="varint", bulk=bulk)
+        self.waterway_to_bbox = dbdict(folder, "waterway_to_bbox", MAX, codec="int64", bulk=bulk)
+
+
+    def add(self, waterway_id, geometry):
+        if geometry is None:
+            return
+        self.waterway_to_geometry[waterway_id] = encode_geometry(*geometry)
+        self.waterway_to_bbox[waterway_id] = bounding_box(*geometry)
+
+
+    def remove(self, waterway_id):
+        for table in (self.waterway_to_geometry, self.waterway_to_bbox):
+            if waterway_id in table:
+                del table[waterway_id]
+
+
+    def tables(self):
+        return self.waterway_to_geometry, self.waterway_to_bbox
+
+
+    def close(self):
+        for table in self.tables():
+            table.close()
+
+
+class CombinedHandler(osmium.SimpleHandler):
+    # runs several handlers in a single pass over the file
+
+    def __init__(self, *handlers):
+        osmium.SimpleHandler.__init__(self)
+        self.way_handlers = [h for h in handlers if hasattr(h, "way")]
+        self.relation_handlers = [h for h in handlers if hasattr(h, "relation")]
+
+
+    def way(self, w):
+        for handler in self.way_handlers:
+            handler.way(w)
+
+
+    def relation(self, r):
+        for handler in self.relation_handlers:
+            handler.relation(r)
+
+
 class IntersectionsHandler(osmium.SimpleHandler):
+    # incremental: keeps the nodes with a single waterway in node_to_waterway,
+    # the incremental update (see update) needs to know the waterway of every node
 
-    def __init__(self):
+    def __init__(self, incremental=False, folder=DICT_DB_FOLDER):
         osmium.SimpleHandler.__init__(self)
         # key=node_id, value=list(waterway_ids the node is present in)
-        self.node_to_waterways = dbdict(DICT_DB_FOLDER, "node_to_waterways", MAX)
+        self.node_to_waterways = dbdict(folder, "node_to_waterways", MAX, codec="int64", bulk=True)
+        # key=node_id, value=waterway_id, for the nodes that are not intersections
+        self.node_to_waterway = None
+        if incremental:
+            self.node_to_waterway = dbdict(folder, "node_to_waterway", MAX, codec="json", bulk=True)
 
         self.processed = 0
 
@@ -31,24 +110,36 @@ class IntersectionsHandler(osmium.SimpleHandler):
         if VERBOSE:
             print(f" Processed: {self.processed}", end="\r")
         for n in w.nodes:
-            if n.ref not in self.node_to_waterways:
-                self.node_to_waterways[n.ref] = []
-            self.node_to_waterways[n.ref].append(w.id)
+            waterways = self.node_to_waterways.get(n.ref, [])
+            waterways.append(w.id)
+            self.node_to_waterways[n.ref] = waterways
         self.processed += 1
     
 
     def clear_redundant_nodes(self):
+        if self.node_to_waterway is not None:
+            self.node_to_waterways.flush()
+            self.node_to_waterway.bulk_insert(
+                (node, waterways[0]) for node, waterways in self.node_to_waterways.items() if len(waterways) == 1)
         self.node_to_waterways.clear_redundant_nodes()
+        # almost all the nodes looked up in the waterways pass are not intersections
+        self.node_to_waterways.build_bloom()
 
 
 class WaterwaysHandler(osmium.SimpleHandler):
 
-    def __init__(self, node_to_waterways):
+    def __init__(self, node_to_waterways, incremental=False):
         osmium.SimpleHandler.__init__(self)
         # key=node_id, value=list(waterway_ids the node is present in)
         self.node_to_waterways = node_to_waterways
         # key=waterway_id, value=[start_node_id, intersection_node_1, intersection_node_2, ..., end_node_id]
-        self.waterway_to_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_nodes", MAX)
+        self.waterway_to_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_nodes", MAX, codec="int64", bulk=True)
+        # key=waterway_id, value=all the nodes of the waterway, only kept for incremental updates
+        self.waterway_to_all_nodes = None
+        if incremental:
+            self.waterway_to_all_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_all_nodes", MAX, codec="varint", bulk=True)
+        # the files have to be read with locations
+        self.geometry = GeometryTables()
         self.processed = 0
 
 
@@ -58,7 +149,7 @@ class WaterwaysHandler(osmium.SimpleHandler):
         if VERBOSE:
             print(f" Processed: {self.processed}", end="\r")
         # add the start node
-        self.waterway_to_nodes[w.id] = [w.nodes[0].ref]
+        nodes = [w.nodes[0].ref]
         for index, n in enumerate(w.nodes):
             # skip first and last node as they are always added
             if index == 0 or index == len(w.nodes) - 1:
@@ -66,21 +157,50 @@ class WaterwaysHandler(osmium.SimpleHandler):
             # only add nodes that have more than one waterway
             if n.ref not in self.node_to_waterways:
                 continue
-            self.waterway_to_nodes[w.id].append(n.ref)
+            nodes.append(n.ref)
         
         # append the last node
-        self.waterway_to_nodes[w.id].append(w.nodes[-1].ref)
+        nodes.append(w.nodes[-1].ref)
+        self.waterway_to_nodes[w.id] = nodes
+        if self.waterway_to_all_nodes is not None:
+            self.waterway_to_all_nodes[w.id] = [n.ref for n in w.nodes]
+        self.geometry.add(w.id, way_geometry(w))
         self.processed += 1
 
 
+class WaterwayNodesHandler(osmium.SimpleHandler):
+    # all the nodes of every waterway, the intersections are not known yet while a single
+    # file of a parallel run is processed (see ingest_partial)
+
+    def __init__(self, folder):
+        osmium.SimpleHandler.__init__(self)
+        # key=waterway_id, value=all the nodes of the waterway
+        self.waterway_to_all_nodes = dbdict(folder, "waterway_to_all_nodes", MAX, codec="varint", bulk=True)
+        self.geometry = GeometryTables(folder)
+
+
+    def way(self, w):
+        if not filter(w):
+            return
+        self.waterway_to_all_nodes[w.id] = [n.ref for n in w.nodes]
+        self.geometry.add(w.id, way_geometry(w))
+
+
+def trim_nodes(nodes, node_to_waterways):
+    # [start_node_id, intersection_node_1, intersection_node_2, ..., end_node_id]
+    return [nodes[0]] + [node for node in nodes[1:-1] if node in node_to_waterways] + [nodes[-1]]
+
+
 class RiverHandler(osmium.SimpleHandler):
-    def __init__(self, waterway_to_nodes):
+    # if waterway_to_nodes is None, the members are stored unfiltered
+    # and have to be filtered with filter_members once the waterways are known
+    def __init__(self, waterway_to_nodes=None, folder=DICT_DB_FOLDER):
         osmium.SimpleHandler.__init__(self)
         self.waterway_to_nodes = waterway_to_nodes
         # key=waterway_id, value=river_id
-        self.waterway_to_river = dbdict(DICT_DB_FOLDER, "waterway_to_river", MAX)
+        self.waterway_to_river = dbdict(folder, "waterway_to_river", MAX, codec="json", bulk=True)
         # key=river_id, value=[ww_id1, ww_id2, ..., ww_id3]
-        self.river_to_waterways = dbdict(DICT_DB_FOLDER, "river_to_waterways", MAX)
+        self.river_to_waterways = dbdict(folder, "river_to_waterways", MAX, codec="int64", bulk=True)
         self.processed = 0
     
 
@@ -94,202 +214,284 @@ class RiverHandler(osmium.SimpleHandler):
             # only add ways
             if member.type != "w":
                 continue
+            if self.waterway_to_nodes is None:
+                members.append(member.ref)
+                continue
             if member.ref not in self.waterway_to_nodes:
                 continue
             self.waterway_to_river[member.ref] = r.id
             members.append(member.ref)
         self.river_to_waterways[r.id] = members
-        
-
+        self.processed += 1
 
-class ConfluenceHandler(osmium.SimpleHandler):
-    # calculate confluences
 
-    def __init__(self, node_to_waterways, waterway_to_nodes, csv, waterway_to_river, river_to_waterways):
-        osmium.SimpleHandler.__init__(self)
-        self.csv = csv
-        # key=node_id, value=list(waterway_ids the node is present in)
-        self.node_to_waterways = node_to_waterways
-        self.waterway_to_river = waterway_to_river
-        self.river_to_waterways = river_to_waterways
-        # key=waterway_id, value=[start_node_id, intersection_node_1, intersection_node_2, ..., end_node_id]
+    def filter_members(self, waterway_to_nodes):
+        # keep only the members that are known waterways, no pbf needed
         self.waterway_to_nodes = waterway_to_nodes
-        # key=id (from 0 upwards), value=list(waterway ids that are in the confluence)
-        self.confluences = dbdict(DICT_DB_FOLDER, "confluences", MAX)
-        # key=waterway_id, value=confluence_id
-        self.waterway_to_confluence = dbdict(DICT_DB_FOLDER, "waterway_to_confluence", MAX)
-        # confluence counter
-        self.confluence_id_counter = 0
-
-
-        self.processed = 0
-
-
-    def write_confluence(self, w_id, confluence_id):
-        self.csv.write(f"{w_id},{confluence_id}\n")
-    
-
-    def way(self, w):
-        if not filter(w):
-            return
-        if VERBOSE:
-            print(f" Processed: {self.processed}", end="\r")
-        if w.id in self.waterway_to_confluence:
-            # self.write_confluence(w.id, self.waterway_to_confluence[w.id])
-            return
-        
-        self.confluence_id_counter += 1
-        open = {w.id}
-        closed = set()
-        while len(open):
-            waterway = open.pop()
-
-            # this only happens when only parts of the world are generated
-            # and the river exceeds the borders
-            if waterway not in self.waterway_to_nodes:
-                closed.add(waterway)
-                continue
-            # if waterway belongs to the river, add the whole river
-            if waterway in self.waterway_to_river:
-                river_id = self.waterway_to_river.fast_get(waterway)
-                for ww in self.river_to_waterways.fast_get(river_id):
-                    if ww == waterway:
-                        continue
-                    if ww in open or ww in closed:
-                        continue
-                    open.add(ww)
-            
-            for node in self.waterway_to_nodes.fast_get(waterway):
-                # only add nodes that have more than one waterway
-                if node not in self.node_to_waterways:
+        # materialized, since rows are replaced while iterating
+        for river_id, members in list(self.river_to_waterways.items()):
+            filtered = []
+            for member in members:
+                if member not in waterway_to_nodes:
                     continue
-                for adjacent_river in self.node_to_waterways.fast_get(node):
-                    if adjacent_river == waterway:
-                        continue
-                    if adjacent_river in closed or adjacent_river in open:
-                        continue
-                    open.add(adjacent_river)
-            closed.add(waterway)
-            self.waterway_to_confluence[waterway] = self.confluence_id_counter
-            self.write_confluence(waterway, self.confluence_id_counter)
-
-        self.confluences[self.confluence_id_counter] = list(closed)
-        # self.write_confluence(w.id, self.confluence_id_counter)
-        self.processed += 1
+                self.waterway_to_river[member] = river_id
+                filtered.append(member)
+            self.river_to_waterways[river_id] = filtered
+            self.processed += 1
 
 
-class LocalConfluenceHandler(osmium.SimpleHandler):
+class ChangeHandler(osmium.SimpleHandler):
+    # collects the waterway changes of osm change files (.osc), later changes replace earlier ones
 
-    def __init__(self, node_to_waterways, waterway_to_nodes, waterway_to_river, river_to_waterways):
+    def __init__(self):
         osmium.SimpleHandler.__init__(self)
-        # key=node_id, value=list(waterway_ids the node is present in)
-        self.node_to_waterways = node_to_waterways
-        # key=waterway_id, value=[start_node_id, intersection_node_1, intersection_node_2, ..., end_node_id]
-        self.waterway_to_nodes = waterway_to_nodes
-        # key=waterway_id, value=river_id
-        self.waterway_to_river = waterway_to_river
-        # key=river_id, value=[ww_id1, ww_id2, ..., ww_id3]
-        self.river_to_waterways = river_to_waterways
+        # key=way_id, value=list(node ids), None if the way was deleted or is no longer a waterway
+        self.ways = dict()
+        # key=relation_id, value=list(member way ids), None if deleted or no longer a waterway relation
+        self.relations = dict()
+        # key=node_id, value=(x, y) of the created and moved nodes
+        self.locations = dict()
 
-        # key=river_id, value=[local_confluence_w1, local_confluence_w2, ..., local_confluence_wn]
-        self.river_to_local_confluence = dbdict(DICT_DB_FOLDER, "river_to_local_confluence", MAX)
 
-        # for stats
-        self.processed = 0
-        self.num_to_process = len(self.waterway_to_river.keys())
+    def node(self, n):
+        if not n.deleted and n.location.valid():
+            self.locations[n.id] = (n.location.x, n.location.y)
 
 
     def way(self, w):
-        if not filter(w):
+        if w.deleted or not filter(w):
+            self.ways[w.id] = None
             return
-        if w.id not in self.waterway_to_river:
-            return
-        if VERBOSE:
-            print(f" Processed: {self.processed}", end="\r")
-        river_id = self.waterway_to_river[w.id]
-        if river_id in self.river_to_local_confluence:
+        self.ways[w.id] = [n.ref for n in w.nodes]
+
+
+    def relation(self, r):
+        if r.deleted or r.tags.get("waterway") not in CLASSES:
+            self.relations[r.id] = None
             return
-        confluence = local_confluence(w.id, self.node_to_waterways, self.waterway_to_nodes, 
-                                      self.waterway_to_river, self.river_to_waterways, self.river_to_local_confluence)
-        self.river_to_local_confluence[river_id] = confluence
-        self.processed += 1
+        self.relations[r.id] = [member.ref for member in r.members if member.type == "w"]
 
 
-def test():
-    if len(sys.argv) >= 2:
-        osm_file = sys.argv[1]
-        if len(sys.argv) == 3:
-            VERBOSE = (sys.argv[2] == "true" or sys.argv[2] == "True" or sys.argv[2] == "1")
-    else:
-        osm_file = OSM_FILE
-    
-    write = True
-    
-    if write:
-        start = time.time()
+class ConfluenceHandler():
+    # calculate confluences on the compact graph with union-find, the pbf is not needed
 
-        intersections = IntersectionsHandler()
-        print("Processing nodes")
-        intersections.apply_file(osm_file)
-        # intersections.apply_file("./sources/slovenia-latest.osm.pbf")
-        intersections.clear_redundant_nodes()
+    def __init__(self, graph, csv):
+        self.csv = csv
+        self.graph = graph
+        # key=id (from 1 upwards), value=list(waterway ids that are in the confluence)
+        self.confluences = dbdict(DICT_DB_FOLDER, "confluences", MAX, codec="varint", bulk=True)
+        # key=waterway_id, value=confluence_id
+        # stays json, tilemaker reads the values (see tilemaker/process.lua)
+        self.waterway_to_confluence = dbdict(DICT_DB_FOLDER, "waterway_to_confluence", MAX, codec="json", bulk=True)
 
-        waterways = WaterwaysHandler(intersections.node_to_waterways)
-        print("Processing ways")
-        waterways.apply_file(osm_file)
-        # waterways.apply_file("./sources/slovenia-latest.osm.pbf")
+        self.processed = 0
 
-        rivers = RiverHandler()
-        print("Processing relations")
-        rivers.apply_file(osm_file)
-        # rivers.apply_file("./sources/slovenia-latest.osm.pbf")
-
-        node_to_waterways = intersections.node_to_waterways
-        waterway_to_nodes = waterways.waterway_to_nodes
-        waterway_to_river = rivers.waterway_to_river
-        river_to_waterways = rivers.river_to_waterways
-
-        # node_to_waterways = dbdict("node_to_waterways", MAX)
-        # waterway_to_nodes = dbdict("waterway_to_nodes", MAX)
-        # waterway_to_river = dbdict("waterway_to_river", MAX)
-        # river_to_waterways = dbdict("river_to_waterways", MAX)
-
-        local_confluence_handler = LocalConfluenceHandler(node_to_waterways, waterway_to_nodes, waterway_to_river, river_to_waterways)
-        print("Calculating local confluences")
-        local_confluence_handler.apply_file(osm_file)
-        # local_confluence_handler.apply_file("./sources/slovenia-latest.osm.pbf")
-        river_to_local_confluence = local_confluence_handler.river_to_local_confluence
 
-        with open(CSV_FILE, "w") as csv:
-            confluence = ConfluenceHandler(node_to_waterways, waterway_to_nodes, csv, waterway_to_river, river_to_waterways)
-            print("Calculating global confluences")
-            confluence.apply_file(osm_file)
-            # confluence.apply_file("./sources/slovenia-latest.osm.pbf")
-        
-        end = time.time()
-        print(f"Took {end - start} s for parsing data from {osm_file}")
+    def run(self):
+        labels = global_confluences(self.graph)
+        self.graph.set_confluences(labels)
+        waterway_ids = self.graph.waterway_ids.tolist()
+        labels = labels.tolist()
+        self.waterway_to_confluence.bulk_insert(zip(waterway_ids, labels))
+        self.csv.writelines(f"{w_id},{confluence_id}\n" for w_id, confluence_id in zip(waterway_ids, labels))
+        self.confluences.bulk_insert(self.members())
+        self.processed = len(waterway_ids)
+
+
+    def update(self, old_graph):
+        # incremental run: confluences with the same waterways as in old_graph keep their id,
+        # the others get new ids and only the changed rows are written
+        # returns the ids of the waterways whose confluence changed (including removed waterways)
+        graph = self.graph
+        labels = global_confluences(graph)
+        old_labels = np.zeros(len(labels), dtype=np.int64)
+        if len(old_graph.waterway_ids):
+            old_index = np.minimum(np.searchsorted(old_graph.waterway_ids, graph.waterway_ids),
+                                   len(old_graph.waterway_ids) - 1)
+            found = old_graph.waterway_ids[old_index] == graph.waterway_ids
+            old_labels[found] = old_graph.ww_confluence[old_index[found]]
+        old_sizes = np.bincount(old_graph.ww_confluence, minlength=1)
+        next_id = len(old_sizes)
+
+        new_labels = np.empty(len(labels), dtype=np.int32)
+        kept = set()
+        order = np.argsort(labels, kind="stable")
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        for group in np.split(order, bounds):
+            if not len(group):
+                continue
+            old_id = int(old_labels[group[0]])
+            # same members: all from one old confluence that has no other members
+            if old_id > 0 and old_sizes[old_id] == len(group) and (old_labels[group] == old_id).all():
+                new_labels[group] = old_id
+                kept.add(old_id)
+            else:
+                new_labels[group] = next_id
+                next_id += 1
+        graph.set_confluences(new_labels)
+
+        changed = np.flatnonzero(new_labels != old_labels)
+        changed_ids = graph.waterway_ids[changed].tolist()
+        self.waterway_to_confluence.bulk_insert(zip(changed_ids, new_labels[changed].tolist()))
+        removed_ids = np.setdiff1d(old_graph.waterway_ids, graph.waterway_ids).tolist()
+        for waterway_id in removed_ids:
+            del self.waterway_to_confluence[waterway_id]
+
+        for confluence_id in np.unique(old_graph.ww_confluence).tolist():
+            if confluence_id not in kept:
+                del self.confluences[confluence_id]
+        self.confluences.bulk_insert((confluence_id, members) for confluence_id, members in self.members()
+                                     if confluence_id not in kept)
+        # the csv is small, it is written again as a whole
+        self.csv.writelines(f"{w_id},{confluence_id}\n"
+                            for w_id, confluence_id in zip(graph.waterway_ids.tolist(), new_labels.tolist()))
+        self.processed = len(changed_ids)
+        return changed_ids + removed_ids
+
+
+    def members(self):
+        # (confluence_id, [waterway ids]) for every confluence, grouped without python sets
+        order = np.argsort(self.graph.ww_confluence, kind="stable")
+        sorted_labels = self.graph.ww_confluence[order]
+        bounds = np.flatnonzero(np.diff(sorted_labels)) + 1
+        for group in np.split(order, bounds):
+            if len(group):
+                yield int(self.graph.ww_confluence[group[0]]), self.graph.waterway_ids[group].tolist()
+
+
+# the handler of the level that is calculated, set before the pool is forked,
+# so the workers read the graph and the calculated rivers from the shared memory
+_level_handler = None
+
+
+def calculate_rivers(rivers):
+    # process pool worker
+    return [(river, _level_handler.calculate(river)) for river in rivers]
+
+
+class LocalConfluenceHandler():
+    # calculate local confluences on the compact graph, the pbf is not needed
+    # a local confluence is stored as label ranges of the upstream tree instead of a list of waterways
+    # rivers are calculated level by level from the headwaters downstream (see river_levels) and
+    # reuse the local confluences of all the rivers of the previous levels, so the result does not
+    # depend on the order of the files. The rivers of a level are calculated by forked processes
+
+    def __init__(self, graph, workers=1):
+        self.graph = graph
+        self.workers = workers
+        parent = upstream_tree_parents(graph)
+        self.lc_label, self.lc_order = upstream_tree_labels(graph, parent)
+        graph.set_local_confluences(self.lc_label, self.lc_order, {})
+        self.levels = river_levels(graph, parent, self.lc_order)
+        # key=river index, value=label ranges of the local confluence
+        self.river_ranges = dict()
+
+        # for stats
+        self.processed = 0
 
-    else:
-        node_to_waterways = dbdict(DICT_DB_FOLDER, "node_to_waterways", MAX)
-        waterway_to_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_nodes", MAX)
-        waterway_to_river = dbdict(DICT_DB_FOLDER, "waterway_to_river", MAX)
-        river_to_waterways = dbdict(DICT_DB_FOLDER, "river_to_waterways", MAX)
-        river_to_local_confluence = dbdict(DICT_DB_FOLDER, "river_to_local_confluence", MAX)
 
+    def river_local_confluence(self, river):
+        ranges = self.river_ranges.get(river)
+        if ranges is None:
+            return None
+        return self.graph.ranges_to_waterways(ranges).tolist()
+
+
+    def calculate(self, river):
+        # the traversal starts at the first member of the relation
+        start = self.graph.river_ww_idx[self.graph.river_ww_ptr[river]]
+        confluence = local_confluence_indices(int(start), self.graph, self.river_local_confluence)
+        return self.graph.waterways_to_ranges(confluence)
+
+
+    def run(self):
+        # rivers with known ranges (see update) are not calculated again
+        global _level_handler
+        river_ww_ptr = self.graph.river_ww_ptr
+        for level in self.levels:
+            rivers = [river for river in level
+                      if river not in self.river_ranges and river_ww_ptr[river + 1] > river_ww_ptr[river]]
+            if VERBOSE:
+                print(f" Processed: {self.processed}", end="\r")
+            # the rivers of a level only see the results of the previous levels
+            if self.workers > 1 and len(rivers) >= MIN_PARALLEL_RIVERS:
+                _level_handler = self
+                chunks = [chunk.tolist() for chunk in np.array_split(rivers, self.workers * 4)]
+                with multiprocessing.get_context("fork").Pool(self.workers) as pool:
+                    results = [result for chunk in pool.map(calculate_rivers, chunks) for result in chunk]
+                _level_handler = None
+            else:
+                results = [(river, self.calculate(river)) for river in rivers]
+            self.river_ranges.update(results)
+            self.processed += len(rivers)
+        self.graph.set_local_confluences(self.lc_label, self.lc_order, self.river_ranges)
+
+
+    def update(self, old_graph, touched_ids, changed_river_ids):
+        # incremental run: the traversal of a local confluence only looks at the nodes and rivers
+        # of the waterways it visits, so only the rivers whose local confluence contains a touched
+        # waterway (changed or sharing a node with a changed one) are calculated again,
+        # the others are translated to the new labels
+        # returns the number of calculated rivers
+        graph = self.graph
+        touched_ids = np.array(sorted(touched_ids), dtype=np.int64)
+        # all the members of a changed river are touched
+        old_rivers = old_graph.ww_river[old_graph.waterway_indices(touched_ids)]
+        rivers = graph.ww_river[graph.waterway_indices(touched_ids)]
+        affected_ids = (set(old_graph.river_ids[old_rivers[old_rivers >= 0]].tolist())
+                        | set(graph.river_ids[rivers[rivers >= 0]].tolist()) | set(changed_river_ids))
+        members = [touched_ids]
+        for river_id in affected_ids:
+            for river_graph in (old_graph, graph):
+                river = river_graph.river_index(river_id)
+                if river >= 0:
+                    members.append(river_graph.waterway_ids[river_graph.river_waterways(river)])
+        touched_ids = np.unique(np.concatenate(members))
+
+        # rivers whose old local confluence contains a touched waterway
+        old_labels = np.sort(old_graph.lc_label[old_graph.waterway_indices(touched_ids)])
+        ranges = old_graph.river_lc_ranges
+        hits = np.searchsorted(old_labels, ranges[:, 1]) > np.searchsorted(old_labels, ranges[:, 0])
+        range_rivers = np.repeat(np.arange(len(old_graph.river_ids)), np.diff(old_graph.river_lc_ptr))
+        affected_ids |= set(old_graph.river_ids[range_rivers[hits]].tolist())
+
+        for river, river_id in enumerate(graph.river_ids.tolist()):
+            old_river = old_graph.river_index(river_id)
+            if river_id in affected_ids or old_river < 0:
+                continue
+            old_ranges = old_graph.river_local_confluence_ranges(old_river)
+            if old_ranges is None:
+                continue
+            members = old_graph.waterway_ids[old_graph.ranges_to_waterways(old_ranges)]
+            self.river_ranges[river] = graph.waterways_to_ranges(graph.waterway_indices(members))
 
-    river_id = 350935692 # Bračana
-    river_id = 863577658 # u sloveniji
-    river_id = 438527470 # mirna
-    river_id = 22702834 # sava
+        self.run()
+        return self.processed
+
+
+def test(river_id=22702834):
+    # timings of the traversals of a single river on the data written by write()
+    # river_id = 350935692 # Bračana
+    # river_id = 863577658 # u sloveniji
+    # river_id = 438527470 # mirna
     # river_id = 507633106 # amazon river
+    node_to_waterways = dbdict(DICT_DB_FOLDER, "node_to_waterways", MAX)
+    waterway_to_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_nodes", MAX)
+    waterway_to_river = dbdict(DICT_DB_FOLDER, "waterway_to_river", MAX)
+    graph = Graph.load(DICT_DB_FOLDER)
+
     start = time.time()
     print(downstream(river_id, node_to_waterways, waterway_to_nodes))
     end = time.time()
     print(f"Took {end - start} s to calculate downstream for {river_id}")
 
     start = time.time()
-    l_conf = local_confluence(river_id, node_to_waterways, waterway_to_nodes, 
-                              waterway_to_river, river_to_waterways,river_to_local_confluence)
+    print(graph_downstream(river_id, graph))
+    end = time.time()
+    print(f"Took {end - start} s to calculate downstream on the graph for {river_id}")
+
+    start = time.time()
+    l_conf = graph_local_confluence(river_id, graph)
     print(l_conf)
     print(len(l_conf))
     end = time.time()
@@ -302,67 +504,501 @@ def test():
     print(f"Took {end - start} s to calculate local confluence (old) for {river_id}")
 
 
-def write(skip_nodes=False):
-    files = os.listdir(sys.argv[1])
-    files = [os.path.join(sys.argv[1], file) for file in files]
+# stages of write in order, see stages.py for the manifest and the resume
+WRITE_STAGES = ["extract", "intersections", "waterways", "members", "spatial_index", "graph", "global_confluences",
+                "downstream_index", "local_confluences", "save"]
+UPDATE_STAGES = ["changes", "ways", "geometry", "relations", "spatial_index", "graph", "global_confluences",
+                 "downstream_index", "local_confluences", "save"]
 
-    start = time.time()
-    if not skip_nodes:
-        # intersections
-        intersections = IntersectionsHandler()
-        print("Processing nodes")
-        for i, osm_file in enumerate(files):
-            print(f" {i + 1}/{len(files)}", end="\r")
-            intersections.apply_file(osm_file)
-        
-        # reduce the size of the nodes file
-        intersections.clear_redundant_nodes()
-        
-        # waterways
-        waterways = WaterwaysHandler(intersections.node_to_waterways)
-        print("Processing ways")
-        for i, osm_file in enumerate(files):
-            print(f" {i + 1}/{len(files)}", end="\r")
-            waterways.apply_file(osm_file)
-
-        node_to_waterways = intersections.node_to_waterways
-        waterway_to_nodes = waterways.waterway_to_nodes
-        # rivers
-        rivers = RiverHandler(waterway_to_nodes)
-        print("Processing relations")
-        for i, osm_file in enumerate(files):
+
+def partial_folder(index):
+    # tables of a single input file of a parallel run
+    return os.path.join(DICT_DB_FOLDER, "partial", str(index))
+
+
+def ingest_partial(job):
+    # process pool worker: reads a single file, the node lists are not trimmed
+    # since the intersections with the other files are not known yet
+    # returns the number of processed ways and relations
+    index, osm_file = job
+    folder = partial_folder(index)
+    os.makedirs(folder)
+    intersections = IntersectionsHandler(folder=folder)
+    rivers = RiverHandler(folder=folder)
+    waterways = WaterwayNodesHandler(folder)
+    CombinedHandler(intersections, rivers, waterways).apply_file(osm_file, locations=True)
+    for table in (intersections.node_to_waterways, rivers.waterway_to_river, rivers.river_to_waterways,
+                  waterways.waterway_to_all_nodes, *waterways.geometry.tables()):
+        table.close()
+    return intersections.processed + rivers.processed
+
+
+def trim_partial(index):
+    # process pool worker: trims the node lists of a single file with the merged intersections
+    # returns (index, number of waterways)
+    folder = partial_folder(index)
+    node_to_waterways = dbdict(DICT_DB_FOLDER, "node_to_waterways", MAX)
+    waterway_to_all_nodes = dbdict(folder, "waterway_to_all_nodes", MAX)
+    waterway_to_nodes = dbdict(folder, "waterway_to_nodes", MAX, codec="int64", bulk=True)
+    items = [(waterway_id, trim_nodes(nodes, node_to_waterways)) for waterway_id, nodes in waterway_to_all_nodes.items()]
+    waterway_to_nodes.bulk_insert(items)
+    for table in (node_to_waterways, waterway_to_all_nodes, waterway_to_nodes):
+        table.close()
+    return index, len(items)
+
+
+def ingest_parallel(files, incremental, workers, stage):
+    # every file is read by its own process into partial tables, which are then merged:
+    # node lists are joined at the nodes shared by several files (rivers crossing the
+    # borders of the extracts) and ways present in overlapping extracts are only kept once
+    # the unfiltered relations and the partial tables are left for the waterways stage (see trim_parallel)
+    shutil.rmtree(os.path.join(DICT_DB_FOLDER, "partial"), ignore_errors=True)
+    # the pool is started before any table is opened, so no connection is forked
+    with multiprocessing.Pool(workers) as pool:
+        for i, objects in enumerate(pool.imap_unordered(ingest_partial, enumerate(files))):
             print(f" {i + 1}/{len(files)}", end="\r")
-            rivers.apply_file(osm_file)
-        waterway_to_river = rivers.waterway_to_river
-        river_to_waterways = rivers.river_to_waterways
+            stage.objects += objects
+
+    intersections = IntersectionsHandler(incremental)
+    rivers = RiverHandler()
+    waterway_to_all_nodes = None
+    if incremental:
+        waterway_to_all_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_all_nodes", MAX, codec="varint", bulk=True)
+    stage.track(intersections.node_to_waterways, intersections.node_to_waterway, rivers.river_to_waterways,
+                waterway_to_all_nodes)
+    merged_ids = np.empty(0, dtype=np.int64)
+    for index in range(len(files)):
+        folder = partial_folder(index)
+        partial_nodes = dbdict(folder, "node_to_waterways", MAX)
+        partial_all_nodes = dbdict(folder, "waterway_to_all_nodes", MAX)
+        partial_rivers = dbdict(folder, "river_to_waterways", MAX)
+        stage.track(partial_nodes, partial_all_nodes, partial_rivers)
+        waterway_ids = np.array(partial_all_nodes.keys(), dtype=np.int64)
+        # ways of overlapping extracts only count in the first file they are in
+        for waterway_id in np.intersect1d(waterway_ids, merged_ids).tolist():
+            for node in set(partial_all_nodes[waterway_id]):
+                members = [member for member in partial_nodes[node] if member != waterway_id]
+                if len(members):
+                    partial_nodes[node] = members
+                else:
+                    del partial_nodes[node]
+        merged_ids = np.union1d(merged_ids, waterway_ids)
+        intersections.node_to_waterways.merge(partial_nodes, append=True)
+        rivers.river_to_waterways.merge(partial_rivers)
+        if incremental:
+            waterway_to_all_nodes.merge(partial_all_nodes)
+        for table in (partial_nodes, partial_all_nodes, partial_rivers):
+            table.close()
+    intersections.clear_redundant_nodes()
+    for table in (intersections.node_to_waterways, intersections.node_to_waterway, rivers.waterway_to_river,
+                  rivers.river_to_waterways, waterway_to_all_nodes):
+        if table is not None:
+            table.close()
+
+
+def trim_parallel(num_files, workers, stage):
+    # trims the node lists of the partial tables with the merged intersections (see ingest_parallel)
+    # and merges the geometry, ways of overlapping extracts keep the geometry of the first file
+    if not os.path.isdir(partial_folder(0)) and num_files:
+        print(f"{os.path.join(DICT_DB_FOLDER, 'partial')} is missing, the intersections stage has to run first")
+        exit(1)
+    with multiprocessing.Pool(workers) as pool:
+        waterway_to_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_nodes", MAX, codec="int64", bulk=True)
+        geometry = GeometryTables()
+        stage.track(waterway_to_nodes, *geometry.tables())
+        # in file order, so the waterways are stored in the same order as in a sequential run
+        for index, objects in pool.imap(trim_partial, range(num_files)):
+            partial = dbdict(partial_folder(index), "waterway_to_nodes", MAX)
+            partial_geometry = GeometryTables(partial_folder(index), bulk=False)
+            stage.track(*partial_geometry.tables())
+            waterway_to_nodes.merge(partial)
+            for table, partial_table in zip(geometry.tables(), partial_geometry.tables()):
+                table.merge(partial_table)
+            partial.close()
+            partial_geometry.close()
+            stage.objects += objects
+    waterway_to_nodes.close()
+    geometry.close()
+    shutil.rmtree(os.path.join(DICT_DB_FOLDER, "partial"))
+
+
+def remove_tables(*names):
+    # a stage starts from empty tables, so running it again does not add to the rows of an earlier run
+    for name in names:
+        remove(DICT_DB_FOLDER, name)
+
+
+def checkpoint_graph(graph):
+    # the graph as left by the last finished graph stage, if it was not calculated by this run
+    if graph is not None:
+        return graph
+    for folder in (CHECKPOINT_FOLDER, DICT_DB_FOLDER):
+        if Graph.exists(folder):
+            return Graph.load(folder)
+    print(f"There is no graph in {CHECKPOINT_FOLDER}, the graph stage has to run first")
+    exit(1)
+
+
+def write(incremental=False, workers=1, folder=None, extract=True, resume=False, stages=None):
+    # incremental: also keeps the tables needed by update (more disk space)
+    # workers: number of processes reading the files, 1 reads them one after another
+    # extract: read the cached waterway-only extracts of the files (see extract.py)
+    # resume: go on after the last finished stage of an earlier run with the same arguments
+    # stages: run only these stages of WRITE_STAGES, the output of the stages before them has to exist
+    # returns the records of the stages that were run (see stages.py)
+    folder = folder or sys.argv[1]
+    # sorted, a resumed run sees the files in the same order
+    files = [os.path.join(folder, file) for file in sorted(os.listdir(folder))]
+    params = {"folder": os.path.abspath(folder), "incremental": incremental, "extract": extract,
+              "parallel": workers > 1}
+    try:
+        runner = StageRunner(WRITE_STAGES, params, resume, stages)
+    except ValueError as error:
+        print(error)
+        exit(1)
+    os.makedirs(CHECKPOINT_FOLDER, exist_ok=True)
+
+    start = time.time()
+    if runner.should_run("extract"):
+        with runner.stage("extract") as stage:
+            if extract:
+                files = extract_files(files, workers)
+            stage.objects = len(files)
+    elif extract and (runner.should_run("intersections") or runner.should_run("waterways")):
+        # only looked up, the extracts are cached
+        files = extract_files(files, workers)
+
+    if workers > 1:
+        if runner.should_run("intersections"):
+            remove_tables("node_to_waterways", "node_to_waterway", "waterway_to_river", "river_to_waterways",
+                          "waterway_to_all_nodes")
+            with runner.stage("intersections") as stage:
+                ingest_parallel(files, incremental, workers, stage)
+        if runner.should_run("waterways"):
+            remove_tables("waterway_to_nodes", "waterway_to_geometry", "waterway_to_bbox")
+            with runner.stage("waterways") as stage:
+                trim_parallel(len(files), workers, stage)
+    else:
+        if runner.should_run("intersections"):
+            # first pass: intersections and river relations
+            remove_tables("node_to_waterways", "node_to_waterway", "waterway_to_river", "river_to_waterways")
+            intersections = IntersectionsHandler(incremental)
+            rivers = RiverHandler()
+            with runner.stage("intersections", intersections.node_to_waterways, intersections.node_to_waterway,
+                              rivers.waterway_to_river, rivers.river_to_waterways) as stage:
+                combined = CombinedHandler(intersections, rivers)
+                for i, osm_file in enumerate(files):
+                    print(f" {i + 1}/{len(files)}", end="\r")
+                    combined.apply_file(osm_file)
+                # reduce the size of the nodes file
+                intersections.clear_redundant_nodes()
+                stage.objects = intersections.processed + rivers.processed
+            for table in (intersections.node_to_waterways, intersections.node_to_waterway, rivers.waterway_to_river,
+                          rivers.river_to_waterways):
+                if table is not None:
+                    table.close()
+
+        if runner.should_run("waterways"):
+            # second pass: waterways, only the intersections known after the first pass are kept
+            remove_tables("waterway_to_nodes", "waterway_to_all_nodes", "waterway_to_geometry", "waterway_to_bbox")
+            node_to_waterways = dbdict(DICT_DB_FOLDER, "node_to_waterways", MAX)
+            waterways = WaterwaysHandler(node_to_waterways, incremental)
+            with runner.stage("waterways", node_to_waterways, waterways.waterway_to_nodes,
+                              waterways.waterway_to_all_nodes, *waterways.geometry.tables()) as stage:
+                for i, osm_file in enumerate(files):
+                    print(f" {i + 1}/{len(files)}", end="\r")
+                    # the geometry needs the locations of the nodes
+                    waterways.apply_file(osm_file, locations=True)
+                stage.objects = waterways.processed
+            for table in (node_to_waterways, waterways.waterway_to_nodes, waterways.waterway_to_all_nodes,
+                          *waterways.geometry.tables()):
+                if table is not None:
+                    table.close()
+
+    if runner.should_run("members"):
+        rivers = RiverHandler()
+        waterway_to_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_nodes", MAX)
+        with runner.stage("members", waterway_to_nodes, rivers.waterway_to_river, rivers.river_to_waterways) as stage:
+            rivers.filter_members(waterway_to_nodes)
+            stage.objects = rivers.processed
+        for table in (waterway_to_nodes, rivers.waterway_to_river, rivers.river_to_waterways):
+            table.close()
+
+    if runner.should_run("spatial_index"):
+        waterway_to_bbox = dbdict(DICT_DB_FOLDER, "waterway_to_bbox", MAX)
+        with runner.stage("spatial_index", waterway_to_bbox) as stage:
+            stage.objects = build_index(waterway_to_bbox, DICT_DB_FOLDER)
+        waterway_to_bbox.close()
+
+    # the confluence stages only use the stored tables, every stage leaves the graph in CHECKPOINT_FOLDER
+    graph = None
+    if runner.should_run("graph"):
+        tables = [dbdict(DICT_DB_FOLDER, name, MAX) for name in ("waterway_to_nodes", "waterway_to_river",
+                                                                 "river_to_waterways")]
+        with runner.stage("graph", *tables) as stage:
+            graph = Graph.build(*tables)
+            graph.save(CHECKPOINT_FOLDER)
+            stage.objects = len(graph.waterway_ids)
+        for table in tables:
+            table.close()
+
+    if runner.should_run("global_confluences"):
+        graph = checkpoint_graph(graph)
+        remove_tables("confluences", "waterway_to_confluence")
+        with open(CSV_FILE, "w") as csv:
+            confluence = ConfluenceHandler(graph, csv)
+            with runner.stage("global_confluences", confluence.confluences,
+                              confluence.waterway_to_confluence) as stage:
+                confluence.run()
+                graph.save(CHECKPOINT_FOLDER)
+                stage.objects = confluence.processed
+        confluence.confluences.close()
+        confluence.waterway_to_confluence.close()
+
+    if runner.should_run("downstream_index"):
+        graph = checkpoint_graph(graph)
+        with runner.stage("downstream_index") as stage:
+            graph.set_downstream_index(*downstream_index(graph))
+            graph.save(CHECKPOINT_FOLDER)
+            stage.objects = len(graph.waterway_ids)
+
+    if runner.should_run("local_confluences"):
+        graph = checkpoint_graph(graph)
+        with runner.stage("local_confluences") as stage:
+            local_confluence_handler = LocalConfluenceHandler(graph, workers)
+            local_confluence_handler.run()
+            graph.save(CHECKPOINT_FOLDER)
+            stage.objects = local_confluence_handler.processed
+
+    # compact graph used by the server for traversals
+    if runner.should_run("save"):
+        graph = checkpoint_graph(graph)
+        with runner.stage("save") as stage:
+            graph.save(DICT_DB_FOLDER)
+            stage.objects = len(graph.waterway_ids)
+        shutil.rmtree(CHECKPOINT_FOLDER, ignore_errors=True)
+
+    end = time.time()
+    print(f"Took {end - start} s for parsing data")
+    return runner.records
+
+
+def set_node_waterways(node, members, node_to_waterways, node_to_waterway):
+    # stores the waterways of a node in the table matching their number
+    if len(members) > 1:
+        node_to_waterways[node] = members
+    elif node in node_to_waterways:
+        del node_to_waterways[node]
+    if len(members) == 1:
+        node_to_waterway[node] = members[0]
+    elif node in node_to_waterway:
+        del node_to_waterway[node]
+
+
+def update(change_files, workers=1):
+    # applies osm change files (.osc) to the tables of an incremental write (see write)
+    # and recalculates only what the changes touch, the ids of the waterways whose
+    # geometry or confluence changed are written to CHANGED_FILE
+    if not os.path.isfile(os.path.join(DICT_DB_FOLDER, "dict_db_waterway_to_all_nodes.sqlite")):
+        print(f"{DICT_DB_FOLDER} was not written with --incremental, a full run is needed first")
+        exit(1)
+    start = time.time()
+    # the records are not written to the manifest, it belongs to the full run
+    runner = StageRunner(UPDATE_STAGES, manifest_path=None)
+    changes = ChangeHandler()
+    with runner.stage("changes") as stage:
+        for change_file in change_files:
+            changes.apply_file(change_file)
+        stage.objects = len(changes.ways) + len(changes.relations)
 
     node_to_waterways = dbdict(DICT_DB_FOLDER, "node_to_waterways", MAX)
+    node_to_waterway = dbdict(DICT_DB_FOLDER, "node_to_waterway", MAX)
+    waterway_to_all_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_all_nodes", MAX)
     waterway_to_nodes = dbdict(DICT_DB_FOLDER, "waterway_to_nodes", MAX)
     waterway_to_river = dbdict(DICT_DB_FOLDER, "waterway_to_river", MAX)
     river_to_waterways = dbdict(DICT_DB_FOLDER, "river_to_waterways", MAX)
+    old_graph = Graph.load(DICT_DB_FOLDER)
+    # written by full runs since the spatial index exists
+    has_geometry = exists(DICT_DB_FOLDER, "waterway_to_geometry")
+    if not has_geometry:
+        print(f"{DICT_DB_FOLDER} has no waterway geometry, the spatial index is only written by a full run")
+    geometry = GeometryTables(bulk=False) if has_geometry else None
+
+    # key=node_id, value=(x, y) from the stored geometry, the change files only
+    # have the locations of the nodes that were created or moved
+    locations = dict()
+    remembered = set()
+
+    def remember(way_id):
+        # the stored geometry matches the stored nodes of a way until they are replaced
+        if way_id in remembered or geometry is None:
+            return
+        remembered.add(way_id)
+        nodes = waterway_to_all_nodes.get(way_id)
+        values = geometry.waterway_to_geometry.get(way_id)
+        if nodes is None or values is None:
+            return
+        xs, ys = decode_geometry(values)
+        # otherwise nodes without a location were skipped
+        if len(xs) == len(nodes):
+            locations.update(zip(nodes, zip(xs.tolist(), ys.tolist())))
+
+    changed_ids = set()
+    with runner.stage("ways", node_to_waterways, node_to_waterway, waterway_to_all_nodes, waterway_to_nodes,
+                      waterway_to_river, river_to_waterways) as stage:
+        # waterways whose intersection nodes have to be found again
+        affected = set()
+        # waterways sharing a node with a changed waterway
+        neighbours = set()
+        for way_id, nodes in changes.ways.items():
+            old_nodes = waterway_to_all_nodes.get(way_id)
+            if old_nodes is None and nodes is None:
+                continue
+            changed_ids.add(way_id)
+            affected.add(way_id)
+            remember(way_id)
+            counts = dict()
+            for node in nodes or []:
+                counts[node] = counts.get(node, 0) + 1
+            for node in set(old_nodes or []) | set(counts):
+                old_members = node_to_waterways.get(node)
+                if old_members is None:
+                    single = node_to_waterway.get(node)
+                    old_members = [] if single is None else [single]
+                # the location of an unchanged node is in the geometry of its other waterways
+                if node in counts and node not in changes.locations and node not in locations:
+                    for member in old_members:
+                        remember(member)
+                # a waterway is in the list once for every time it passes the node
+                members = [member for member in old_members if member != way_id] + [way_id] * counts.get(node, 0)
+                neighbours.update(old_members)
+                neighbours.update(members)
+                if (len(old_members) > 1) != (len(members) > 1):
+                    affected.update(old_members)
+                    affected.update(members)
+                set_node_waterways(node, members, node_to_waterways, node_to_waterway)
+            if nodes is None:
+                del waterway_to_all_nodes[way_id]
+            else:
+                waterway_to_all_nodes[way_id] = nodes
+
+        for way_id in affected:
+            all_nodes = waterway_to_all_nodes.get(way_id)
+            if all_nodes is None:
+                if way_id in waterway_to_nodes:
+                    del waterway_to_nodes[way_id]
+                river_id = waterway_to_river.get(way_id)
+                if river_id is not None:
+                    del waterway_to_river[way_id]
+                    river_to_waterways[river_id] = [member for member in river_to_waterways.get(river_id, [])
+                                                    if member != way_id]
+                continue
+            waterway_to_nodes[way_id] = trim_nodes(all_nodes, node_to_waterways)
+        changed_ids |= affected
+        stage.objects = len(changes.ways)
+
+    # waterways of moved nodes, their tiles have to be rendered again
+    moved_ids = set()
+    if geometry is not None:
+        with runner.stage("geometry", *geometry.tables()) as stage:
+            for node in changes.locations:
+                members = node_to_waterways.get(node)
+                if members is None:
+                    single = node_to_waterway.get(node)
+                    members = [] if single is None else [single]
+                moved_ids.update(members)
+            moved_ids -= changes.ways.keys()
+            # read before any geometry is replaced
+            for way_id in moved_ids:
+                remember(way_id)
+            for way_id in sorted(moved_ids | changes.ways.keys()):
+                nodes = waterway_to_all_nodes.get(way_id)
+                coordinates = [changes.locations.get(node) or locations.get(node) for node in nodes or []]
+                coordinates = [coordinate for coordinate in coordinates if coordinate is not None]
+                if not coordinates:
+                    geometry.remove(way_id)
+                    continue
+                geometry.add(way_id, ([x for x, _ in coordinates], [y for _, y in coordinates]))
+                stage.objects += 1
+
+    with runner.stage("relations", waterway_to_nodes, waterway_to_river, river_to_waterways) as stage:
+        for river_id, members in changes.relations.items():
+            for member in river_to_waterways.get(river_id, []):
+                if waterway_to_river.get(member) == river_id:
+                    del waterway_to_river[member]
+            if members is None:
+                if river_id in river_to_waterways:
+                    del river_to_waterways[river_id]
+                continue
+            # members that are not (yet) waterways are dropped, like in a full run
+            members = [member for member in members if member in waterway_to_nodes]
+            for member in members:
+                waterway_to_river[member] = river_id
+            river_to_waterways[river_id] = members
+        stage.objects = len(changes.relations)
+
+    for table in (node_to_waterways, node_to_waterway, waterway_to_all_nodes, waterway_to_nodes, waterway_to_river,
+                  river_to_waterways):
+        table.flush()
+
+    if geometry is not None:
+        geometry.waterway_to_geometry.flush()
+        with runner.stage("spatial_index", geometry.waterway_to_bbox) as stage:
+            stage.objects = build_index(geometry.waterway_to_bbox, DICT_DB_FOLDER)
+
+    with runner.stage("graph", waterway_to_nodes, waterway_to_river, river_to_waterways) as stage:
+        graph = Graph.build(waterway_to_nodes, waterway_to_river, river_to_waterways)
+        stage.objects = len(graph.waterway_ids)
 
-    # global confluences
     with open(CSV_FILE, "w") as csv:
-        confluence = ConfluenceHandler(node_to_waterways, waterway_to_nodes, csv, waterway_to_river, river_to_waterways)
-        print("Calculating global confluences")
-        for i, osm_file in enumerate(files):
-            print(f" {i + 1}/{len(files)}", end="\r")
-            confluence.apply_file(osm_file)
-
+        confluence = ConfluenceHandler(graph, csv)
+        with runner.stage("global_confluences", confluence.confluences, confluence.waterway_to_confluence) as stage:
+            confluence_ids = confluence.update(old_graph)
+            stage.objects = confluence.processed
+
+    with runner.stage("downstream_index") as stage:
+        graph.set_downstream_index(*downstream_index(graph))
+        stage.objects = len(graph.waterway_ids)
+
+    with runner.stage("local_confluences") as stage:
+        local_confluence_handler = LocalConfluenceHandler(graph, workers)
+        calculated = local_confluence_handler.update(old_graph, changed_ids | neighbours, changes.relations.keys())
+        print(f"Calculated the local confluences of {calculated} rivers")
+        stage.objects = calculated
+
+    with runner.stage("save") as stage:
+        graph.save(DICT_DB_FOLDER)
+        stage.objects = len(graph.waterway_ids)
+
+    # tiles only show the geometry and the confluence of a waterway
+    changed_ids |= set(confluence_ids) | moved_ids
+    with open(CHANGED_FILE, "w") as changed_file:
+        changed_file.writelines(f"{waterway_id}\n" for waterway_id in sorted(changed_ids))
+    print(f"{len(changed_ids)} changed waterways written to {CHANGED_FILE}")
 
-    # local confluences
-    local_confluence_handler = LocalConfluenceHandler(node_to_waterways, waterway_to_nodes, waterway_to_river, river_to_waterways)
-    print("Calculating local confluences")
-    for i, osm_file in enumerate(files):
-        print(f" {i + 1}/{len(files)}", end="\r")
-        local_confluence_handler.apply_file(osm_file)
-    river_to_local_confluence = local_confluence_handler.river_to_local_confluence
-
-    
     end = time.time()
-    print(f"Took {end - start} s for parsing data")
+    print(f"Took {end - start} s for updating data")
+    return runner.records
 
 
 if __name__ == "__main__":
-    write(False)
+    parser = argparse.ArgumentParser(description="Creates the .sqlite files and the graph snapshot from osm.pbf files")
+    parser.add_argument("folder", nargs="?", help="folder containing the osm.pbf files")
+    parser.add_argument("--incremental", action="store_true", help="also keep the tables needed by --update")
+    parser.add_argument("--update", nargs="+", metavar="CHANGE_FILE", help="apply osm change files (.osc) instead")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes reading the files and calculating local confluences")
+    parser.add_argument("--no-extract", action="store_true", help="read the full files instead of the waterway extracts")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"go on after the last finished stage of the previous run (see {MANIFEST_FILE})")
+    parser.add_argument("--stages", nargs="+", choices=WRITE_STAGES, metavar="STAGE",
+                        help=f"run only these stages: {', '.join(WRITE_STAGES)}")
+    args = parser.parse_args()
+    if args.update:
+        update(args.update, args.workers)
+    elif args.folder is None:
+        parser.error("the folder containing the osm.pbf files is required")
+    elif args.resume and args.stages:
+        parser.error("--resume and --stages can not be used together")
+    else:
+        write(args.incremental, args.workers, args.folder, not args.no_extract, args.resume, args.stages)
     # test()
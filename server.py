@@ -1,19 +1,38 @@
 from fastapi import FastAPI, responses, Header, HTTPException
-from relations import downstream, local_confluence
-from db_dict import dbdict
+from relations import downstream, local_confluence, graph_downstream, graph_local_confluence, indexed_downstream
+from relations import batch_downstream, batch_local_confluence, iter_downstream, iter_local_confluence
+from value_codecs import encode_deltas_array
+import numpy as np
+from db_dict import dbdict, exists
+from graph import Graph
+from spatial import SpatialIndex, decode_geometry
+from shapes import GeometryCache, MAX_ZOOM, MEDIA_TYPE as GEOJSON_MEDIA_TYPE
 from rivers import MAX
+from consts import COORDINATE_PRECISION
 import json
-from pymbtiles import MBtiles
+from tiles import TileReader, tile_headers, accepted_encodings, etag_matches
+from pmtiles import PMTilesReader
 from functools import lru_cache
-from datetime import datetime, timedelta
 from auth import TOTP_manager
 from typing_extensions import Annotated
-from typing import Union
+from typing import Union, List
+from pydantic import BaseModel
 from server_config import Config
+from metrics import ServerMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from pool import TraversalPool, PoolTimeout, PoolFull
+from result_cache import ResultCache, dataset_version, RESULT_CACHE_FILE
+import os.path
+import threading
 
 
 # http://127.0.0.1:8000/docs
 
+BATCH_KINDS = ["downstream", "local_confluence", "confluence"]
+MAX_BATCH_SIZE = 1000
+MAX_NEAREST = 100
+MAX_BBOX_WATERWAYS = 10000
+VARINT_MEDIA_TYPE = "application/x-varint-delta"
+
 app = FastAPI()
 
 
@@ -24,55 +43,263 @@ node_to_waterways = dbdict(config.dict_db_folder, "node_to_waterways", MAX, chec
 waterway_to_nodes = dbdict(config.dict_db_folder, "waterway_to_nodes", MAX, check_same_thread=False)
 waterway_to_river = dbdict(config.dict_db_folder, "waterway_to_river", MAX, check_same_thread=False)
 river_to_waterways = dbdict(config.dict_db_folder, "river_to_waterways", MAX, check_same_thread=False)
-river_to_local_confluence = dbdict(config.dict_db_folder, "river_to_local_confluence", MAX, check_same_thread=False)
+# only written by older versions of rivers.py, the traversal on the tables uses it if it is there
+river_to_local_confluence = None
+if exists(config.dict_db_folder, "river_to_local_confluence"):
+    river_to_local_confluence = dbdict(config.dict_db_folder, "river_to_local_confluence", MAX, check_same_thread=False)
 waterway_to_confluence = dbdict(config.dict_db_folder, "waterway_to_confluence", MAX, check_same_thread=False)
 
+# one read-only connection per thread, tiles are cached up to a size in bytes,
+# or slices of the memory mapped pmtiles archive
+if config.pmtiles_path is not None:
+    tile_reader = PMTilesReader(config.pmtiles_path, config.tile_cache_bytes)
+else:
+    tile_reader = TileReader(config.mbtiles_path, config.tile_cache_bytes)
+
+# traversals run on the compact graph if it was generated by rivers.py
+graph = Graph.load(config.dict_db_folder) if Graph.exists(config.dict_db_folder) else None
+
+# nearest waterway and bbox queries and geojson responses, if written by rivers.py
+spatial_index = SpatialIndex.load(config.dict_db_folder) if SpatialIndex.exists(config.dict_db_folder) else None
+waterway_to_geometry = None
+if exists(config.dict_db_folder, "waterway_to_geometry"):
+    waterway_to_geometry = dbdict(config.dict_db_folder, "waterway_to_geometry", MAX, check_same_thread=False)
+
+# traversals, geojson and batches run on a few threads of their own, concurrent identical
+# queries share a single run (see pool.py)
+traversal_pool = TraversalPool(config.traversal_threads, config.traversal_timeout, config.traversal_queue)
+
+# traversal results on disk, shared by the workers and kept over restarts (see result_cache.py),
+# None if disabled in the config
+result_cache = None
+if config.result_cache_bytes > 0:
+    result_cache = ResultCache(config.result_cache_path or os.path.join(config.dict_db_folder, RESULT_CACHE_FILE),
+                               dataset_version(config.dict_db_folder), config.result_cache_bytes)
+
+# None unless enabled in the config, the hot paths are only wrapped if it is set
+metrics = ServerMetrics() if config.metrics else None
+if metrics is not None:
+    metrics.collect_tables({table.name: table for table in (node_to_waterways, waterway_to_nodes, waterway_to_river,
+                                                            river_to_waterways, river_to_local_confluence,
+                                                            waterway_to_confluence, waterway_to_geometry)
+                           if table is not None})
+    metrics.collect_lru_cache("tile", tile_reader.stats)
+    metrics.collect_traversal_pool(traversal_pool.stats)
+    if result_cache is not None:
+        metrics.collect_lru_cache("result", result_cache.stats)
+    # the traversals on the tables count their lookups
+    node_to_waterways = metrics.counting_table(node_to_waterways)
+    waterway_to_nodes = metrics.counting_table(waterway_to_nodes)
+    waterway_to_river = metrics.counting_table(waterway_to_river)
+    river_to_waterways = metrics.counting_table(river_to_waterways)
+    if river_to_local_confluence is not None:
+        river_to_local_confluence = metrics.counting_table(river_to_local_confluence)
+
+
+def downstream_ids(waterway_id):
+    if not waterway_id.isdigit():
+        return []
+    # precomputed successors if available, otherwise walk the graph
+    if graph is not None and graph.down_next is not None:
+        return indexed_downstream(int(waterway_id), graph)
+    if graph is not None:
+        return graph_downstream(int(waterway_id), graph)
+    return downstream(int(waterway_id), node_to_waterways, waterway_to_nodes)
+
+
+def local_confluence_ids(waterway_id):
+    if not waterway_id.isdigit():
+        return []
+    if graph is not None:
+        return graph_local_confluence(int(waterway_id), graph)
+    return local_confluence(int(waterway_id), node_to_waterways,
+                            waterway_to_nodes, waterway_to_river, 
+                            river_to_waterways, river_to_local_confluence)
+
+
+if metrics is not None:
+    downstream_ids = metrics.traversal("downstream", downstream_ids, graph)
+    local_confluence_ids = metrics.traversal("local_confluence", local_confluence_ids, graph)
+
+
+def stored(kind, waterway_id, function):
+    # json of the ids, from the result cache if there is one
+    if result_cache is None:
+        return json.dumps(function(waterway_id))
+    return result_cache.cached(f"{kind}/{waterway_id}", lambda: json.dumps(function(waterway_id)))
+
 
 @lru_cache(maxsize=100)
 def cached_downstream(waterway_id):
-    if not waterway_id.isdigit():
-        return json.dumps([])
-    return json.dumps(downstream(int(waterway_id), node_to_waterways, waterway_to_nodes))
+    return stored("downstream", waterway_id, downstream_ids)
 
 
 @lru_cache(maxsize=100)
 def cached_local_confluence(waterway_id):
+    return stored("local_confluence", waterway_id, local_confluence_ids)
+
+
+ID_QUERIES = {"downstream": downstream_ids, "local_confluence": local_confluence_ids}
+CACHED_ID_QUERIES = {"downstream": cached_downstream, "local_confluence": cached_local_confluence}
+STREAMED_ID_QUERIES = {"downstream": iter_downstream, "local_confluence": iter_local_confluence}
+
+
+@lru_cache(maxsize=100)
+def cached_varint(kind, waterway_id):
+    # sorted ids, delta + zigzag + varint encoded (see value_codecs.decode_deltas)
+    waterway_ids = json.loads(CACHED_ID_QUERIES[kind](waterway_id))
+    return encode_deltas_array(np.sort(np.array(waterway_ids, dtype=np.int64)))
+
+
+def warm_up(count):
+    # the most requested queries of the earlier runs, if this is the first worker serving the dataset,
+    # one after the other on the traversal pool, shared with the requests for the same query
+    for key in result_cache.claim_warm_up(count):
+        kind, _, waterway_id = key.partition("/")
+        if kind in CACHED_ID_QUERIES:
+            try:
+                traversal_pool.submit((kind, waterway_id), CACHED_ID_QUERIES[kind], waterway_id).result()
+            except PoolFull:
+                # the requests come first, the rest is calculated when it is asked for
+                return
+
+
+def id_chunks(kind, waterway_id):
+    # lists of the ids in the order the traversal finds them, the tables are traversed at once
+    if graph is None:
+        yield ID_QUERIES[kind](waterway_id)
+        return
+    yield from STREAMED_ID_QUERIES[kind](int(waterway_id), graph)
+
+
+async def stream_json(first, chunks):
+    # json array written while the traversal is running, a timeout after the first chunk
+    # can only abort the response
+    yield "["
+    separator = ""
+    if len(first):
+        yield ",".join(map(str, first))
+        separator = ","
+    async for chunk in chunks:
+        if len(chunk):
+            yield separator + ",".join(map(str, chunk))
+            separator = ","
+    yield "]"
+
+
+def waterway_geometry(waterway_id):
+    values = waterway_to_geometry.get(waterway_id)
+    return None if values is None else decode_geometry(values)
+
+
+def river_id(waterway_id):
+    # None if the waterway is not part of a river relation
+    if graph is not None:
+        index = graph.waterway_index(waterway_id)
+        if index < 0 or graph.ww_river[index] < 0:
+            return None
+        return int(graph.river_ids[graph.ww_river[index]])
+    return waterway_to_river.get(waterway_id)
+
+
+def river_members(river_id):
+    if graph is not None:
+        river = graph.river_index(river_id)
+        return [] if river < 0 else graph.to_osm_ids(graph.river_waterways(river))
+    return river_to_waterways.get(river_id, [])
+
+
+geometry_cache = None
+if waterway_to_geometry is not None:
+    geometry_cache = GeometryCache(waterway_to_geometry, river_id, river_members, config.geometry_cache_bytes)
+    if metrics is not None:
+        metrics.collect_lru_cache("geometry", geometry_cache.stats)
+
+
+def geojson(kind, waterway_id, zoom):
+    waterway_ids = json.loads(CACHED_ID_QUERIES[kind](waterway_id))
+    return geometry_cache.feature_collection(waterway_ids, zoom)
+
+
+def pool_error(error):
+    if isinstance(error, PoolTimeout):
+        return HTTPException(status_code=504, detail="The query took too long, try again later")
+    return HTTPException(status_code=503, detail="Too many queries, try again later")
+
+
+async def pooled(key, function, *args):
+    # function(*args) on the traversal pool, shared with the identical queries running already
+    try:
+        return await traversal_pool.run(key, function, *args)
+    except (PoolTimeout, PoolFull) as error:
+        raise pool_error(error)
+
+
+async def stream_response(kind, waterway_id):
+    # the chunks are read on the traversal pool, the stream holds one of its slots until it is sent
     if not waterway_id.isdigit():
-        return json.dumps([])
-    return json.dumps(local_confluence(int(waterway_id), node_to_waterways,
-                                        waterway_to_nodes, waterway_to_river, 
-                                        river_to_waterways, river_to_local_confluence))
+        return responses.Response(content="[]", media_type="application/json")
+    chunks = traversal_pool.iterate(id_chunks(kind, waterway_id))
+    # awaited before the response is started, so a full pool or a timeout is still an error status
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        return responses.Response(content="[]", media_type="application/json")
+    except (PoolTimeout, PoolFull) as error:
+        raise pool_error(error)
+    return responses.StreamingResponse(stream_json(first, chunks), media_type="application/json")
+
+
+async def id_list_response(kind, waterway_id, response_format, accept, zoom=None):
+    # response_format: json (default, a json encoded string), varint (binary), stream (chunked json array,
+    # not a string, see the README) or geojson (the simplified geometry for the zoom)
+    if result_cache is not None and waterway_id.isdigit():
+        result_cache.count(f"{kind}/{waterway_id}")
+    if response_format is None:
+        response_format = "json"
+        if accept is not None and VARINT_MEDIA_TYPE in accept:
+            response_format = "varint"
+        elif accept is not None and GEOJSON_MEDIA_TYPE in accept:
+            response_format = "geojson"
+    if response_format == "json":
+        return await pooled((kind, waterway_id), CACHED_ID_QUERIES[kind], waterway_id)
+    if response_format == "varint":
+        content = await pooled((kind, waterway_id, response_format), cached_varint, kind, waterway_id)
+        return responses.Response(content=content, media_type=VARINT_MEDIA_TYPE)
+    if response_format == "stream":
+        return await stream_response(kind, waterway_id)
+    if response_format == "geojson":
+        if geometry_cache is None:
+            raise HTTPException(status_code=404, detail="There is no waterway geometry, it is written by rivers.py")
+        zoom = MAX_ZOOM if zoom is None else zoom
+        content = await pooled((kind, waterway_id, response_format, zoom), geojson, kind, waterway_id, zoom)
+        return responses.Response(content=content, media_type=GEOJSON_MEDIA_TYPE)
+    raise HTTPException(status_code=400, detail="Unknown format, available: json, varint, stream, geojson")
+
 
 @lru_cache(maxsize=100)
 def cached_confluence(waterway_id):
     if not waterway_id.isdigit():
         return json.dumps([])
+    if graph is not None and graph.ww_confluence is not None:
+        index = graph.waterway_index(int(waterway_id))
+        if index < 0:
+            return json.dumps([])
+        return int(graph.ww_confluence[index])
     if not int(waterway_id) in waterway_to_confluence:
         return json.dumps([])
     return waterway_to_confluence[int(waterway_id)]
 
 
-@lru_cache(maxsize=1000)
-def cached_data(z, x, y):
+def read_data(z, x, y, accepted):
     if not z.isdigit() or not x.isdigit() or not y.isdigit():
         return None
     
     if int(z) == 0:
         z = '1'
-    elif int(z) > 14:
-        z == '14'
-
-    inverted_y = str(2**int(z) - 1 - int(y))
-    with MBtiles(config.mbtiles_path) as src:
-        tile_data = src.read_tile(z, x, inverted_y)
-    if tile_data is None:
-        return None
 
-    expires_datetime = datetime.utcnow() + timedelta(days=7)
-    expires_str = expires_datetime.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    headers = {"Content-Encoding": "gzip", "Access-Control-Allow-Origin": "*", "Expires": expires_str}
-
-    return responses.Response(content=tile_data, media_type="application/x-protobuf", headers=headers)
+    inverted_y = 2**int(z) - 1 - int(y)
+    return tile_reader.read_tile(int(z), int(x), inverted_y, accepted)
 
 
 @lru_cache(maxsize=1)
@@ -82,18 +309,27 @@ def cached_style():
     return json_file
 
 
+if metrics is not None:
+    metrics.collect_lru_caches({"downstream": cached_downstream, "local_confluence": cached_local_confluence,
+                                "varint": cached_varint, "confluence": cached_confluence})
+
+
 @app.get("/downstream/{waterway_id}")
-def get_downstream(waterway_id, totp_token: Annotated[Union[str, None], Header()] = None):
+async def get_downstream(waterway_id, format: Union[str, None] = None, zoom: Union[int, None] = None,
+                   totp_token: Annotated[Union[str, None], Header()] = None,
+                   accept: Annotated[Union[str, None], Header()] = None):
     if not totp_manager.verify(totp_token):
         raise HTTPException(status_code=401, detail="Invalid or missing TOTP token")
-    return cached_downstream(waterway_id)
+    return await id_list_response("downstream", waterway_id, format, accept, zoom)
 
 
 @app.get("/local_confluence/{waterway_id}")
-def get_local_confluence(waterway_id, totp_token: Annotated[Union[str, None], Header()] = None):
+async def get_local_confluence(waterway_id, format: Union[str, None] = None, zoom: Union[int, None] = None,
+                         totp_token: Annotated[Union[str, None], Header()] = None,
+                         accept: Annotated[Union[str, None], Header()] = None):
     if not totp_manager.verify(totp_token):
         raise HTTPException(status_code=401, detail="Invalid or missing TOTP token")
-    return cached_local_confluence(waterway_id)
+    return await id_list_response("local_confluence", waterway_id, format, accept, zoom)
 
 
 @app.get("/confluence/{waterway_id}")
@@ -103,11 +339,154 @@ def get_confluence(waterway_id, totp_token: Annotated[Union[str, None], Header()
     return cached_confluence(waterway_id)
 
 
+class BatchQuery(BaseModel):
+    waterway_ids: List[int]
+    kinds: List[str] = BATCH_KINDS
+
+
+def confluence_id(waterway_id):
+    # cached_confluence returns an empty json list for unknown waterways
+    value = cached_confluence(str(waterway_id))
+    return None if isinstance(value, str) else value
+
+
+def batch(waterway_ids, kinds):
+    result = dict()
+    if "downstream" in kinds:
+        if graph is not None:
+            result["downstream"] = batch_downstream(waterway_ids, graph)
+        else:
+            result["downstream"] = {w: json.loads(cached_downstream(str(w))) for w in waterway_ids}
+    if "local_confluence" in kinds:
+        if graph is not None:
+            result["local_confluence"] = batch_local_confluence(waterway_ids, graph)
+        else:
+            result["local_confluence"] = {w: json.loads(cached_local_confluence(str(w))) for w in waterway_ids}
+    if "confluence" in kinds:
+        result["confluence"] = {w: confluence_id(w) for w in waterway_ids}
+    return result
+
+
+@app.post("/batch")
+async def post_batch(query: BatchQuery, totp_token: Annotated[Union[str, None], Header()] = None):
+    # answers all the kinds of queries for all the waterways in a single request
+    if not totp_manager.verify(totp_token):
+        raise HTTPException(status_code=401, detail="Invalid or missing TOTP token")
+    if len(query.waterway_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_SIZE} waterways per batch")
+    for kind in query.kinds:
+        if kind not in BATCH_KINDS:
+            raise HTTPException(status_code=400, detail=f"Unknown kind {kind}, available: {', '.join(BATCH_KINDS)}")
+    waterway_ids = list(dict.fromkeys(query.waterway_ids))
+    kinds = tuple(dict.fromkeys(query.kinds))
+    return await pooled(("batch", tuple(waterway_ids), kinds), batch, waterway_ids, kinds)
+
+
+def fixed_point(value):
+    return round(value * COORDINATE_PRECISION)
+
+
+def check_spatial_index():
+    if spatial_index is None:
+        raise HTTPException(status_code=404, detail="There is no spatial index, it is written by rivers.py")
+
+
+@app.get("/nearest")
+def get_nearest(lon: float, lat: float, count: int = 1, max_distance: Union[float, None] = None,
+                totp_token: Annotated[Union[str, None], Header()] = None):
+    # the count waterways closest to the point, max_distance in meters
+    if not totp_manager.verify(totp_token):
+        raise HTTPException(status_code=401, detail="Invalid or missing TOTP token")
+    check_spatial_index()
+    if not -180 <= lon <= 180 or not -90 <= lat <= 90:
+        raise HTTPException(status_code=400, detail="lon has to be in [-180, 180] and lat in [-90, 90]")
+    if not 1 <= count <= MAX_NEAREST:
+        raise HTTPException(status_code=400, detail=f"count has to be between 1 and {MAX_NEAREST}")
+    nearest = spatial_index.nearest(fixed_point(lon), fixed_point(lat), waterway_geometry, count, max_distance)
+    return [{"waterway_id": waterway_id, "river_id": river_id(waterway_id), "distance": round(distance, 1)}
+            for waterway_id, distance in nearest]
+
+
+@app.get("/waterways")
+def get_waterways(bbox: str, limit: int = MAX_BBOX_WATERWAYS,
+                  totp_token: Annotated[Union[str, None], Header()] = None):
+    # waterways whose bounding box intersects bbox=min_lon,min_lat,max_lon,max_lat
+    if not totp_manager.verify(totp_token):
+        raise HTTPException(status_code=401, detail="Invalid or missing TOTP token")
+    check_spatial_index()
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox has to be min_lon,min_lat,max_lon,max_lat")
+    if not 1 <= limit <= MAX_BBOX_WATERWAYS:
+        raise HTTPException(status_code=400, detail=f"limit has to be between 1 and {MAX_BBOX_WATERWAYS}")
+    if not -180 <= min_lon <= 180 or not -180 <= max_lon <= 180 or not -90 <= min_lat <= max_lat <= 90:
+        raise HTTPException(status_code=400, detail="lon has to be in [-180, 180], lat in [-90, 90] and min_lat <= max_lat")
+    # a box with min_lon > max_lon crosses the antimeridian, it is split at 180
+    if min_lon <= max_lon:
+        boxes = [(min_lon, min_lat, max_lon, max_lat)]
+    else:
+        boxes = [(min_lon, min_lat, 180, max_lat), (-180, min_lat, max_lon, max_lat)]
+    # a waterway can be in both halves
+    waterway_ids = dict()
+    for box in boxes:
+        found = spatial_index.intersecting([fixed_point(value) for value in box], limit + 1 - len(waterway_ids))
+        waterway_ids.update(dict.fromkeys(found))
+        if len(waterway_ids) > limit:
+            break
+    waterway_ids = list(waterway_ids)
+    return {"waterway_ids": waterway_ids[:limit], "truncated": len(waterway_ids) > limit}
+
+
+class TileResponse(responses.Response):
+    # the tile data can be a memoryview of the pmtiles archive, it is sent without a copy
+
+    def render(self, content):
+        return content
+
+
 @app.get("/data/{z}/{x}/{y}.pbf")
-def get_data(z, x, y, totp_token: Annotated[Union[str, None], Header()] = None):
+def get_data(z, x, y, totp_token: Annotated[Union[str, None], Header()] = None,
+             if_none_match: Annotated[Union[str, None], Header()] = None,
+             accept_encoding: Annotated[Union[str, None], Header()] = None):
     if not totp_manager.verify(totp_token):
         raise HTTPException(status_code=401, detail="Invalid or missing TOTP token")
-    return cached_data(z, x, y)    
+    tile = read_data(z, x, y, accepted_encodings(accept_encoding))
+    if tile is None:
+        return None
+    tile_data, etag, encoding = tile
+    headers = tile_headers(encoding, etag)
+    if etag_matches(if_none_match, etag):
+        headers.pop("Content-Encoding", None)
+        return responses.Response(status_code=304, headers=headers)
+    return TileResponse(content=tile_data, media_type="application/x-protobuf", headers=headers)
+
+
+@app.get("/stats")
+def get_stats(totp_token: Annotated[Union[str, None], Header()] = None):
+    if not totp_manager.verify(totp_token):
+        raise HTTPException(status_code=401, detail="Invalid or missing TOTP token")
+    stats = {"tiles": tile_reader.stats()}
+    if geometry_cache is not None:
+        stats["geometry"] = geometry_cache.stats()
+    stats["traversals"] = traversal_pool.stats()
+    if result_cache is not None:
+        stats["results"] = result_cache.stats()
+    return stats
+
+
+@app.on_event("startup")
+def start_warm_up():
+    # also deletes the results of older datasets, even if nothing is warmed up
+    if result_cache is not None:
+        threading.Thread(target=warm_up, args=(config.warm_up_count,), daemon=True).start()
+
+
+@app.on_event("shutdown")
+def close_result_cache():
+    # writes the counts of the last queries
+    if result_cache is not None:
+        result_cache.close()
 
 
 @app.get("/styles/style.json")
@@ -117,6 +496,15 @@ def get_json_style(totp_token: Annotated[Union[str, None], Header()] = None):
     return cached_style()
 
 
+# not behind TOTP, so Prometheus can scrape it, only served if enabled in the config
+if metrics is not None:
+    @app.get("/metrics")
+    def get_metrics():
+        return responses.Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+    metrics.instrument_app(app)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("server:app", host="0.0.0.0", reload=True, workers=8, port=config.port)
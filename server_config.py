@@ -27,14 +27,36 @@ class Config:
         
         required_config_file_fields = ["secret", "mbtiles_path", "port", "style_path", "dict_db_folder"]
         for field in required_config_file_fields:
+            # the mbtiles are not needed if the tiles are served from a pmtiles archive
+            if field == "mbtiles_path" and "pmtiles_path" in contents:
+                continue
             if field not in contents:
                 self.wrong_config_file_format()
         
         self.secret = contents["secret"]
-        self.mbtiles_path = contents["mbtiles_path"]
+        self.mbtiles_path = contents.get("mbtiles_path")
         self.port = contents["port"]
         self.style_path = contents["style_path"]
         self.dict_db_folder = contents["dict_db_folder"]
+        # optional fields
+        self.tile_cache_bytes = contents.get("tile_cache_bytes", 256 * 1024 * 1024)
+        # simplified waterway geometry of the geojson responses (see shapes.py)
+        self.geometry_cache_bytes = contents.get("geometry_cache_bytes", 64 * 1024 * 1024)
+        # threads of the traversals of every worker and seconds a request waits for its traversal (see pool.py)
+        self.traversal_threads = contents.get("traversal_threads", 4)
+        self.traversal_timeout = contents.get("traversal_timeout", 30)
+        # queued and running traversals of every worker, more are answered with a 503
+        self.traversal_queue = contents.get("traversal_queue", 64)
+        # traversal results shared by the workers on disk (see result_cache.py), 0 disables it,
+        # stored in the dict_db_folder unless a path is given
+        self.result_cache_bytes = contents.get("result_cache_bytes", 1024 * 1024 * 1024)
+        self.result_cache_path = contents.get("result_cache_path")
+        # most requested queries calculated when a new dataset is served
+        self.warm_up_count = contents.get("warm_up_count", 1000)
+        # tiles are read from this archive instead of the mbtiles (see pmtiles.py)
+        self.pmtiles_path = contents.get("pmtiles_path")
+        # Prometheus metrics on /metrics (see metrics.py)
+        self.metrics = contents.get("metrics", False)
     
 
     def wrong_config_file_format(self):
@@ -0,0 +1,130 @@
+import json
+import numpy as np
+from cache import LRUCache
+from spatial import decode_geometry
+from consts import *
+
+# Merged geometry of a set of waterways (a downstream or a local confluence) as GeoJSON,
+# so a client can show a whole basin without loading the tiles it lies in.
+#
+# The waterways are grouped by their river relation, every river is a MultiLineString
+# feature, waterways without a river are a feature of their own. The lines are simplified
+# with Douglas-Peucker for the requested zoom and cached per (river, zoom): the cached
+# entry holds every member of the river, so all the results that touch a river share it,
+# no matter which part of the river they contain.
+
+TILE_SIZE = 256
+# simplification tolerance in pixels of the zoom
+PIXEL_TOLERANCE = 0.5
+MAX_ZOOM = 14
+MEDIA_TYPE = "application/geo+json"
+
+
+def tolerance(zoom):
+    # fixed point coordinate units of PIXEL_TOLERANCE at the zoom (along the equator)
+    return 360 / (TILE_SIZE * 2 ** zoom) * PIXEL_TOLERANCE * COORDINATE_PRECISION
+
+
+def simplify(xs, ys, tolerance):
+    # Douglas-Peucker on the plain coordinates, indices of the points that are kept
+    # (always the first and the last one)
+    if len(xs) <= 2:
+        return np.arange(len(xs))
+    xs = xs.astype(np.float64)
+    ys = ys.astype(np.float64)
+    keep = np.zeros(len(xs), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xs) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = xs[end] - xs[start], ys[end] - ys[start]
+        px, py = xs[start + 1:end] - xs[start], ys[start + 1:end] - ys[start]
+        length = np.hypot(dx, dy)
+        if length > 0:
+            distances = np.abs(px * dy - py * dx) / length
+        else:
+            distances = np.hypot(px, py)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+    return np.flatnonzero(keep)
+
+
+def line_json(xs, ys):
+    # json array of [lon, lat] pairs
+    return json.dumps([[x / COORDINATE_PRECISION, y / COORDINATE_PRECISION] for x, y in zip(xs.tolist(), ys.tolist())],
+                      separators=(",", ":"))
+
+
+def lines_size(lines):
+    return sum(len(line) for line in lines.values()) + 100 * len(lines)
+
+
+class GeometryCache():
+    # waterway_to_geometry: dbdict written by rivers.py (see spatial.encode_geometry)
+    # river_of: function(waterway_id) -> river_id, None if the waterway is not part of a river
+    # river_members: function(river_id) -> ids of the member waterways of the river
+
+    def __init__(self, waterway_to_geometry, river_of, river_members, cache_bytes):
+        self.waterway_to_geometry = waterway_to_geometry
+        self.river_of = river_of
+        self.river_members = river_members
+        # key=(river_id, zoom) or (None, waterway_id, zoom), value=dict(waterway_id -> json line)
+        self.cache = LRUCache(cache_bytes, sizeof=lines_size)
+
+
+    def simplified(self, waterway_ids, zoom):
+        lines = dict()
+        for waterway_id in waterway_ids:
+            values = self.waterway_to_geometry.get(waterway_id)
+            if values is None:
+                continue
+            xs, ys = decode_geometry(values)
+            kept = simplify(xs, ys, tolerance(zoom))
+            lines[waterway_id] = line_json(xs[kept], ys[kept])
+        return lines
+
+
+    def lines(self, key, waterway_ids, zoom):
+        lines = self.cache.get(key)
+        if lines is None:
+            lines = self.simplified(waterway_ids, zoom)
+            self.cache.put(key, lines)
+        return lines
+
+
+    def feature_collection(self, waterway_ids, zoom):
+        # GeoJSON text of the waterways, a feature per river
+        zoom = max(0, min(MAX_ZOOM, zoom))
+        # key=river_id (None for the waterways without one), value=list(waterway_ids)
+        rivers = dict()
+        for waterway_id in waterway_ids:
+            rivers.setdefault(self.river_of(waterway_id), []).append(waterway_id)
+        features = []
+        for river_id, members in rivers.items():
+            if river_id is None:
+                for waterway_id in members:
+                    lines = self.lines((None, waterway_id, zoom), [waterway_id], zoom)
+                    if waterway_id in lines:
+                        features.append(self.feature(None, [lines[waterway_id]]))
+                continue
+            lines = self.lines((river_id, zoom), self.river_members(river_id), zoom)
+            parts = [lines[waterway_id] for waterway_id in members if waterway_id in lines]
+            if parts:
+                features.append(self.feature(river_id, parts))
+        return '{"type":"FeatureCollection","features":[' + ",".join(features) + "]}"
+
+
+    @staticmethod
+    def feature(river_id, parts):
+        return ('{"type":"Feature","properties":{"river_id":' + json.dumps(river_id) + '},'
+                '"geometry":{"type":"MultiLineString","coordinates":[' + ",".join(parts) + "]}}")
+
+
+    def stats(self):
+        return self.cache.stats()
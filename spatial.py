@@ -0,0 +1,220 @@
+import os, os.path
+import math
+import heapq
+import numpy as np
+from graph import save_arrays, load_arrays
+from consts import *
+
+# Spatial index over the waterways, answers which waterways are near a point or inside a box
+# without knowing their ids.
+#
+# rivers.py stores the geometry of every waterway (the coordinates of all its nodes) and its
+# bounding box while it reads the files. The boxes are bulk loaded into a packed R-tree:
+# the items are sorted by Sort-Tile-Recursive (vertical slices by the x of their center, each
+# slice by the y), every NODE_SIZE consecutive items get a parent node and the levels above
+# group NODE_SIZE consecutive nodes of the level below, until a single root is left. The
+# children of node i are the entries [i * NODE_SIZE, (i + 1) * NODE_SIZE) of the level below,
+# so the tree is just the boxes of every level and needs no pointers.
+#
+# Coordinates are osmium fixed point integers (COORDINATE_PRECISION), the boxes are int32.
+# Distances are measured in an equirectangular projection around the query point, which is
+# exact enough for the distances to a nearby river. Longitudes are taken around the query
+# point, so the antimeridian does not separate the waterways on its two sides.
+
+INDEX_FILE = "waterways.rtree"
+INDEX_MAGIC = b"WRRTREE1"
+NODE_SIZE = 16
+METERS_PER_DEGREE = 111319.49
+# 360 degrees in fixed point
+FULL_TURN = 360 * COORDINATE_PRECISION
+
+
+def encode_geometry(xs, ys):
+    # stored as [x_1, ..., x_n, y_1, ..., y_n], the deltas of the varint codec stay small
+    return list(xs) + list(ys)
+
+
+def decode_geometry(values):
+    # (xs, ys) as int64 arrays
+    values = np.array(values, dtype=np.int64)
+    half = len(values) // 2
+    return values[:half], values[half:]
+
+
+def bounding_box(xs, ys):
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def str_order(boxes):
+    # Sort-Tile-Recursive order of the boxes
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    center_x = boxes[:, 0].astype(np.int64) + boxes[:, 2]
+    center_y = boxes[:, 1].astype(np.int64) + boxes[:, 3]
+    leaves = math.ceil(len(boxes) / NODE_SIZE)
+    slice_size = math.ceil(math.sqrt(leaves)) * NODE_SIZE
+    by_x = np.argsort(center_x, kind="stable")
+    slices = np.empty(len(boxes), dtype=np.int64)
+    slices[by_x] = np.arange(len(boxes)) // slice_size
+    return np.lexsort((center_y, slices))
+
+
+def parent_boxes(boxes):
+    starts = np.arange(0, len(boxes), NODE_SIZE)
+    return np.stack([np.minimum.reduceat(boxes[:, 0], starts), np.minimum.reduceat(boxes[:, 1], starts),
+                     np.maximum.reduceat(boxes[:, 2], starts), np.maximum.reduceat(boxes[:, 3], starts)], axis=1)
+
+
+def build_index(waterway_to_bbox, folder):
+    # writes the index of all the boxes of the table to folder, returns the number of waterways
+    ids = []
+    boxes = []
+    for waterway_id, box in waterway_to_bbox.items():
+        ids.append(waterway_id)
+        boxes.append(box)
+    ids = np.array(ids, dtype=np.int64)
+    boxes = np.array(boxes, dtype=np.int32).reshape(-1, 4)
+    order = str_order(boxes)
+    arrays = {"waterway_ids": ids[order], "boxes": boxes[order]}
+    # node levels from the leaves up to the root, concatenated
+    levels = []
+    level = arrays["boxes"]
+    while len(level) > 1:
+        level = parent_boxes(level)
+        levels.append(level)
+    arrays["level_ptr"] = np.cumsum([0] + [len(level) for level in levels]).astype(np.int64)
+    arrays["node_boxes"] = np.concatenate(levels) if levels else np.empty((0, 4), dtype=np.int32)
+    save_arrays(os.path.join(folder, INDEX_FILE), arrays, INDEX_MAGIC)
+    return len(ids)
+
+
+def scales(y):
+    # meters per fixed point unit along x and y at the latitude y
+    scale = METERS_PER_DEGREE / COORDINATE_PRECISION
+    return scale * math.cos(math.radians(y / COORDINATE_PRECISION)), scale
+
+
+def wrap(dxs):
+    # longitude differences folded into [-180, 180) degrees
+    return (dxs + FULL_TURN // 2) % FULL_TURN - FULL_TURN // 2
+
+
+def project(xs, ys, x, y):
+    # fixed point coordinates of a line to meters around (x, y), the first point is taken
+    # around x and the others follow it, so the line stays continuous across any fold
+    x_scale, y_scale = scales(y)
+    dxs = wrap(xs[:1] - x) + np.concatenate([[0], np.cumsum(wrap(np.diff(xs)))])
+    return dxs * x_scale, (ys - y) * y_scale
+
+
+def line_distance(xs, ys, x, y):
+    # distance in meters from (x, y) to the line through the points, all fixed point
+    pxs, pys = project(xs.astype(np.float64), ys.astype(np.float64), x, y)
+    if len(pxs) == 1:
+        return float(math.hypot(pxs[0], pys[0]))
+    ax, ay, dx, dy = pxs[:-1], pys[:-1], np.diff(pxs), np.diff(pys)
+    lengths = dx * dx + dy * dy
+    # position of the closest point on every segment, 0 at its start and 1 at its end
+    t = np.clip(-(ax * dx + ay * dy) / np.where(lengths > 0, lengths, 1), 0, 1)
+    return float(np.sqrt((ax + t * dx) ** 2 + (ay + t * dy) ** 2).min())
+
+
+class SpatialIndex():
+
+    def __init__(self, arrays):
+        # leaf items in STR order
+        self.waterway_ids = arrays["waterway_ids"]
+        self.boxes = arrays["boxes"]
+        # boxes of the nodes, node_boxes[level_ptr[l]:level_ptr[l + 1]] is the l-th level above the items
+        self.level_ptr = arrays["level_ptr"]
+        self.node_boxes = arrays["node_boxes"]
+        # levels[0] are the items, levels[-1] the root
+        self.levels = [self.boxes] + [self.node_boxes[start:end]
+                                      for start, end in zip(self.level_ptr[:-1], self.level_ptr[1:])]
+
+
+    @staticmethod
+    def exists(folder):
+        return os.path.isfile(os.path.join(folder, INDEX_FILE))
+
+
+    @classmethod
+    def load(cls, folder):
+        # memory mapped like the graph, all the server workers share it
+        return cls(load_arrays(os.path.join(folder, INDEX_FILE), INDEX_MAGIC))
+
+
+    def __len__(self):
+        return len(self.waterway_ids)
+
+
+    def children(self, level, nodes):
+        # entries of level - 1 below the nodes of level
+        children = (nodes[:, None] * NODE_SIZE + np.arange(NODE_SIZE)).ravel()
+        return children[children < len(self.levels[level - 1])]
+
+
+    def intersecting(self, box, limit=None):
+        # ids of the waterways whose bounding box intersects box (min_x, min_y, max_x, max_y),
+        # at most limit of them, level by level from the root
+        if not len(self.waterway_ids):
+            return []
+        level = len(self.levels) - 1
+        entries = np.arange(len(self.levels[level]))
+        while True:
+            boxes = self.levels[level][entries]
+            hits = ((boxes[:, 0] <= box[2]) & (boxes[:, 2] >= box[0]) &
+                    (boxes[:, 1] <= box[3]) & (boxes[:, 3] >= box[1]))
+            entries = entries[hits]
+            if level == 0 or not len(entries):
+                break
+            entries = self.children(level, entries)
+            level -= 1
+        if level != 0:
+            return []
+        if limit is not None:
+            entries = entries[:limit]
+        return self.waterway_ids[entries].tolist()
+
+
+    def box_distances(self, boxes, x, y):
+        # lower bounds of the distances in meters from (x, y) to the boxes
+        boxes = boxes.astype(np.int64)
+        # the closest of the point and its copies a turn east and west
+        dx = np.min([np.maximum(np.maximum(boxes[:, 0] - shifted, shifted - boxes[:, 2]), 0)
+                     for shifted in (x, x - FULL_TURN, x + FULL_TURN)], axis=0)
+        dy = np.maximum(np.maximum(boxes[:, 1] - y, y - boxes[:, 3]), 0)
+        x_scale, y_scale = scales(y)
+        return np.hypot(dx * x_scale, dy * y_scale)
+
+
+    def nearest(self, x, y, geometry, count=1, max_distance=None):
+        # [(waterway_id, distance in meters)] of the count waterways closest to (x, y), best first
+        # geometry: function(waterway_id) -> (xs, ys) of the waterway, None if unknown
+        # the boxes are searched best first, the geometry is only read for boxes closer
+        # than the waterways already found
+        if not len(self.waterway_ids):
+            return []
+        # (distance, kind, level, entry), kind 0 is a waterway with its exact distance,
+        # kind 1 an entry of a level with the distance to its box
+        level = len(self.levels) - 1
+        queue = [(float(distance), 1, level, entry)
+                 for entry, distance in enumerate(self.box_distances(self.levels[level], x, y).tolist())]
+        heapq.heapify(queue)
+        result = []
+        while queue and len(result) < count:
+            distance, kind, level, entry = heapq.heappop(queue)
+            if max_distance is not None and distance > max_distance:
+                break
+            if kind == 0:
+                result.append((int(self.waterway_ids[entry]), distance))
+            elif level == 0:
+                coordinates = geometry(int(self.waterway_ids[entry]))
+                if coordinates is not None and len(coordinates[0]):
+                    heapq.heappush(queue, (line_distance(*coordinates, x, y), 0, 0, entry))
+            else:
+                children = self.children(level, np.array([entry]))
+                distances = self.box_distances(self.levels[level - 1][children], x, y)
+                for child, child_distance in zip(children.tolist(), distances.tolist()):
+                    heapq.heappush(queue, (child_distance, 1, level - 1, child))
+        return result
@@ -0,0 +1,143 @@
+import os, os.path
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+from consts import *
+
+# Stage runner of rivers.py. Every stage records its wall time, the peak memory, the number
+# of objects it processed and the reads, writes and flushes of the dbdict tables it used.
+# The finished stages of a run are written to a manifest (see MANIFEST_FILE), so a run
+# that died can go on after its last finished stage, or only some stages can be run again.
+
+MANIFEST_VERSION = 1
+
+
+def peak_rss():
+    # (peak resident set size of this process, largest peak of its finished child processes) in bytes
+    # the child processes are the pools of the stages, they are waited for when a pool is closed
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own, children
+
+
+class Stage():
+    # handed to the body of a stage, which counts its objects and adds the tables it opens
+
+    def __init__(self, name, tables):
+        self.name = name
+        self.objects = 0
+        # key=table, value=stats of the table when the stage started using it
+        self.tables = dict()
+        self.track(*tables)
+
+
+    def track(self, *tables):
+        for table in tables:
+            if table is not None and table not in self.tables:
+                self.tables[table] = table.stats()
+
+
+    def table_stats(self):
+        # reads, writes and flushes per table name, tables with the same name are summed
+        stats = dict()
+        for table, start in self.tables.items():
+            end = table.stats()
+            counts = stats.setdefault(table.name, {"reads": 0, "writes": 0, "flushes": 0})
+            # point queries and rows of whole table scans
+            counts["reads"] += end["queries"] + end["scanned"] - start["queries"] - start["scanned"]
+            counts["writes"] += end["writes"] - start["writes"]
+            counts["flushes"] += end["flushes"] - start["flushes"]
+        return stats
+
+
+class StageRunner():
+    # stages: names of all the stages of the run, in order
+    # params: arguments of the run, a run can only resume the manifest of a run with the same params
+    # resume: skip the stages up to the last finished stage of the manifest
+    # only: run only these stages (the manifest still has to match the params)
+    # manifest_path: None keeps the records in memory only
+
+    def __init__(self, stages, params=None, resume=False, only=None, manifest_path=MANIFEST_FILE):
+        self.stages = list(stages)
+        self.params = params or dict()
+        self.only = None if only is None else set(only)
+        self.manifest_path = manifest_path
+        unknown = (self.only or set()) - set(self.stages)
+        if unknown:
+            raise ValueError(f"unknown stages: {', '.join(sorted(unknown))}, the stages are: {', '.join(self.stages)}")
+        # stage records of this run
+        self.records = []
+
+        self.manifest = {"version": MANIFEST_VERSION, "params": self.params, "stages": []}
+        if manifest_path is not None and (resume or self.only is not None):
+            manifest = self.load()
+            if manifest is None and resume:
+                raise ValueError(f"{manifest_path} does not exist, there is no run to resume")
+            if manifest is not None:
+                if manifest.get("version") != MANIFEST_VERSION or manifest.get("params") != self.params:
+                    raise ValueError(f"{manifest_path} was written by a run with other arguments: "
+                                     f"{json.dumps(manifest.get('params'))}")
+                self.manifest = manifest
+
+        self.first = 0
+        if resume:
+            finished = self.finished()
+            # after the last finished stage, even if a stage before it was run again since
+            self.first = max((self.stages.index(name) + 1 for name in finished if name in self.stages), default=0)
+
+
+    def load(self):
+        if not os.path.isfile(self.manifest_path):
+            return None
+        with open(self.manifest_path) as file:
+            return json.load(file)
+
+
+    def save(self):
+        if self.manifest_path is None:
+            return
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+
+    def finished(self):
+        return [record["name"] for record in self.manifest["stages"]]
+
+
+    def should_run(self, name):
+        if self.only is not None:
+            return name in self.only
+        return self.stages.index(name) >= self.first
+
+
+    @contextmanager
+    def stage(self, name, *tables):
+        # times the body, the record is only written if the body finished
+        print(name)
+        record = Stage(name, tables)
+        start = time.time()
+        yield record
+        seconds = time.time() - start
+        rss, children_rss = peak_rss()
+        entry = {
+            "name": name,
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seconds": seconds,
+            "peak_rss": rss,
+            "children_peak_rss": children_rss,
+            "objects": record.objects,
+            "tables": record.table_stats(),
+        }
+        self.records.append(entry)
+        # the later stages used the output of the earlier run of this stage
+        if name in self.stages:
+            later = set(self.stages[self.stages.index(name):])
+            self.manifest["stages"] = [old for old in self.manifest["stages"] if old["name"] not in later]
+        self.manifest["stages"].append(entry)
+        self.save()
+        print(f"{name} took {seconds:.2f} s, peak memory {rss / (1 << 20):.0f} MiB")
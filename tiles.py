@@ -0,0 +1,217 @@
+import os, os.path
+import sys
+import gzip
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from cache import LRUCache
+
+# Tile access for the server: one long-lived read-only connection per thread
+# and a cache of the raw tile bytes bounded by their total size.
+#
+# An optional side file next to the mbtiles (see build_variants) holds a content
+# hash of every tile, used as its ETag, and precompressed brotli/zstd variants.
+
+MMAP_SIZE = 1 << 30
+# cached for tiles that are not in the file
+MISSING = (b"", None)
+# preferred first, gzip is what the mbtiles contain and is always available
+ENCODINGS = ["br", "zstd", "gzip"]
+
+
+def variants_path(mbtiles_path):
+    return f"{mbtiles_path}-variants.sqlite"
+
+
+def expires_header(days=7):
+    expires_datetime = datetime.utcnow() + timedelta(days=days)
+    return expires_datetime.strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+
+def tile_headers(encoding="gzip", etag=None):
+    # built per request, so the Expires header is always a week ahead
+    headers = {"Access-Control-Allow-Origin": "*", "Expires": expires_header(), "Vary": "Accept-Encoding"}
+    # uncompressed tiles (possible in pmtiles archives) have no Content-Encoding
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    if etag is not None:
+        headers["ETag"] = etag
+    return headers
+
+
+def content_hash(tile_data):
+    return hashlib.blake2b(tile_data, digest_size=16).hexdigest()
+
+
+def make_etag(tile_hash, encoding):
+    # strong validator, different for every encoding of the same tile
+    return f'"{tile_hash}-{encoding}"'
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match is None or etag is None:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def accepted_encodings(accept_encoding):
+    # content codings the client accepts (q > 0), gzip is always assumed
+    accepted = {"gzip"}
+    if accept_encoding is None:
+        return accepted
+    for part in accept_encoding.split(","):
+        coding, *params = [value.strip() for value in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(coding.lower())
+    return accepted
+
+
+class TileReader():
+
+    def __init__(self, mbtiles_path, cache_bytes):
+        # immutable: the file is never written while serving, so sqlite skips locking
+        self.uri = f"file:{mbtiles_path}?mode=ro&immutable=1"
+        self.variants_uri = None
+        self.encodings = ["gzip"]
+        if os.path.isfile(variants_path(mbtiles_path)):
+            self.variants_uri = f"file:{variants_path(mbtiles_path)}?mode=ro&immutable=1"
+            con = self._connect(self.variants_uri)
+            variant_encodings = {row[0] for row in con.execute("select encoding from encodings")}
+            con.close()
+            self.encodings = [encoding for encoding in ENCODINGS if encoding in variant_encodings or encoding == "gzip"]
+        self._local = threading.local()
+        # values are (tile_data, etag)
+        self.cache = LRUCache(cache_bytes, sizeof=lambda value: len(value[0]) + 64)
+
+
+    @staticmethod
+    def _connect(uri):
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        con.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        return con
+
+
+    def _connection(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = self._connect(self.uri)
+        return con
+
+
+    def _variants_connection(self):
+        con = getattr(self._local, "variants_con", None)
+        if con is None:
+            con = self._local.variants_con = self._connect(self.variants_uri)
+        return con
+
+
+    def _load(self, z, x, y, encoding):
+        if encoding == "gzip":
+            row = self._connection().execute(
+                "select tile_data from tiles where zoom_level=? and tile_column=? and tile_row=?",
+                (z, x, y)).fetchone()
+            if not row:
+                return MISSING
+            tile_data = bytes(row[0])
+            if self.variants_uri is None:
+                return tile_data, make_etag(content_hash(tile_data), encoding)
+        else:
+            row = self._variants_connection().execute(
+                "select tile_data from tile_variants where zoom_level=? and tile_column=? and tile_row=? and encoding=?",
+                (z, x, y, encoding)).fetchone()
+            if not row:
+                return MISSING
+            tile_data = bytes(row[0])
+        row = self._variants_connection().execute(
+            "select hash from tile_hashes where zoom_level=? and tile_column=? and tile_row=?",
+            (z, x, y)).fetchone()
+        tile_hash = row[0] if row else content_hash(tile_data)
+        return tile_data, make_etag(tile_hash, encoding)
+
+
+    def read_tile(self, z, x, y, accepted=("gzip",)):
+        # y is in the TMS scheme used by mbtiles
+        # returns (tile_data, etag, encoding) of the preferred accepted encoding, None for missing tiles
+        for encoding in self.encodings:
+            if encoding not in accepted and encoding != "gzip":
+                continue
+            key = (z, x, y, encoding)
+            value = self.cache.get(key)
+            if value is None:
+                value = self._load(z, x, y, encoding)
+                self.cache.put(key, value)
+            tile_data, etag = value
+            if tile_data:
+                return tile_data, etag, encoding
+        return None
+
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def build_variants(mbtiles_path, encodings):
+    # offline pass: content hashes and precompressed variants of every tile
+    compressors = {}
+    for encoding in encodings:
+        if encoding == "br":
+            import brotli
+            compressors[encoding] = lambda data: brotli.compress(data, quality=11)
+        elif encoding == "zstd":
+            import zstandard
+            compressors[encoding] = zstandard.ZstdCompressor(level=19).compress
+        else:
+            raise ValueError(f"Unknown encoding {encoding}, available: br, zstd")
+
+    path = variants_path(mbtiles_path)
+    tmp_path = path + ".tmp"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    target = sqlite3.connect(tmp_path)
+    target.execute("create table encodings (encoding PRIMARY KEY)")
+    target.execute("create table tile_hashes (zoom_level integer, tile_column integer, tile_row integer, hash text, "
+                   "PRIMARY KEY (zoom_level, tile_column, tile_row))")
+    target.execute("create table tile_variants (zoom_level integer, tile_column integer, tile_row integer, "
+                   "encoding text, tile_data blob, PRIMARY KEY (zoom_level, tile_column, tile_row, encoding))")
+    target.executemany("insert into encodings (encoding) values (?)", [(encoding,) for encoding in encodings])
+
+    source = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    processed = 0
+    for z, x, y, tile_data in source.execute("select zoom_level, tile_column, tile_row, tile_data from tiles"):
+        target.execute("insert into tile_hashes values (?,?,?,?)", (z, x, y, content_hash(tile_data)))
+        # the mbtiles contain gzip compressed tiles
+        raw = gzip.decompress(tile_data) if tile_data[:2] == b"\x1f\x8b" else tile_data
+        for encoding, compress in compressors.items():
+            target.execute("insert into tile_variants values (?,?,?,?,?)", (z, x, y, encoding, compress(raw)))
+        processed += 1
+        if processed % 10000 == 0:
+            target.commit()
+            print(f" Processed: {processed}", end="\r")
+    target.commit()
+    target.close()
+    source.close()
+    os.replace(tmp_path, path)
+    print(f"Processed {processed} tiles")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python tiles.py <mbtiles_path> [br] [zstd]")
+        exit(0)
+    build_variants(sys.argv[1], sys.argv[2:])
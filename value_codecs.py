@@ -0,0 +1,136 @@
+import json
+from array import array
+import sys
+import numpy as np
+
+# Codecs for the values stored in dbdict tables.
+# json is the original format and works for any value, the binary codecs
+# only store lists of integers (e.g. waterway ids or node ids) as BLOBs.
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def encode_varints(values):
+    # unsigned LEB128
+    out = bytearray()
+    for value in values:
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data):
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        value = 0
+        shift = 0
+    return values
+
+
+def encode_deltas(ids):
+    # first id as is, then the differences to the previous id, all zigzag encoded
+    previous = 0
+    deltas = []
+    for id in ids:
+        deltas.append(zigzag(id - previous))
+        previous = id
+    return encode_varints(deltas)
+
+
+def decode_deltas(data):
+    ids = []
+    previous = 0
+    for delta in decode_varints(data):
+        previous += unzigzag(delta)
+        ids.append(previous)
+    return ids
+
+
+def encode_deltas_array(ids):
+    # vectorized encode_deltas for large id arrays, produces the same bytes
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return b""
+    deltas = np.diff(ids, prepend=np.int64(0))
+    values = ((deltas << np.int64(1)) ^ (deltas >> np.int64(63))).view(np.uint64)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        num_bytes += rest > 0
+        rest >>= np.uint64(7)
+    offsets = np.cumsum(num_bytes) - num_bytes
+    out = np.empty(int(num_bytes.sum()), dtype=np.uint8)
+    for i in range(int(num_bytes.max())):
+        active = num_bytes > i
+        byte = (values[active] >> np.uint64(7 * i)) & np.uint64(0x7f)
+        # continuation bit if more bytes follow
+        byte |= (num_bytes[active] > i + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[active] + i] = byte.astype(np.uint8)
+    return out.tobytes()
+
+
+class JsonCodec():
+    name = "json"
+    # sql condition for rows holding a single element list, used by clear_redundant_nodes
+    single_element_sql = "json_array_length(value) = 1"
+
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class Int64ArrayCodec():
+    # packed little endian int64, fast to decode
+    name = "int64"
+    single_element_sql = "length(value) = 8"
+
+    def encode(self, value):
+        values = array("q", value)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values.tobytes()
+
+    def decode(self, data):
+        values = array("q")
+        values.frombytes(data)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values.tolist()
+
+
+class VarintCodec():
+    # delta + zigzag + varint encoded, the smallest but slowest to decode
+    name = "varint"
+    single_element_sql = None
+
+    def encode(self, value):
+        return encode_deltas(value)
+
+    def decode(self, data):
+        return decode_deltas(data)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), Int64ArrayCodec(), VarintCodec())}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}, available: {', '.join(CODECS)}")
+    return CODECS[name]